@@ -0,0 +1,87 @@
+# activity.py
+"""
+Activity-adaptive polling.
+
+Per account we keep when a refresh last saw new games and a moving average
+of games per day. Active accounts are counted on every refresh; accounts
+that have been quiet are counted less often the longer they stay quiet,
+but never less often than once per ACTIVITY_MAX_STALENESS_SECONDS.
+Disable with ADAPTIVE_POLLING = False in key.py.
+"""
+from __future__ import annotations
+
+try:
+    from key import ADAPTIVE_POLLING
+except Exception:
+    ADAPTIVE_POLLING = True
+
+# Longest a skipped account's count may go without a recount
+try:
+    from key import ACTIVITY_MAX_STALENESS_SECONDS
+except Exception:
+    ACTIVITY_MAX_STALENESS_SECONDS = 3 * 24 * 60 * 60
+
+# Counted on every refresh: this many games/day on average, or new games this recently
+ACTIVE_GAMES_PER_DAY = 0.5
+ACTIVE_RECENT_SECONDS = 2 * 24 * 60 * 60
+
+# A quiet account is recounted after (time since its last new game) / this
+IDLE_BACKOFF_DIVISOR = 4
+
+EMA_ALPHA = 0.3
+# Polls closer together than this don't move the average (too noisy)
+EMA_MIN_ELAPSED_SECONDS = 60 * 60
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+def poll_interval(activity: dict | None, now_ts: int) -> int:
+    """
+    Seconds an account's stored count may be reused before it must be recounted.
+    activity: account_activity row or None (unknown accounts are always counted).
+    """
+    if activity is None:
+        return 0
+    if (activity["games_per_day"] or 0.0) >= ACTIVE_GAMES_PER_DAY:
+        return 0
+
+    idle = now_ts - int(activity["last_new_match_ts"] or activity["first_seen_ts"])
+    if idle < ACTIVE_RECENT_SECONDS:
+        return 0
+    return min(ACTIVITY_MAX_STALENESS_SECONDS, idle // IDLE_BACKOFF_DIVISOR)
+
+
+def should_poll(activity: dict | None, last_updated: int | None, now_ts: int) -> bool:
+    # No stored count for this window yet (e.g. a new week): always count
+    if last_updated is None:
+        return True
+    return now_ts - last_updated >= poll_interval(activity, now_ts)
+
+
+def observe(
+    activity: dict | None,
+    prev_games: int | None,
+    prev_updated: int | None,
+    games: int,
+    now_ts: int,
+) -> tuple[int | None, float, int]:
+    """
+    Folds one count into the account's activity.
+    Returns (last_new_match_ts, games_per_day, first_seen_ts).
+    """
+    if activity is None:
+        # First sight: games already in the window count as recent activity
+        return (now_ts if games > 0 else None), 0.0, now_ts
+
+    last_new = activity["last_new_match_ts"]
+    rate = float(activity["games_per_day"] or 0.0)
+
+    if prev_games is not None and prev_updated is not None:
+        gained = max(0, games - prev_games)
+        if gained:
+            last_new = now_ts
+        elapsed = now_ts - prev_updated
+        if elapsed >= EMA_MIN_ELAPSED_SECONDS:
+            rate = EMA_ALPHA * (gained * DAY_SECONDS / elapsed) + (1 - EMA_ALPHA) * rate
+
+    return last_new, rate, int(activity["first_seen_ts"])
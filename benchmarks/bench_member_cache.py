@@ -0,0 +1,203 @@
+# benchmarks/bench_member_cache.py
+"""
+Member cache of one large guild: full vs lean mode, memory and query cost.
+
+    python benchmarks/bench_member_cache.py [--members 100000] [--linked 20000] [--linked-here 2000]
+
+Full mode is the default bot setup: every member arrives through guild
+chunking and is cached. Lean mode is what bot.py configures with
+LEAN_MEMBER_CACHE: MemberCacheFlags.none(), no chunking, and
+guild_cache.member_ids() asking Discord only for linked users. --linked
+users are linked across all guilds, --linked-here of them are members of
+this one.
+
+Both run through discord.py's real chunk handling. A fake gateway answers
+the member requests, so the request counts are exact; the timings leave out
+the Discord round trip (about one per request). Linked users live in a
+throwaway DB.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import aiosqlite  # noqa: E402
+import discord  # noqa: E402
+from discord.state import ChunkRequest, ConnectionState  # noqa: E402
+
+import db  # noqa: E402
+import guild_cache  # noqa: E402
+
+GUILD_ID = 1
+CHUNK = 1000  # members per GUILD_MEMBERS_CHUNK event, as Discord sends them
+
+
+def _uid(i: int) -> int:
+    return 100_000_000_000_000_000 + i
+
+
+def _member_payload(uid: int) -> dict:
+    return {
+        "user": {"id": str(uid), "username": f"user{uid}", "discriminator": "0", "avatar": None, "global_name": None},
+        "roles": [],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+class FakeGateway:
+    """Answers member requests from a fixed member list, like Discord would."""
+
+    def __init__(self, state: ConnectionState, members: set[int]):
+        self.state = state
+        self.members = members
+        self.requests = 0
+        self.ids_asked = 0
+
+    async def request_chunks(self, guild_id, query=None, *, limit, user_ids=None, presences=False, nonce=None):
+        self.requests += 1
+        self.ids_asked += len(user_ids or ())
+        found = [_member_payload(uid) for uid in user_ids or () if uid in self.members]
+        data = {"guild_id": str(guild_id), "members": found, "chunk_index": 0, "chunk_count": 1, "nonce": nonce}
+        asyncio.get_running_loop().create_task(self._reply(data))
+
+    async def _reply(self, data: dict) -> None:
+        # Like a real round trip: answer once discord.py is waiting for it
+        while not self.state._chunk_requests[data["nonce"]].waiters:
+            await asyncio.sleep(0)
+        self.state.parse_guild_members_chunk(data)
+
+
+def _intents() -> discord.Intents:
+    intents = discord.Intents.default()
+    intents.members = True  # as in bot.py
+    return intents
+
+
+def _guild(n_members: int, flags: discord.MemberCacheFlags) -> tuple[discord.Guild, ConnectionState]:
+    state = ConnectionState(
+        dispatch=lambda *a: None, handlers={}, hooks={}, http=None, intents=_intents(), member_cache_flags=flags
+    )
+    state.loop = asyncio.get_running_loop()
+    guild = discord.Guild(
+        data={"id": str(GUILD_ID), "name": "bench", "roles": [], "emojis": [], "features": [], "member_count": n_members},
+        state=state,
+    )
+    state._add_guild(guild)
+    return guild, state
+
+
+async def _full(n_members: int) -> int:
+    """
+    Bytes kept after chunking every member into the cache (the default setup).
+    """
+    gc.collect()
+    tracemalloc.start()
+    guild, state = _guild(n_members, discord.MemberCacheFlags.from_intents(_intents()))
+    request = ChunkRequest(GUILD_ID, None, state.loop, state._get_guild, cache=True)
+    state._chunk_requests[request.nonce] = request
+    for start in range(0, n_members, CHUNK):
+        state.parse_guild_members_chunk({
+            "guild_id": str(GUILD_ID),
+            "members": [_member_payload(_uid(i)) for i in range(start, min(start + CHUNK, n_members))],
+            "chunk_index": start // CHUNK,
+            "chunk_count": -(-n_members // CHUNK),
+            "nonce": request.nonce,
+        })
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(guild.members) == n_members
+    return used
+
+
+async def _lean(n_members: int, linked_here: int) -> tuple[int, list[tuple[str, int, int, float]]]:
+    """
+    Bytes kept by the lean cache, and (pass, requests, ids asked, ms) per member_ids() pass.
+    """
+    members = {_uid(i) for i in range(n_members)}
+    assert linked_here <= n_members
+
+    gc.collect()
+    tracemalloc.start()
+    guild, state = _guild(n_members, discord.MemberCacheFlags.none())
+    gateway = FakeGateway(state, members)
+    state._get_websocket = lambda guild_id=None, shard_id=None: gateway
+
+    passes = []
+
+    async def one_pass(name: str) -> None:
+        guild_cache.invalidate_members(GUILD_ID)  # as if MEMBER_CACHE_TTL_SECONDS ran out
+        before = (gateway.requests, gateway.ids_asked)
+        t0 = time.perf_counter()
+        ids = await guild_cache.member_ids(guild)
+        ms = (time.perf_counter() - t0) * 1000
+        assert len(ids) == linked_here, (name, len(ids))
+        passes.append((name, gateway.requests - before[0], gateway.ids_asked - before[1], ms))
+
+    await one_pass("first")
+    await one_pass("ttl refresh")
+    guild_cache._absent.invalidate_guild(GUILD_ID)
+    await one_pass("absent-set expired")
+
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used, passes
+
+
+async def _link_users(linked: int, linked_here: int) -> None:
+    # The first linked_here linked users are members of the guild, the rest are not
+    ids = [_uid(i) for i in range(linked_here)] + [_uid(10_000_000 + i) for i in range(linked - linked_here)]
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        await conn.executemany(
+            "INSERT INTO users(discord_user_id, created_at) VALUES(?, 0)", [(str(u),) for u in ids]
+        )
+        await conn.executemany(
+            "INSERT INTO riot_accounts(discord_user_id, puuid, platform, added_at) VALUES(?, ?, 'EUW1', 0)",
+            [(str(u), f"puuid-{u}") for u in ids],
+        )
+        await conn.commit()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=100_000)
+    parser.add_argument("--linked", type=int, default=20_000, help="linked users across all guilds")
+    parser.add_argument("--linked-here", type=int, default=2_000, help="linked users in this guild")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_DIR = Path(tmp)
+        db.DB_PATH = db.DB_DIR / "bench.sqlite3"
+        db.SCHEMA_PATH = ROOT / "db" / "schema.sql"
+        await db.init_db()
+        await _link_users(args.linked, args.linked_here)
+
+        guild_cache.LEAN_MEMBER_CACHE = True
+        full = await _full(args.members)
+        lean, passes = await _lean(args.members, args.linked_here)
+
+    mb = 1024 * 1024
+    print(f"members={args.members} linked={args.linked} linked_here={args.linked_here}")
+    print(f"full cache: {full / mb:8.1f} MiB ({full / args.members:.0f} B/member)")
+    print(f"lean cache: {lean / mb:8.1f} MiB")
+    print(f"saved:      {(full - lean) / mb:8.1f} MiB ({(1 - lean / full) * 100:.1f}%)")
+    print("lean member_ids() passes (each request is one gateway round trip):")
+    for name, requests, asked, ms in passes:
+        print(f"  {name:<20} requests={requests:5d} ids_asked={asked:7d} local={ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+# benchmarks/bench_retention.py
+"""
+DB size and leaderboard query latency after a simulated year, with and
+without the retention pass.
+
+    python benchmarks/bench_retention.py [--guilds 50] [--accounts 2000] [--horizon-days 90]
+
+Every guild uses weekly windows; each week every account gets an
+account_stats row and every guild a full snapshot, like a year of
+scheduled refreshes. Runs against a throwaway DB in a temp directory.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import aiosqlite  # noqa: E402
+
+import db  # noqa: E402
+import retention  # noqa: E402
+from utilities.utils_window import make_window_key  # noqa: E402
+
+WEEK = 7 * 24 * 60 * 60
+TZ = "Europe/Copenhagen"
+
+
+async def _populate(guilds: int, accounts: int, weeks: int, now_ts: int) -> list[str]:
+    per_guild = accounts // guilds
+    window_keys = [make_window_key("week", now_ts - (weeks - w) * WEEK, TZ) for w in range(weeks)]
+
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        await conn.executemany(
+            "INSERT INTO users(discord_user_id, created_at) VALUES(?, ?)",
+            [(str(u), now_ts) for u in range(accounts)],
+        )
+        await conn.executemany(
+            "INSERT INTO riot_accounts(id, discord_user_id, riot_id, puuid, platform, added_at) VALUES(?, ?, ?, ?, ?, ?)",
+            [(u + 1, str(u), f"p{u}#EUW", f"puuid-{u}", "EUW1", now_ts) for u in range(accounts)],
+        )
+        await conn.executemany(
+            "INSERT INTO guild_settings(guild_id, window_mode, window_tz) VALUES(?, 'week', ?)",
+            [(str(g), TZ) for g in range(guilds)],
+        )
+        for w, window_key in enumerate(window_keys):
+            await conn.executemany(
+                "INSERT INTO account_stats(account_id, window_key, games_played, last_updated) VALUES(?, ?, ?, ?)",
+                [(u + 1, window_key, (u * 7 + w) % 40, now_ts) for u in range(accounts)],
+            )
+            await conn.executemany(
+                """
+                INSERT INTO leaderboard_snapshots(guild_id, window_key, discord_user_id, rank, games_played, updated_at)
+                VALUES(?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (str(g), window_key, str(g * per_guild + i), i + 1, (i * 7 + w) % 40, now_ts)
+                    for g in range(guilds)
+                    for i in range(per_guild)
+                ],
+            )
+        await conn.commit()
+    return window_keys
+
+
+def _db_bytes() -> int:
+    wal = db.DB_PATH.with_name(db.DB_PATH.name + "-wal")
+    return sum(p.stat().st_size for p in (db.DB_PATH, wal) if p.exists())
+
+
+async def _checkpoint() -> None:
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        await conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+async def _query_ms(member_ids: list[int], window_key: str, rounds: int = 50) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await db.get_guild_leaderboard_rows(member_ids, window_key)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+async def main(guilds: int, accounts: int, horizon_days: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_DIR = Path(tmp)
+        db.DB_PATH = db.DB_DIR / "bench.sqlite3"
+        db.SCHEMA_PATH = ROOT / "db" / "schema.sql"
+        await db.init_db()
+
+        now_ts = int(time.time())
+        window_keys = await _populate(guilds, accounts, 52, now_ts)
+        await _checkpoint()
+
+        member_ids = [str(u) for u in range(accounts // guilds)]
+        old_key = window_keys[0]
+
+        size_before = _db_bytes()
+        ms_before = await _query_ms(member_ids, window_keys[-1])
+
+        result = await retention.run_retention(horizon_days)
+        await _checkpoint()
+
+        size_after = _db_bytes()
+        ms_after = await _query_ms(member_ids, window_keys[-1])
+        archived = old_key not in await db.list_window_keys()
+
+        print(f"guilds={guilds} accounts={accounts} windows=52 horizon={horizon_days}d")
+        print(f"retention: {result}")
+        print(f"db size:   {size_before / 2**20:8.1f} MiB -> {size_after / 2**20:8.1f} MiB")
+        print(f"board query: {ms_before:6.2f} ms -> {ms_after:6.2f} ms")
+        print(f"oldest window archived: {archived}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--horizon-days", type=int, default=90)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.guilds, args.accounts, args.horizon_days))
@@ -0,0 +1,127 @@
+# benchmarks/bench_speedups.py
+"""
+Cost per 1k Match-V5 pages of JSON decoding and of the event loop.
+
+    python benchmarks/bench_speedups.py [--pages 1000] [--ids 100] [--concurrency 8]
+
+decode: json.loads vs orjson.loads on a page of match ids (the body of every
+    Match-V5 ids request) and on an account-v1 body.
+loop: a local aiohttp server serves the same page and a client fetches it
+    `--pages` times with `--concurrency` in flight, on asyncio and on uvloop.
+    This is the HTTP and scheduling overhead a refresh pays on top of Riot.
+
+Backends that are not installed are reported and skipped.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+
+def _ids_page(n_ids: int) -> str:
+    return json.dumps([f"EUW1_{7_000_000_000 + i}" for i in range(n_ids)])
+
+
+ACCOUNT_BODY = json.dumps({"puuid": "x" * 78, "gameName": "Some Player", "tagLine": "EUW"})
+
+
+def _decoders() -> dict:
+    out = {"json": json.loads}
+    try:
+        import orjson
+        out["orjson"] = orjson.loads
+    except ImportError:
+        print("orjson not installed: skipped")
+    return out
+
+
+def _bench_decode(pages: int, body: str) -> dict[str, float]:
+    """
+    Milliseconds to decode `body` `pages` times, best of 5.
+    """
+    out = {}
+    for name, loads in _decoders().items():
+        best = float("inf")
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(pages):
+                loads(body)
+            best = min(best, time.perf_counter() - started)
+        out[name] = best * 1000
+    return out
+
+
+async def _fetch_pages(pages: int, concurrency: int, body: str, loads) -> float:
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(text=body, content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/ids", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    url = f"http://127.0.0.1:{port}/ids"
+    remaining = iter(range(pages))
+
+    async with aiohttp.ClientSession() as session:
+
+        async def worker():
+            for _ in remaining:
+                async with session.get(url) as resp:
+                    await resp.json(loads=loads)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    return elapsed * 1000
+
+
+def _bench_loops(pages: int, concurrency: int, body: str) -> dict[str, float]:
+    loops = {"asyncio": asyncio.run}
+    try:
+        import uvloop
+        loops["uvloop"] = uvloop.run
+    except ImportError:
+        print("uvloop not installed: skipped")
+
+    out = {}
+    for loop_name, run in loops.items():
+        for json_name, loads in _decoders().items():
+            run(_fetch_pages(pages // 10, concurrency, body, loads))  # warm-up
+            out[f"{loop_name} + {json_name}"] = run(_fetch_pages(pages, concurrency, body, loads))
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--ids", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    per_1k = 1000 / args.pages
+    page = _ids_page(args.ids)
+    print(f"pages={args.pages} ids/page={args.ids} ({len(page)} bytes) concurrency={args.concurrency}")
+
+    print("\ndecode, ms per 1k bodies")
+    for label, body in (("match ids page", page), ("account-v1", ACCOUNT_BODY)):
+        for name, ms in _bench_decode(args.pages, body).items():
+            print(f"  {label:<15} {name:<7} {ms * per_1k:8.2f}")
+
+    print("\nfetch + decode over loopback HTTP, ms per 1k pages")
+    for name, ms in _bench_loops(args.pages, args.concurrency, page).items():
+        print(f"  {name:<18} {ms * per_1k:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
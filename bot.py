@@ -1,24 +1,103 @@
 # bot.py
-import asyncio
+import time
+
+_PROCESS_START = time.perf_counter()
+
+import hashlib
+import json
+
 import discord
 from discord.ext import commands
 
 import db
+import guild_cache
+import loop_monitor
+import metrics
+import shards
+import singleflight
+import speedups
 from key import BOT_KEY
 
 intents = discord.Intents.default()
 intents.members = True  
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot_options = {}
+if guild_cache.LEAN_MEMBER_CACHE:
+    # Don't cache or chunk every member; guild_cache fetches linked users on demand
+    bot_options["member_cache_flags"] = discord.MemberCacheFlags.none()
+    bot_options["chunk_guilds_at_startup"] = False
+
+if shards.SHARD_COUNT:
+    # shard_ids=None lets this process run every shard; set SHARD_IDS to split across processes
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=shards.SHARD_COUNT,
+        shard_ids=shards.SHARD_IDS,
+        **bot_options,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, **bot_options)
+
+
+_startup_marks: set[str] = set()
+
+
+def _startup_mark(stage: str) -> None:
+    """
+    Records seconds since process start for a startup stage (first time only).
+    """
+    if stage in _startup_marks:
+        return
+    _startup_marks.add(stage)
+    elapsed = time.perf_counter() - _PROCESS_START
+    metrics.observe(f"startup.{stage}", elapsed)
+    print(f"[Startup] {stage} after {elapsed:.2f}s")
+
+
+async def sync_commands_if_changed() -> None:
+    """
+    Global tree sync (all servers), but only when the command definitions changed
+    since the last successful sync. Reconnects never sync.
+    """
+    payload = [c.to_dict(bot.tree) for c in bot.tree.get_commands()]
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    if await db.get_meta("command_tree_hash") == digest:
+        print("Command tree unchanged — skipping sync")
+        return
+
+    synced = await bot.tree.sync()
+    await db.set_meta("command_tree_hash", digest)
+    print(f"Synced {len(synced)} global commands")
 
 
 @bot.event
 async def on_ready():
-    await db.init_db()
+    # Fires again after every reconnect; keep it cheap
+    _startup_mark("ready")
+    print(f"Ready as {bot.user} ({bot.user.id})")
 
-    # Global sync (all servers)
-    synced = await bot.tree.sync()
-    print(f"Synced {len(synced)} global commands as {bot.user} ({bot.user.id})")
+
+@bot.listen("on_interaction")
+async def _first_interaction(interaction: discord.Interaction):
+    _startup_mark("first_interaction")
+
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    guild_cache.member_joined(member.guild.id, member.id)
+
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    guild_cache.invalidate_members(member.guild.id)
+
+
+@bot.event
+async def on_shard_disconnect(shard_id: int):
+    # Member lists may be stale after the gateway comes back
+    guild_cache.drop_shard(shard_id)
 
 
 async def load_cogs():
@@ -28,6 +107,7 @@ async def load_cogs():
         "commands.scheduler",
         "commands.admin",
         "commands.leaderboard_commands",
+        "commands.maintenance",
     ]:
         try:
             await bot.load_extension(ext)
@@ -37,9 +117,26 @@ async def load_cogs():
 
 
 async def main():
+    # Loop lag sampling and blocking-call capture from the very start
+    loop_monitor.start()
+
+    # Schema migrations run once per process, not on every gateway (re)connect
+    await db.init_db()
+    _startup_mark("db_ready")
+
     async with bot:
         await load_cogs()
-        await bot.start(BOT_KEY)
+        _startup_mark("cogs_loaded")
+
+        await bot.login(BOT_KEY)
+        await sync_commands_if_changed()
+        _startup_mark("commands_synced")
+
+        try:
+            await bot.connect()
+        finally:
+            # Riot requests (coalesced flights) share one session for the process lifetime
+            await singleflight.close_http_session()
 
 
-asyncio.run(main())
+speedups.run(main())
@@ -4,8 +4,9 @@ from discord import app_commands
 import traceback
 
 import db
-from key import RIOT_API_KEY
+import guild_cache
 from riot_api import get_puuid_by_riot_id, RiotNotFound, RiotUnauthorized, RiotRateLimited
+from riot_limits import RiotUnavailable
 
 PLATFORMS = [
     "EUW1", "EUN1", "NA1", "KR", "JP1",
@@ -14,10 +15,10 @@ PLATFORMS = [
 
 REGION_CLUSTERS = ["europe", "americas", "asia", "sea"]
 
-async def resolve_puuid_any_cluster(api_key: str, riot_id: str):
+async def resolve_puuid_any_cluster(riot_id: str):
     for cluster in REGION_CLUSTERS:
         try:
-            return await get_puuid_by_riot_id(api_key, riot_id, region_cluster=cluster)
+            return await get_puuid_by_riot_id(riot_id, region_cluster=cluster)
         except RiotNotFound:
             continue
     raise RiotNotFound()
@@ -40,8 +41,7 @@ class Accounts(commands.Cog):
         plat = platform.value
 
         try:
-            print("RIOT_API_KEY loaded:", RIOT_API_KEY[:10])
-            puuid, game_name, tag_line = await resolve_puuid_any_cluster(RIOT_API_KEY, riot_id)
+            puuid, game_name, tag_line = await resolve_puuid_any_cluster(riot_id)
             canonical_riot_id = f"{game_name}#{tag_line}"
 
             inserted = await db.add_riot_account(
@@ -52,6 +52,8 @@ class Accounts(commands.Cog):
             )
 
             if inserted:
+                if interaction.guild_id:
+                    guild_cache.invalidate_members(interaction.guild_id)
                 await interaction.followup.send(f"✅ Linked **{canonical_riot_id}** on **{plat}**.", ephemeral=True)
             else:
                 await interaction.followup.send("ℹ️ That Riot account is already linked (PUUID exists).", ephemeral=True)
@@ -68,6 +70,11 @@ class Accounts(commands.Cog):
                 msg += f" (Retry-After: {e.retry_after}s)"
             await interaction.followup.send(msg, ephemeral=True)
 
+        except RiotUnavailable as e:
+            await interaction.followup.send(
+                f"⏳ Riot API is having trouble right now. Try again in {int(e.retry_after) + 1}s.", ephemeral=True
+            )
+
         except Exception:
             print("Link crashed:\n", traceback.format_exc())
             await interaction.followup.send("❌ Something went wrong. Check bot console.", ephemeral=True)
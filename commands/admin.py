@@ -1,5 +1,8 @@
 # commands/admin.py
-import time
+import asyncio
+import csv
+import io
+import re
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
@@ -8,10 +11,13 @@ from discord.ext import commands
 from discord import app_commands
 
 import db
+import guild_cache
 from utilities.utils_schedule import compute_next_refresh_ts
-from utilities.utils_window import compute_window_start_ts, make_window_key
+from utilities.utils_window import compute_window_start_ts
 from leaderboard import refresh_leaderboard_for_guild
 from stats_update import update_stats_for_guild
+import refresh
+import window_service
 
 
 try:
@@ -20,14 +26,13 @@ except Exception:
     BOT_OWNER_IDS = set()
 
 
-# Riot API key (safe import so bot doesn't crash if missing)
-try:
-    from key import RIOT_API_KEY
-except Exception:
-    RIOT_API_KEY = None
-
 # Riot API helper imports
 from riot_api import get_puuid_by_riot_id, RiotNotFound, RiotUnauthorized, RiotRateLimited
+import riot_limits
+from riot_limits import PRIORITY_INTERACTIVE, PRIORITY_BACKFILL, RiotUnavailable
+import loop_monitor
+import metrics
+import profiling
 
 # Platforms you support (must exist because /adminlink uses it)
 PLATFORMS = [
@@ -54,16 +59,117 @@ QUEUE_POLICIES = [
 
 REGION_CLUSTERS = ["europe", "americas", "asia", "sea"]
 
+# Bulk import: Riot IDs resolved at once per usable API key, and how often the progress message is edited
+BULK_IMPORT_CONCURRENCY = 4
+BULK_IMPORT_MAX_ROWS = 2000
+BULK_IMPORT_PROGRESS_SECONDS = 3.0
+BULK_IMPORT_MAX_RETRIES = 3
+
+# /refreshnow edits its progress message at most this often (Discord rate-limits edits)
+REFRESH_PROGRESS_EDIT_SECONDS = 5.0
+
+_MENTION_RE = re.compile(r"^<@!?(\d+)>$")
+
 
-async def resolve_puuid_any_cluster(api_key: str, riot_id: str):
+async def resolve_puuid_any_cluster(
+    riot_id: str,
+    priority: int = PRIORITY_INTERACTIVE,
+):
     for cluster in REGION_CLUSTERS:
         try:
-            return await get_puuid_by_riot_id(api_key, riot_id, region_cluster=cluster)
+            return await get_puuid_by_riot_id(
+                riot_id, region_cluster=cluster, priority=priority
+            )
         except RiotNotFound:
             continue
     raise RiotNotFound()
 
 
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+
+def _progress_line(progress) -> str:
+    if progress is None or not progress.total:
+        return "🔄 Refreshing… collecting accounts"
+    eta = progress.eta_seconds()
+    eta_txt = f"ETA ~{_format_duration(eta)}" if eta is not None else "ETA —"
+    return (
+        f"🔄 Refreshing… **{progress.done}/{progress.total}** accounts · "
+        f"{progress.requests} Riot requests · {_format_duration(progress.elapsed())} elapsed · {eta_txt}"
+    )
+
+
+class RefreshCancelView(discord.ui.View):
+    """
+    Cancel button under the /refreshnow progress message.
+    """
+
+    def __init__(self, task: asyncio.Task):
+        super().__init__(timeout=None)
+        self.task = task
+        self.cancelling = False
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.cancelling = True
+        self.task.cancel()
+        button.disabled = True
+        await interaction.response.edit_message(content="🛑 Cancelling…", view=self)
+
+
+def _parse_discord_user_id(raw: str) -> int | None:
+    raw = raw.strip()
+    m = _MENTION_RE.match(raw)
+    if m:
+        return int(m.group(1))
+    return int(raw) if raw.isdigit() else None
+
+
+def _parse_import_csv(text: str) -> tuple[list[tuple[int, int, str, str]], list[str]]:
+    """
+    Parses "discord_user, riot_id, platform" rows.
+    discord_user may be a raw ID or a mention. A header row is skipped.
+    Returns (rows as (line_no, discord_user_id, riot_id, platform), errors).
+    """
+    rows: list[tuple[int, int, str, str]] = []
+    errors: list[str] = []
+
+    for line_no, cols in enumerate(csv.reader(io.StringIO(text)), start=1):
+        cols = [c.strip() for c in cols]
+        if not any(cols):
+            continue
+        if line_no == 1 and cols[0].lower() in ("discord_user", "discord_user_id", "user", "discord"):
+            continue
+        if len(cols) < 3:
+            errors.append(f"line {line_no}: expected 3 columns (discord_user, riot_id, platform)")
+            continue
+
+        duid = _parse_discord_user_id(cols[0])
+        if duid is None:
+            errors.append(f"line {line_no}: invalid Discord user `{cols[0]}`")
+            continue
+
+        riot_id = cols[1]
+        if "#" not in riot_id:
+            errors.append(f"line {line_no}: invalid Riot ID `{riot_id}` (expected GameName#TAG)")
+            continue
+
+        plat = cols[2].upper()
+        if plat not in PLATFORMS:
+            errors.append(f"line {line_no}: unknown platform `{cols[2]}`")
+            continue
+
+        rows.append((line_no, duid, riot_id, plat))
+
+    return rows, errors
+
+
 @app_commands.default_permissions(administrator=True)
 class Admin(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -81,17 +187,7 @@ class Admin(commands.Cog):
         Returns (window_key, window_start_ts, mode, tz_name)
         """
         gs = await db.get_guild_settings(guild_id)
-        mode = (gs.get("window_mode") or "month").strip().lower()
-        tz_name = gs.get("window_tz") or "Europe/Copenhagen"
-        since_ts = gs.get("window_since_ts")
-
-        window_start_ts = compute_window_start_ts(
-            now_utc=datetime.now(timezone.utc),
-            mode=mode,
-            tz_name=tz_name,
-            since_ts=since_ts,
-        )
-        window_key = make_window_key(mode, window_start_ts, tz_name)
+        window_key, window_start_ts, mode, tz_name, _ = window_service.window_for_settings(gs)
         return window_key, window_start_ts, mode, tz_name
 
     # ---------------- Leaderboard placement ----------------
@@ -114,13 +210,12 @@ class Admin(commands.Cog):
         window_key, window_start_ts, mode, tz_name = await self._compute_window(interaction.guild_id)
 
         # Optional: fetch stats immediately for first render
-        if RIOT_API_KEY:
+        if riot_limits.has_keys():
             gs = await db.get_guild_settings(interaction.guild_id)
             queue_policy = (gs.get("queue_policy") or "all").strip().lower()
 
             await update_stats_for_guild(
                 guild=interaction.guild,
-                riot_api_key=RIOT_API_KEY,
                 window_key=window_key,
                 window_start_ts=window_start_ts,
                 queue_policy=queue_policy,
@@ -169,6 +264,11 @@ class Admin(commands.Cog):
             next_refresh_ts=next_ts,
         )
 
+        # Wake the scheduler so the new time takes effect immediately
+        scheduler = self.bot.get_cog("Scheduler")
+        if scheduler is not None:
+            scheduler.schedule(interaction.guild_id, next_ts)
+
         await interaction.followup.send(
             f"✅ Refresh set: {weekday.name.title()} {hour:02d}:{minute:02d} ({tz_name}).\n"
             f"Next refresh: <t:{next_ts}:F>",
@@ -240,6 +340,30 @@ class Admin(commands.Cog):
 
         await interaction.followup.send(f"✅ Queue policy set to `{policy.value}`.", ephemeral=True)
 
+    # ---------------- Stale-while-revalidate ----------------
+    @app_commands.command(name="setstaleness", description="Refresh in the background when /top or /myrank data is older than N hours.")
+    @app_commands.describe(hours="0 turns background refresh off")
+    async def setstaleness(self, interaction: discord.Interaction, hours: int):
+        if not self._is_admin(interaction):
+            await interaction.response.send_message("❌ Admins only.", ephemeral=True)
+            return
+
+        if hours < 0 or hours > 24 * 14:
+            await interaction.response.send_message("❌ hours must be between 0 and 336.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        await db.ensure_guild_settings(interaction.guild_id)
+        await db.set_stale_after_seconds(interaction.guild_id, hours * 3600)
+
+        if hours == 0:
+            await interaction.followup.send("✅ Background refresh on read is **off**.", ephemeral=True)
+        else:
+            await interaction.followup.send(
+                f"✅ `/top` and `/myrank` will refresh in the background when data is older than **{hours}h**.",
+                ephemeral=True,
+            )
+
     # ---------------- Manual refresh + status ----------------
     @app_commands.command(name="refreshstatus", description="Show this server's refresh + window setup.")
     async def refreshstatus(self, interaction: discord.Interaction):
@@ -263,6 +387,11 @@ class Admin(commands.Cog):
         since_txt = f"<t:{since_ts}:F>" if since_ts else "—"
         queue_policy = (gs.get("queue_policy") or "all").strip().lower()
 
+        stale_after = gs.get("stale_after_seconds")
+        if stale_after is None:
+            stale_after = refresh.DEFAULT_STALE_AFTER_SECONDS
+        stale_txt = f"{stale_after // 3600}h" if stale_after > 0 else "off"
+
         try:
             start_ts = compute_window_start_ts(datetime.now(timezone.utc), mode, tz_name, since_ts)
             start_txt = f"<t:{start_ts}:F>"
@@ -279,12 +408,14 @@ class Admin(commands.Cog):
             f"- Window tz: `{tz_name}`\n"
             f"- Window since: {since_txt}\n"
             f"- Window starts now at: {start_txt}\n"
-            f"- Queue policy: `{queue_policy}`\n",
+            f"- Queue policy: `{queue_policy}`\n"
+            f"- Background refresh when older than: `{stale_txt}`\n",
             ephemeral=True,
         )
 
     @app_commands.command(name="refreshnow", description="Force update stats and refresh leaderboard now.")
-    async def refreshnow(self, interaction: discord.Interaction):
+    @app_commands.describe(profile="Record where the refresh spends its time (writes a flame graph file)")
+    async def refreshnow(self, interaction: discord.Interaction, profile: bool = False):
         if not self._is_admin(interaction):
             await interaction.response.send_message("❌ Admins only.", ephemeral=True)
             return
@@ -292,8 +423,8 @@ class Admin(commands.Cog):
         await interaction.response.defer(ephemeral=True)
         await db.ensure_guild_settings(interaction.guild_id)
 
-        if not RIOT_API_KEY:
-            await interaction.followup.send("❌ RIOT_API_KEY is missing in key.py", ephemeral=True)
+        if not riot_limits.has_keys():
+            await interaction.followup.send("❌ RIOT_API_KEY(S) missing in key.py", ephemeral=True)
             return
 
         gs = await db.get_guild_settings(interaction.guild_id)
@@ -301,27 +432,89 @@ class Admin(commands.Cog):
 
         window_key, window_start_ts, mode, tz_name = await self._compute_window(interaction.guild_id)
 
-        updated = await update_stats_for_guild(
-            guild=interaction.guild,
-            riot_api_key=RIOT_API_KEY,
-            window_key=window_key,
-            window_start_ts=window_start_ts,
-            queue_policy=queue_policy,
-            max_concurrency=2,
-        )
-
-        await refresh_leaderboard_for_guild(self.bot, interaction.guild_id, window_key)
+        # Joins a background refresh of this guild if one is already running
+        joined = refresh.is_refreshing(interaction.guild_id)
+        task = refresh.start_refresh(self.bot, interaction.guild, profile=profile)
+        progress = refresh.progress_for(interaction.guild_id)
+
+        view = RefreshCancelView(task)
+        status_msg = await interaction.followup.send(_progress_line(progress), view=view, ephemeral=True, wait=True)
+
+        # Throttled progress edits. The interaction token expires after 15 minutes:
+        # from then on the refresh just runs to the end without a visible status.
+        editable = True
+        while not task.done():
+            await asyncio.wait({task}, timeout=REFRESH_PROGRESS_EDIT_SECONDS)
+            if task.done() or not editable or view.cancelling:
+                continue
+            try:
+                await status_msg.edit(content=_progress_line(progress), view=view)
+            except discord.HTTPException:
+                editable = False
+
+        view.stop()
+        if task.cancelled():
+            done = f" after {progress.done}/{progress.total} accounts" if progress else ""
+            final = f"🛑 Refresh cancelled{done}. Counts stored so far are kept."
+        elif task.exception() is not None:
+            final = f"❌ Refresh failed: `{task.exception()}`"
+        else:
+            final = self._refresh_summary(task.result(), mode, window_start_ts, tz_name, queue_policy)
 
-        now_ts = int(time.time())
-        await db.set_last_refresh_ts(interaction.guild_id, now_ts)
+        attachments = []
+        if profile:
+            profiled = None if joined else refresh.take_profile(interaction.guild_id)
+            if profiled is None:
+                final += "\n⚠️ Not profiled: a refresh was already running."
+            else:
+                prof, path = profiled
+                final += f"\n🔬 **Hot spots** (`{path}`)\n```\n{prof.summary()[:1200]}\n```"
+                attachments.append(discord.File(path))
 
-        await interaction.followup.send(
-            f"✅ Refreshed. Updated {updated} linked accounts.\n"
+        try:
+            await status_msg.edit(content=final, view=None, attachments=attachments)
+        except discord.HTTPException:
+            print(f"[Admin] /refreshnow guild {interaction.guild_id}: could not post result (token expired)")
+
+    @staticmethod
+    def _refresh_summary(result, mode: str, window_start_ts: int, tz_name: str, queue_policy: str) -> str:
+        msg = (
+            f"{'⚠️' if result.failed else '✅'} Refreshed: {result.summary()}.\n"
             f"Window: `{mode}` start <t:{window_start_ts}:F> ({tz_name})\n"
-            f"Queues: `{queue_policy}`",
+            f"Queues: `{queue_policy}`"
+        )
+        if result.failed:
+            shown = list(result.failed.items())[:5]
+            msg += "\nFailed (kept previous counts):\n" + "\n".join(
+                f"• account `{account_id}`: {error[:100]}" for account_id, error in shown
+            )
+        return msg
+
+    @app_commands.command(name="profilerefresh", description="(Admin) Profile this server's next scheduled refresh.")
+    async def profilerefresh(self, interaction: discord.Interaction):
+        if not self._is_admin(interaction):
+            await interaction.response.send_message("❌ Admins only.", ephemeral=True)
+            return
+
+        profiling.arm(interaction.guild_id)
+        await interaction.response.send_message(
+            "🔬 The next scheduled refresh will be profiled. Hot spots go to the bot log and a "
+            f"flame graph file to `{profiling.PROFILE_DIR}/`. For a run right now use `/refreshnow profile:True`.",
             ephemeral=True,
         )
 
+    @app_commands.command(name="botstats", description="(Admin) Show Riot rate-limit, latency and event-loop metrics.")
+    async def botstats(self, interaction: discord.Interaction):
+        if not self._is_admin(interaction):
+            await interaction.response.send_message("❌ Admins only.", ephemeral=True)
+            return
+
+        msg = f"📈 **Bot metrics**\n```\n{metrics.format_summary()[:1400]}\n```"
+        stalls = loop_monitor.format_stalls()
+        if stalls:
+            msg += f"🐢 **Recent event-loop stalls**\n```\n{stalls[:450]}\n```"
+        await interaction.response.send_message(msg, ephemeral=True)
+
     # ---------------- Admin manage other users' links ----------------
     @app_commands.command(name="adminaccounts", description="(Admin) Show linked Riot accounts for a specific user.")
     @app_commands.describe(user="The Discord user to check")
@@ -354,15 +547,15 @@ class Admin(commands.Cog):
 
         await interaction.response.defer(ephemeral=True)
 
-        if not RIOT_API_KEY:
-            await interaction.followup.send("❌ RIOT_API_KEY missing.", ephemeral=True)
+        if not riot_limits.has_keys():
+            await interaction.followup.send("❌ RIOT_API_KEY(S) missing.", ephemeral=True)
             return
 
         riot_id = riot_id.strip()
         plat = platform.value
 
         try:
-            puuid, game_name, tag_line = await resolve_puuid_any_cluster(RIOT_API_KEY, riot_id)
+            puuid, game_name, tag_line = await resolve_puuid_any_cluster(riot_id)
             canonical_riot_id = f"{game_name}#{tag_line}"
 
             inserted = await db.add_riot_account(
@@ -373,6 +566,7 @@ class Admin(commands.Cog):
             )
 
             if inserted:
+                guild_cache.invalidate_members(interaction.guild_id)
                 await interaction.followup.send(
                     f"✅ Linked **{canonical_riot_id}** on **{plat}** to {user.mention}.",
                     ephemeral=True,
@@ -393,9 +587,153 @@ class Admin(commands.Cog):
             if retry_after:
                 msg += f" (Retry-After: {retry_after}s)"
             await interaction.followup.send(msg, ephemeral=True)
+        except RiotUnavailable as e:
+            await interaction.followup.send(
+                f"⏳ Riot API is having trouble right now. Try again in {int(e.retry_after) + 1}s.", ephemeral=True
+            )
         except Exception as ex:
             await interaction.followup.send(f"❌ adminlink failed: `{ex}`", ephemeral=True)
 
+    @app_commands.command(name="adminimport", description="(Admin) Bulk link Riot accounts from a CSV file.")
+    @app_commands.describe(file="CSV with rows: discord_user, riot_id, platform")
+    async def adminimport(self, interaction: discord.Interaction, file: discord.Attachment):
+        if not self._is_admin(interaction):
+            await interaction.response.send_message("❌ Admins only.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+
+        if not riot_limits.has_keys():
+            await interaction.followup.send("❌ RIOT_API_KEY(S) missing.", ephemeral=True)
+            return
+
+        try:
+            text = (await file.read()).decode("utf-8-sig")
+        except UnicodeDecodeError:
+            await interaction.followup.send("❌ File must be UTF-8 CSV.", ephemeral=True)
+            return
+
+        rows, errors = _parse_import_csv(text)
+        if len(rows) > BULK_IMPORT_MAX_ROWS:
+            await interaction.followup.send(f"❌ Too many rows ({len(rows)}). Max is {BULK_IMPORT_MAX_ROWS}.", ephemeral=True)
+            return
+        if not rows:
+            report = "\n".join(errors[:20]) or "File is empty."
+            await interaction.followup.send(f"❌ Nothing to import.\n{report}", ephemeral=True)
+            return
+
+        total = len(rows)
+        done = 0
+        resolved: list[tuple[int, str, str, str]] = []
+        queue: asyncio.Queue = asyncio.Queue()
+        for row in rows:
+            queue.put_nowait(row)
+
+        progress_msg = await interaction.followup.send(f"⏳ Resolving 0/{total} Riot IDs…", ephemeral=True, wait=True)
+
+        async def resolve_one(line_no: int, duid: int, riot_id: str, plat: str):
+            for attempt in range(BULK_IMPORT_MAX_RETRIES + 1):
+                try:
+                    # Backfill lane: interactive /link and /adminlink always go first
+                    puuid, game_name, tag_line = await resolve_puuid_any_cluster(
+                        riot_id, priority=PRIORITY_BACKFILL
+                    )
+                    resolved.append((duid, puuid, f"{game_name}#{tag_line}", plat))
+                    return
+                except (RiotRateLimited, RiotUnavailable) as e:
+                    # Back off the whole worker; other workers hit the same budget
+                    if attempt == BULK_IMPORT_MAX_RETRIES:
+                        errors.append(f"line {line_no}: Riot unavailable or rate limited resolving `{riot_id}`")
+                        return
+                    await asyncio.sleep(e.retry_after or 2 ** attempt)
+                except RiotNotFound:
+                    errors.append(f"line {line_no}: Riot ID `{riot_id}` not found")
+                    return
+                except RiotUnauthorized:
+                    raise
+                except Exception as ex:
+                    errors.append(f"line {line_no}: `{riot_id}` failed: {ex}")
+                    return
+
+        async def worker():
+            nonlocal done
+            while not queue.empty():
+                row = queue.get_nowait()
+                try:
+                    await resolve_one(*row)
+                finally:
+                    done += 1
+
+        async def report_progress():
+            while True:
+                await asyncio.sleep(BULK_IMPORT_PROGRESS_SECONDS)
+                try:
+                    await progress_msg.edit(
+                        content=f"⏳ Resolving {done}/{total} Riot IDs… ({len(errors)} errors so far)"
+                    )
+                except discord.HTTPException:
+                    return  # token expired: the result goes to the channel instead
+
+        async def report(content: str, error_lines: list[str] | None = None) -> None:
+            # A large import outlives the 15-minute interaction token; then the
+            # result is posted in the channel instead
+            def error_file():
+                return discord.File(io.BytesIO("\n".join(error_lines).encode("utf-8")), filename="import_errors.txt")
+
+            try:
+                if error_lines is None:
+                    await progress_msg.edit(content=content)
+                else:
+                    await interaction.followup.send(content, file=error_file(), ephemeral=True)
+                return
+            except discord.HTTPException:
+                pass
+            channel = interaction.channel
+            if channel is None:
+                print(f"[Admin] /adminimport guild {interaction.guild_id}: could not post result (token expired)")
+                return
+            try:
+                await channel.send(
+                    f"{interaction.user.mention} /adminimport: {content}",
+                    files=[error_file()] if error_lines is not None else [],
+                )
+            except discord.HTTPException as e:
+                print(f"[Admin] /adminimport guild {interaction.guild_id}: could not post result: {e}")
+
+        # Sized like the refresh pools: more usable keys, more IDs in flight
+        n_workers = min(total, riot_limits.region_worker_count("europe", BULK_IMPORT_CONCURRENCY))
+        workers = [asyncio.create_task(worker()) for _ in range(n_workers)]
+        reporter = asyncio.create_task(report_progress())
+        try:
+            finished, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            for task in finished:
+                task.result()  # re-raises RiotUnauthorized
+        except RiotUnauthorized:
+            await report(
+                f"❌ Riot API key invalid/expired or missing permissions. Import aborted after {done}/{total} rows."
+            )
+            return
+        finally:
+            # An abort must not leave rows resolving in the background
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            reporter.cancel()
+
+        inserted, skipped = await db.add_riot_accounts_bulk(resolved)
+        guild_cache.invalidate_members(interaction.guild_id)
+
+        summary = (
+            f"✅ Import finished: {total} rows\n"
+            f"- Linked: **{inserted}**\n"
+            f"- Already linked: **{skipped}**\n"
+            f"- Errors: **{len(errors)}**"
+        )
+        await report(summary)
+
+        if errors:
+            await report("⚠️ Rows that were not imported:", errors)
+
     @app_commands.command(name="adminunlink", description="(Admin) Unlink a Riot account from a specific user by account ID.")
     @app_commands.describe(user="Discord user", account_id="The ID shown in /adminaccounts")
     async def adminunlink(self, interaction: discord.Interaction, user: discord.Member, account_id: int):
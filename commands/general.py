@@ -27,7 +27,7 @@ class General(commands.Cog):
                 "**/accounts** — Show your linked accounts\n"
                 "**/unlink** `id` — Remove a linked account\n"
                 "**/myrank** — See your current placement\n"
-                "**/top** `n` — Show top N players (1–50)\n"
+                "**/top** `n` `period` — Browse the board N players per page (1–50), current or previous period\n"
             ),
             inline=False,
         )
@@ -36,12 +36,16 @@ class General(commands.Cog):
             name="🛠️ Admins",
             value=(
                 "**/setleaderboard** — Choose channel + create leaderboard message\n"
-                "**/refreshnow** — Update stats + refresh leaderboard\n"
+                "**/refreshnow** `profile` — Update stats + refresh leaderboard (optionally profiled)\n"
+                "**/profilerefresh** — Profile the next scheduled refresh\n"
                 "**/refreshstatus** — Show current configuration\n"
                 "**/setrefresh** — Set automatic refresh schedule\n"
                 "**/setwindow** — week / month / year window\n"
                 "**/setfrom** — Count from custom date\n"
                 "**/setqueues** — Choose which queues count\n"
+                "**/setstaleness** `hours` — Auto-refresh stale boards on /top, /myrank\n"
+                "**/adminimport** `csv` — Bulk link accounts (user, Riot ID, platform)\n"
+                "**/botstats** — Riot rate-limit, latency + event-loop lag metrics\n"
             ),
             inline=False,
         )
@@ -1,18 +1,25 @@
 # commands/leaderboard_commands.py
 from __future__ import annotations
 
-from datetime import datetime, timezone
-
 import discord
 from discord.ext import commands
 from discord import app_commands
 
 import db
-from utilities.utils_window import compute_window_start_ts, make_window_key
+import guild_cache
+import refresh
 
-MAX_TOP_LIMIT = 50
+MAX_TOP_LIMIT = 50  # rows per page
 MIN_TOP_LIMIT = 1
 
+# Prev/Next stop working after this; Discord interaction tokens last 15 minutes
+TOP_VIEW_TIMEOUT_SECONDS = 10 * 60
+
+PERIODS = [
+    ("Current", "current"),
+    ("Previous", "previous"),
+]
+
 
 def _tier_emoji_for_rank(rank: int) -> str:
     """
@@ -32,42 +39,118 @@ def _medal(rank: int) -> str:
     return {1: "🥇", 2: "🥈", 3: "🥉"}.get(rank, f"**{rank}.**")
 
 
-async def _current_window_key(guild_id: int) -> tuple[str, int, str, str, str]:
+async def _current_window_key(guild_id: int) -> tuple[dict, tuple[str, int, str, str, str]]:
     """
-    Returns: (window_key, window_start_ts, window_mode, tz_name, queue_policy)
+    Returns: (guild_settings, (window_key, window_start_ts, window_mode, tz_name, queue_policy))
     """
     gs = await db.get_guild_settings(guild_id)
+    return gs, refresh.current_window(gs)
 
-    mode = (gs.get("window_mode") or "month").strip().lower()
-    tz_name = gs.get("window_tz") or "Europe/Copenhagen"
-    since_ts = gs.get("window_since_ts")
 
-    queue_policy = (gs.get("queue_policy") or "all").strip().lower()
-
-    start_ts = compute_window_start_ts(
-        now_utc=datetime.now(timezone.utc),
-        mode=mode,
-        tz_name=tz_name,
-        since_ts=since_ts,
-    )
-    window_key = make_window_key(mode, start_ts, tz_name)
-    return window_key, start_ts, mode, tz_name, queue_policy
+def _freshness_line(gs: dict, refreshing: bool) -> str:
+    last_ts = gs.get("last_refresh_ts")
+    line = f"Updated <t:{last_ts}:R>" if last_ts else "Never updated"
+    if refreshing:
+        line += " · 🔄 refreshing in background"
+    return line
 
 
 async def _get_rows_for_guild(guild: discord.Guild, window_key: str) -> list[tuple[str, int]]:
-    member_ids = {str(m.id) for m in guild.members}
-    rows = await db.get_guild_leaderboard_rows(list(member_ids), window_key=window_key)
-    rows = sorted(rows, key=lambda r: r[1], reverse=True)
+    rows = guild_cache.get_board(guild.id, window_key)
+    if rows is not None:
+        return rows
+
+    rows = await db.get_guild_leaderboard_rows(await guild_cache.member_ids(guild), window_key=window_key)
+    # Same order as the leaderboard message: total desc, user id asc
+    rows = sorted(rows, key=lambda r: (-r[1], int(r[0])))
+    guild_cache.set_board(guild.id, window_key, rows)
     return rows
 
 
+def _page_lines(rows: list[tuple[str, int]], page: int, per_page: int) -> list[str]:
+    lines = []
+    start = page * per_page
+    for idx, (duid, games) in enumerate(rows[start:start + per_page], start=start + 1):
+        lines.append(f"{_medal(idx)} {_tier_emoji_for_rank(idx)} <@{duid}> — **{games}**")
+    return lines
+
+
+class TopPagesView(discord.ui.View):
+    """
+    Prev/Next buttons under /top. Every page is cut from `rows`, the ranked board
+    fetched once for the command, so browsing a large board costs no further queries.
+    """
+
+    def __init__(self, rows: list[tuple[str, int]], per_page: int, title: str, header: str):
+        super().__init__(timeout=TOP_VIEW_TIMEOUT_SECONDS)
+        self.rows = rows
+        self.per_page = per_page
+        self.title = title
+        self.header = header
+        self.page = 0
+        self.pages = max(1, -(-len(rows) // per_page))
+        self.message: discord.WebhookMessage | None = None
+        self._sync_buttons()
+
+    def embed(self) -> discord.Embed:
+        # Lines go in the description: a field holds at most 1024 characters
+        lines = _page_lines(self.rows, self.page, self.per_page)
+        embed = discord.Embed(title=self.title, description=self.header + "\n\n" + "\n".join(lines))
+        if self.pages > 1:
+            first = self.page * self.per_page + 1
+            embed.set_footer(
+                text=f"Page {self.page + 1}/{self.pages} · #{first}–#{first + len(lines) - 1} of {len(self.rows)}"
+            )
+        return embed
+
+    def _sync_buttons(self) -> None:
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def _show(self, interaction: discord.Interaction, page: int) -> None:
+        self.page = min(max(page, 0), self.pages - 1)
+        self._sync_buttons()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="◀ Prev", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+    async def on_timeout(self) -> None:
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view=None)
+        except discord.HTTPException:
+            pass
+
+
+async def _send_top_pages(
+    interaction: discord.Interaction,
+    rows: list[tuple[str, int]],
+    per_page: int,
+    title: str,
+    header: str,
+) -> None:
+    view = TopPagesView(rows, per_page, title, header)
+    if view.pages == 1:
+        await interaction.followup.send(embed=view.embed(), ephemeral=True)
+        return
+    view.message = await interaction.followup.send(embed=view.embed(), view=view, ephemeral=True, wait=True)
+
+
 class LeaderboardCommands(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
-    @app_commands.command(name="top", description="Show top N players (default 10).")
-    @app_commands.describe(n="How many to show (1-50)")
-    async def top(self, interaction: discord.Interaction, n: int = 10):
+    @app_commands.command(name="top", description="Show the leaderboard, N players per page (default 10).")
+    @app_commands.describe(n="How many to show per page (1-50)", period="Current window (default) or the one before it")
+    @app_commands.choices(period=[app_commands.Choice(name=n, value=v) for n, v in PERIODS])
+    async def top(self, interaction: discord.Interaction, n: int = 10, period: app_commands.Choice[str] | None = None):
         await interaction.response.defer(ephemeral=True)
 
         if n < MIN_TOP_LIMIT or n > MAX_TOP_LIMIT:
@@ -78,30 +161,71 @@ class LeaderboardCommands(commands.Cog):
             await interaction.followup.send("❌ This command only works in a server.", ephemeral=True)
             return
 
-        window_key, start_ts, mode, tz_name, queue_policy = await _current_window_key(interaction.guild_id)
+        gs, (window_key, start_ts, mode, tz_name, queue_policy) = await _current_window_key(interaction.guild_id)
+
+        if period is not None and period.value == "previous":
+            await self._send_previous_top(interaction, gs, n, mode, tz_name, queue_policy)
+            return
+
         rows = await _get_rows_for_guild(interaction.guild, window_key)
 
+        # Serve what we have now; freshen it in the background if it's old
+        refreshing = refresh.maybe_revalidate(self.bot, interaction.guild, gs)
+
         if not rows:
-            await interaction.followup.send("No data yet. Users must `/link` and an admin must `/refreshnow`.", ephemeral=True)
+            msg = "No data yet. Users must `/link` and an admin must `/refreshnow`."
+            if refreshing:
+                msg = "No data yet — a refresh is running, try again in a few minutes."
+            await interaction.followup.send(msg, ephemeral=True)
             return
 
-        top_rows = rows[:n]
+        await _send_top_pages(
+            interaction,
+            rows,
+            per_page=n,
+            title=f"🏆 Top {min(n, len(rows))}" if len(rows) <= n else "🏆 Leaderboard",
+            header=(
+                f"Window: `{mode}` | Start: <t:{start_ts}:d> | TZ: `{tz_name}`\n"
+                f"Queues: `{queue_policy}`\n"
+                f"{_freshness_line(gs, refreshing)}"
+            ),
+        )
 
-        lines = []
-        for idx, (duid, games) in enumerate(top_rows, start=1):
-            tier = _tier_emoji_for_rank(idx)
-            lines.append(f"{_medal(idx)} {tier} <@{duid}> — **{games}**")
+    async def _send_previous_top(
+        self,
+        interaction: discord.Interaction,
+        gs: dict,
+        n: int,
+        mode: str,
+        tz_name: str,
+        queue_policy: str,
+    ):
+        prev = refresh.previous_window(gs)
+        if prev is None:
+            await interaction.followup.send("❌ A `since_date` window has no previous period.", ephemeral=True)
+            return
+        window_key, start_ts, end_ts = prev
 
-        embed = discord.Embed(
-            title=f"🏆 Top {n}",
-            description=(
-                f"Window: `{mode}` | Start: <t:{start_ts}:d> | TZ: `{tz_name}`\n"
+        # Serves what is stored; the closed window is counted once more in the
+        # background and final from then on
+        final = refresh.maybe_finalize(interaction.guild, gs)
+
+        rows = await _get_rows_for_guild(interaction.guild, window_key)
+        if not rows:
+            await interaction.followup.send("No data for the previous period.", ephemeral=True)
+            return
+
+        await _send_top_pages(
+            interaction,
+            rows,
+            per_page=n,
+            title=f"🏆 Top {min(n, len(rows))} — previous period" if len(rows) <= n else "🏆 Leaderboard — previous period",
+            header=(
+                f"Window: `{mode}` | <t:{start_ts}:d> – <t:{end_ts}:d> | TZ: `{tz_name}`\n"
                 f"Queues: `{queue_policy}`"
+                + ("" if final else "\n⏳ Provisional: final counts are still being made")
             ),
         )
-        embed.add_field(name="Leaderboard", value="\n".join(lines), inline=False)
-
-        await interaction.followup.send(embed=embed, ephemeral=True)
 
     @app_commands.command(name="myrank", description="Show your current placement on the leaderboard.")
     async def myrank(self, interaction: discord.Interaction):
@@ -111,11 +235,16 @@ class LeaderboardCommands(commands.Cog):
             await interaction.followup.send("❌ This command only works in a server.", ephemeral=True)
             return
 
-        window_key, start_ts, mode, tz_name, queue_policy = await _current_window_key(interaction.guild_id)
+        gs, (window_key, start_ts, mode, tz_name, queue_policy) = await _current_window_key(interaction.guild_id)
         rows = await _get_rows_for_guild(interaction.guild, window_key)
 
+        refreshing = refresh.maybe_revalidate(self.bot, interaction.guild, gs)
+
         if not rows:
-            await interaction.followup.send("No data yet. Users must `/link` and an admin must `/refreshnow`.", ephemeral=True)
+            msg = "No data yet. Users must `/link` and an admin must `/refreshnow`."
+            if refreshing:
+                msg = "No data yet — a refresh is running, try again in a few minutes."
+            await interaction.followup.send(msg, ephemeral=True)
             return
 
         my_id = str(interaction.user.id)
@@ -144,7 +273,8 @@ class LeaderboardCommands(commands.Cog):
                 f"You are **#{rank}** {tier}\n"
                 f"Games: **{games}**\n\n"
                 f"Window: `{mode}` | Start: <t:{start_ts}:d> | TZ: `{tz_name}`\n"
-                f"Queues: `{queue_policy}`"
+                f"Queues: `{queue_policy}`\n"
+                f"{_freshness_line(gs, refreshing)}"
             ),
         )
 
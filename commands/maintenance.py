@@ -0,0 +1,70 @@
+# commands/maintenance.py
+import asyncio
+import time
+
+from discord.ext import commands
+
+import retention
+import shards
+import trickle
+import window_service
+
+
+class Maintenance(commands.Cog):
+    RETENTION_INTERVAL_SECONDS = 24 * 60 * 60
+    # Let startup (cache fill, first refreshes) settle before the first pass
+    RETENTION_FIRST_DELAY_SECONDS = 10 * 60
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self._task: asyncio.Task | None = None
+        self._trickle_task: asyncio.Task | None = None
+        self._rollover_task: asyncio.Task | None = None
+
+    async def cog_load(self):
+        # With several shard processes on one DB only the owner of shard 0 prunes
+        owned = shards.owned_shard_ids()
+        if owned is None or 0 in owned:
+            self._task = asyncio.create_task(self._retention_loop())
+            self._rollover_task = asyncio.create_task(self._rollover_loop())
+            if trickle.TRICKLE_REFRESH:
+                self._trickle_task = asyncio.create_task(self._trickle_loop())
+
+    def cog_unload(self):
+        for task in (self._task, self._trickle_task, self._rollover_task):
+            if task is not None:
+                task.cancel()
+
+    async def _trickle_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await trickle.run_forever()
+            except Exception as e:
+                print(f"[Trickle] loop crashed, restarting in 60s: {e}")
+                await asyncio.sleep(60)
+
+    async def _rollover_loop(self):
+        # Seeds whatever window is current at startup, then each new one as it starts
+        while True:
+            try:
+                next_ts = await window_service.seed_rollovers()
+            except Exception as e:
+                print(f"[Windows] rollover seeding failed: {e}")
+                next_ts = time.time() + window_service.ROLLOVER_CHECK_SECONDS
+            # A second past the boundary so the new window is the current one
+            await asyncio.sleep(max(1.0, next_ts - time.time() + 1))
+
+    async def _retention_loop(self):
+        await asyncio.sleep(self.RETENTION_FIRST_DELAY_SECONDS)
+        while True:
+            try:
+                result = await retention.run_retention()
+                print(f"[Retention] {result}")
+            except Exception as e:
+                print(f"[Retention] pass failed: {e}")
+            await asyncio.sleep(self.RETENTION_INTERVAL_SECONDS)
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Maintenance(bot))
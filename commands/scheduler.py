@@ -1,21 +1,52 @@
 # commands/scheduler.py
+import asyncio
+import heapq
 import time
 from datetime import datetime, timezone
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 import db
-from leaderboard import refresh_leaderboard_for_guild
+import shards
+from leaderboard import BoardState, refresh_leaderboard_for_guild
 from stats_update import update_stats_for_guild
 from utilities.utils_schedule import compute_next_refresh_ts
-from utilities.utils_window import compute_window_start_ts, make_window_key
+import metrics
+import profiling
+import refresh
+import riot_limits
+import window_service
+
+# Requests assumed for a guild with no refresh history yet
+DEFAULT_REFRESH_REQUESTS = 200
+# Estimates are padded by this factor so pre-warms finish before, not at, the deadline
+PREWARM_SAFETY_FACTOR = 1.25
+
+
+def _plan_prewarm_starts(
+    jobs: list[tuple[int, int, float]],
+    rate: float,
+    max_lead: float,
+) -> dict[int, float]:
+    """
+    jobs: (guild_id, deadline_ts, estimated_requests). Returns guild_id -> start_ts.
 
-# Riot API key (safe import so bot doesn't crash if missing)
-try:
-    from key import RIOT_API_KEY
-except Exception:
-    RIOT_API_KEY = None
+    All guilds share one Riot budget, so the work is laid out back to back,
+    latest deadline first: each guild finishes at its deadline or when the
+    next one starts, whichever is earlier. Guilds due at the same time are
+    spread over the preceding hours instead of all starting at once. No start
+    is earlier than max_lead before its own deadline.
+    """
+    starts: dict[int, float] = {}
+    cursor = float("inf")
+    for guild_id, deadline, requests in sorted(jobs, key=lambda j: (j[1], j[0]), reverse=True):
+        cost = requests / rate * PREWARM_SAFETY_FACTOR
+        end = min(deadline, cursor)
+        start = max(end - cost, deadline - max_lead)
+        starts[guild_id] = start
+        cursor = start
+    return starts
 
 
 def _shame_line(name: str, gained: int) -> str:
@@ -30,17 +61,13 @@ def _shame_line(name: str, gained: int) -> str:
     return f"🧊 **{name}** gained **0**. Chill week."
 
 
-async def _post_weekly_announcement(
-    bot: discord.Client,
-    guild: discord.Guild,
-    guild_id: int,
-    window_key: str,
-) -> None:
+async def _post_weekly_announcement(state: BoardState) -> None:
     """
     Posts a fun 'weekly shame' announcement in the leaderboard channel.
     Uses snapshot delta: (current games_played - previous snapshot games_played).
+    Runs as a leaderboard pipeline stage, before the snapshot is overwritten.
     """
-    gs = await db.get_guild_settings(guild_id)
+    gs, guild = state.gs, state.guild
     channel_id = gs.get("leaderboard_channel_id")
     if not channel_id:
         return
@@ -49,16 +76,12 @@ async def _post_weekly_announcement(
     if channel is None or not isinstance(channel, (discord.TextChannel, discord.Thread)):
         return
 
-    # Current totals (top 3)
-    member_ids = [str(m.id) for m in guild.members]
-    rows = await db.get_guild_leaderboard_rows(member_ids, window_key)  # [(duid, total)]
+    # Current totals (top 3), already in stable order
+    rows = state.rows[:3]
     if not rows:
         return
 
-    # stable ordering: total desc, user id asc
-    rows = sorted(rows, key=lambda r: (-r[1], int(r[0])))[:3]
-
-    prev = await db.get_snapshot_map(guild_id, window_key)  # {duid: (rank, games)}
+    prev = state.prev  # {duid: (rank, games)}
 
     lines: list[str] = []
     for duid, total in rows:
@@ -81,108 +104,285 @@ async def _post_weekly_announcement(
 
 
 class Scheduler(commands.Cog):
+    """
+    Runs each guild's refresh at its next_refresh_ts.
+
+    Due times live in an in-memory min-heap, rebuilt from guild_settings at
+    startup. The loop sleeps until the earliest deadline (or until schedule()
+    changes something), so an idle bot does no DB work at all.
+    """
+
+    # Upper bound for one sleep, so clock jumps can't delay a refresh for days
+    MAX_SLEEP_SECONDS = 60 * 60
+
+    # Pre-warming: stats for a due guild are counted ahead of its deadline so the
+    # post goes out on time. Never earlier than PREWARM_MAX_LEAD_SECONDS before it.
+    # At the deadline only accounts the pre-warm did not store are counted again.
+    PREWARM_MAX_LEAD_SECONDS = 6 * 60 * 60
+    PLAN_INTERVAL_SECONDS = 10 * 60
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.refresh_loop.start()
+        self._heap: list[tuple[int, int]] = []  # (next_refresh_ts, guild_id)
+        self._due: dict[int, int] = {}  # guild_id -> current next_refresh_ts; heap entries that disagree are stale
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._plan_task: asyncio.Task | None = None
+        # guild_id -> (deadline_ts, pre-warm task); the task returns its start time
+        self._prewarm: dict[int, tuple[int, asyncio.Task]] = {}
+
+    async def cog_load(self):
+        self._task = asyncio.create_task(self._run())
+        self._plan_task = asyncio.create_task(self._plan_loop())
 
     def cog_unload(self):
-        self.refresh_loop.cancel()
+        for task in (self._task, self._plan_task):
+            if task is not None:
+                task.cancel()
+        for _, task in self._prewarm.values():
+            task.cancel()
+
+    def schedule(self, guild_id: int, next_ts: int | None) -> None:
+        """
+        Sets (or clears, with None) a guild's next refresh time and wakes the loop.
+        Guilds on shards owned by another process are ignored.
+        """
+        if not shards.owns_guild(guild_id):
+            return
+        if next_ts is None:
+            self._due.pop(guild_id, None)
+        else:
+            self._due[guild_id] = int(next_ts)
+            heapq.heappush(self._heap, (int(next_ts), guild_id))
+        self._wakeup.set()
+
+    async def _load_schedule(self) -> None:
+        self._heap.clear()
+        self._due.clear()
+        for guild_id, next_ts in await db.list_guild_schedule(shards.SHARD_COUNT, shards.owned_shard_ids()):
+            self._due[guild_id] = next_ts
+            self._heap.append((next_ts, guild_id))
+        heapq.heapify(self._heap)
+        print(f"[Scheduler] Loaded {len(self._heap)} scheduled guilds")
+
+    def _pop_due(self, now_ts: int) -> list[int]:
+        due: list[int] = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            ts, guild_id = heapq.heappop(self._heap)
+            if self._due.get(guild_id) == ts:
+                del self._due[guild_id]
+                due.append(guild_id)
+        return due
+
+    def _seconds_until_next(self, now: float) -> float | None:
+        # Drop stale heap heads so we don't wake for rescheduled guilds
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - now)
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        await self._load_schedule()
+
+        while True:
+            self._wakeup.clear()
+            wait = self._seconds_until_next(time.time())
+
+            if wait is None or wait > 0:
+                timeout = self.MAX_SLEEP_SECONDS if wait is None else min(wait, self.MAX_SLEEP_SECONDS)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-    @tasks.loop(seconds=60)
-    async def refresh_loop(self):
+            for guild_id in self._pop_due(int(time.time())):
+                try:
+                    await self._refresh_guild(guild_id)
+                except Exception as e:
+                    print(f"[Scheduler] Guild {guild_id}: unexpected scheduler error: {e}")
+
+    async def _plan_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                wait = await self._plan_prewarms(time.time())
+            except Exception as e:
+                print(f"[Scheduler] pre-warm planning failed: {e}")
+                wait = self.PLAN_INTERVAL_SECONDS
+            await asyncio.sleep(max(1.0, min(wait, self.PLAN_INTERVAL_SECONDS)))
+
+    async def _plan_prewarms(self, now: float) -> float:
+        """
+        Starts the pre-warms whose planned start has come. Returns seconds until
+        the next planned start.
+        """
+        if not riot_limits.has_keys():
+            return self.PLAN_INTERVAL_SECONDS
+
+        horizon = now + self.PREWARM_MAX_LEAD_SECONDS
+        pending = [
+            (guild_id, deadline)
+            for guild_id, deadline in self._due.items()
+            if now < deadline <= horizon and self._prewarm.get(guild_id, (None,))[0] != deadline
+        ]
+        if not pending:
+            return self.PLAN_INTERVAL_SECONDS
+
+        estimates = await db.get_refresh_estimates([g for g, _ in pending])
+        jobs = [(g, d, estimates.get(g, DEFAULT_REFRESH_REQUESTS)) for g, d in pending]
+        starts = _plan_prewarm_starts(jobs, riot_limits.sustained_rate(), self.PREWARM_MAX_LEAD_SECONDS)
+
+        next_start = float("inf")
+        for guild_id, deadline in pending:
+            start = starts[guild_id]
+            if start > now:
+                next_start = min(next_start, start)
+                continue
+            task = asyncio.create_task(self._prewarm_guild(guild_id, deadline))
+            self._prewarm[guild_id] = (deadline, task)
+            print(f"[Scheduler] Guild {guild_id}: pre-warm started {deadline - now:.0f}s before deadline")
+
+        return next_start - now
+
+    async def _prewarm_guild(self, guild_id: int, deadline: int) -> int | None:
+        """
+        Counts the stats the deadline refresh will post, through refresh.start_refresh
+        so it shares a run with /refreshnow or a background refresh. Returns when
+        the counting started, or None when there was nothing to pre-warm.
+        """
+        guild = self.bot.get_guild(guild_id)
+        g = await db.get_guild_settings(guild_id)
+        if guild is None or not g:
+            return None
+
+        # The window as of the deadline; if it has not started yet there is nothing to count
+        _, window_start_ts, _, _, _ = window_service.window_for_settings(
+            g, datetime.fromtimestamp(deadline, timezone.utc)
+        )
+        started = int(time.time())
+        if window_start_ts >= started:
+            return None
+
+        # Shielded: dropping this pre-warm must not cancel a run someone else joined
+        result = await asyncio.shield(refresh.start_refresh(self.bot, guild, render=False))
+        print(f"[Scheduler] Guild {guild_id}: pre-warm done, {result.summary()}")
+        return started
+
+    async def _take_prewarm(self, guild_id: int, deadline: int) -> int | None:
+        """
+        Waits for the guild's pre-warm for this deadline, if any. Returns when it
+        started counting, if it ran inside this deadline's plan horizon.
+        """
+        entry = self._prewarm.pop(guild_id, None)
+        if entry is None or entry[0] != deadline:
+            if entry is not None:
+                entry[1].cancel()
+            return None
+
+        try:
+            started = await entry[1]
+        except Exception as e:
+            print(f"[Scheduler] Guild {guild_id}: pre-warm failed: {e}")
+            return None
+        if started is None or started < deadline - self.PREWARM_MAX_LEAD_SECONDS:
+            return None
+        return started
+
+    async def _refresh_guild(self, guild_id: int):
+        if not profiling.take_armed(guild_id):
+            await self._run_guild_refresh(guild_id)
+            return
+
+        # Armed by /profilerefresh: record this one run
+        with profiling.session(f"scheduled-{guild_id}") as prof:
+            try:
+                await self._run_guild_refresh(guild_id)
+            finally:
+                path = prof.write()
+                print(f"[Scheduler] Guild {guild_id}: profile written to {path}\n{prof.summary()}")
+
+    async def _run_guild_refresh(self, guild_id: int):
         now_ts = int(time.time())
 
-        guild_rows = await db.list_guild_refresh_due(now_ts)
-        if not guild_rows:
+        g = await db.get_guild_settings(guild_id)
+        if not g or g.get("next_refresh_ts") is None:
+            return
+        if int(g["next_refresh_ts"]) > now_ts:
+            # Already handled and rescheduled (e.g. by a previous owner of this shard)
+            self.schedule(guild_id, int(g["next_refresh_ts"]))
             return
 
-        for g in guild_rows:
-            guild_id = int(g["guild_id"])
-            guild = self.bot.get_guild(guild_id)
-            if guild is None:
-                continue  # bot left guild
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return  # bot left guild
+
+        # Always reschedule next refresh even if we bail early
+        async def _schedule_next():
+            next_ts = compute_next_refresh_ts(
+                now_utc=datetime.now(timezone.utc),
+                weekday=g["refresh_weekday"],
+                hour=g["refresh_hour"],
+                minute=g["refresh_minute"],
+                tz_name=g["refresh_tz"],
+            )
+            await db.set_next_refresh_ts(guild_id, next_ts)
+            self.schedule(guild_id, next_ts)
+            return next_ts
+
+        try:
+            if not riot_limits.has_keys():
+                print(f"[Scheduler] Guild {guild_id}: no Riot API keys — skipping stats update")
+                next_ts = await _schedule_next()
+                print(f"[Scheduler] Guild {guild_id}: next_refresh_ts={next_ts}")
+                return
 
-            try:
-                # Always reschedule next refresh even if we bail early
-                async def _schedule_next():
-                    next_ts = compute_next_refresh_ts(
-                        now_utc=datetime.now(timezone.utc),
-                        weekday=g["refresh_weekday"],
-                        hour=g["refresh_hour"],
-                        minute=g["refresh_minute"],
-                        tz_name=g["refresh_tz"],
-                    )
-                    await db.set_next_refresh_ts(guild_id, next_ts)
-                    return next_ts
-
-                if not RIOT_API_KEY:
-                    print(f"[Scheduler] Guild {guild_id}: RIOT_API_KEY missing — skipping stats update")
-                    next_ts = await _schedule_next()
-                    print(f"[Scheduler] Guild {guild_id}: next_refresh_ts={next_ts}")
-                    continue
-
-                mode = (g.get("window_mode") or "month").strip().lower()
-                tz_name = g.get("window_tz") or "Europe/Copenhagen"
-                since_ts = g.get("window_since_ts")
-                queue_policy = (g.get("queue_policy") or "all").strip().lower()
-
-                window_start_ts = compute_window_start_ts(
-                    now_utc=datetime.now(timezone.utc),
-                    mode=mode,
-                    tz_name=tz_name,
-                    since_ts=since_ts,
-                )
-                window_key = make_window_key(mode, window_start_ts, tz_name)
+            window_key, window_start_ts, mode, _, queue_policy = window_service.window_for_settings(g)
 
-                # 1) Update Riot stats
-                updated_accounts = await update_stats_for_guild(
+            # 1) Update Riot stats; after a pre-warm, only accounts it did not store
+            deadline = int(g["next_refresh_ts"])
+            prewarm_started = await self._take_prewarm(guild_id, deadline)
+            with profiling.span("stats"):
+                result = await update_stats_for_guild(
                     guild=guild,
-                    riot_api_key=RIOT_API_KEY,
                     window_key=window_key,
                     window_start_ts=window_start_ts,
                     queue_policy=queue_policy,
                     max_concurrency=2,
+                    fresh_since=prewarm_started,
                 )
+            stats_note = result.summary() if prewarm_started is None else f"pre-warmed, then {result.summary()}"
 
-                # 2) Optional announcement FIRST (uses previous snapshot)
-                # If you only want it on weekly windows, uncomment this:
-                # if mode == "week":
-                await _post_weekly_announcement(self.bot, guild, guild_id, window_key)
+            # 2) One board load for announcement, embed and snapshot rows.
+            # The announcement stage runs first and diffs against the previous snapshot.
+            # If you only want it on weekly windows, pass stages only when mode == "week".
+            await refresh_leaderboard_for_guild(
+                self.bot, guild_id, window_key, stages=[_post_weekly_announcement]
+            )
+            metrics.observe("scheduler.post_delay", time.time() - deadline)
 
-                # 3) Refresh leaderboard embed (this writes snapshot rows)
-                await refresh_leaderboard_for_guild(self.bot, guild_id, window_key)
+            # 3) Mark last refresh
+            await db.set_last_refresh_ts(guild_id, now_ts)
 
-                # 4) Mark last refresh
-                await db.set_last_refresh_ts(guild_id, now_ts)
+            # 4) Schedule next refresh
+            next_ts = await _schedule_next()
 
-                # 5) Schedule next refresh
-                next_ts = await _schedule_next()
+            print(
+                f"[Scheduler] Guild {guild_id}: {stats_note} "
+                f"queue_policy={queue_policy} mode={mode} "
+                f"window_start_ts={window_start_ts} next_refresh_ts={next_ts}"
+            )
 
-                print(
-                    f"[Scheduler] Guild {guild_id}: updated={updated_accounts} "
-                    f"queue_policy={queue_policy} mode={mode} "
-                    f"window_start_ts={window_start_ts} next_refresh_ts={next_ts}"
-                )
+        except Exception as e:
+            print(f"[Scheduler] Guild {guild_id}: refresh failed: {e}")
 
-            except Exception as e:
-                print(f"[Scheduler] Guild {guild_id}: refresh failed: {e}")
-
-                # Even on failure, schedule next refresh so it doesn't retry every minute forever
-                try:
-                    next_ts = compute_next_refresh_ts(
-                        now_utc=datetime.now(timezone.utc),
-                        weekday=g["refresh_weekday"],
-                        hour=g["refresh_hour"],
-                        minute=g["refresh_minute"],
-                        tz_name=g["refresh_tz"],
-                    )
-                    await db.set_next_refresh_ts(guild_id, next_ts)
-                except Exception:
-                    pass
-
-    @refresh_loop.before_loop
-    async def before_refresh_loop(self):
-        await self.bot.wait_until_ready()
+            # Even on failure, schedule next refresh so it doesn't retry every minute forever
+            try:
+                await _schedule_next()
+            except Exception:
+                pass
 
 
 async def setup(bot: commands.Bot):
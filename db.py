@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 import time
 from pathlib import Path
 from typing import Iterable, List, Tuple, Optional
@@ -15,22 +16,196 @@ SCHEMA_PATH = DB_DIR / "schema.sql"
 def _now_ts() -> int:
     return int(time.time())
 
+
+async def _add_missing_columns(db: aiosqlite.Connection, table: str, columns: list[tuple[str, str]]) -> None:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    existing = {r[1] for r in await cur.fetchall()}
+    for column, decl in columns:
+        if column not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# ---------- schema migrations ----------
+# schema.sql is always the full, current schema and is used as-is for a fresh DB.
+# Existing DBs are brought up to date by running every migration newer than the
+# version recorded in schema_version. Add new changes to BOTH places.
+
+async def _migration_1(db: aiosqlite.Connection) -> None:
+    # Baseline for DBs created before versioning: add any missing tables/indexes
+    # (schema.sql is all IF NOT EXISTS) and columns added since their creation.
+    await db.executescript(SCHEMA_PATH.read_text(encoding="utf-8"))
+    await _add_missing_columns(db, "guild_settings", [("stale_after_seconds", "INTEGER")])
+
+
+async def _migration_2(db: aiosqlite.Connection) -> None:
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS window_archive (
+          guild_id TEXT NOT NULL,
+          window_key TEXT NOT NULL,
+          players INTEGER NOT NULL,
+          total_games INTEGER NOT NULL,
+          top_json TEXT NOT NULL,
+          archived_at INTEGER NOT NULL,
+          PRIMARY KEY (guild_id, window_key)
+        )
+        """
+    )
+    await db.commit()
+    # auto_vacuum only changes on an existing DB after a full VACUUM (one-off)
+    cur = await db.execute("PRAGMA auto_vacuum")
+    if (await cur.fetchone())[0] != 2:
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("VACUUM")
+
+
+async def _migration_3(db: aiosqlite.Connection) -> None:
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS match_slice_counts (
+          puuid TEXT NOT NULL,
+          queue_class TEXT NOT NULL,
+          start_ts INTEGER NOT NULL,
+          end_ts INTEGER NOT NULL,
+          count INTEGER NOT NULL,
+          PRIMARY KEY (puuid, queue_class, start_ts, end_ts)
+        ) WITHOUT ROWID
+        """
+    )
+    await _add_missing_columns(db, "account_stats", [("final", "INTEGER NOT NULL DEFAULT 0")])
+
+
+async def _migration_4(db: aiosqlite.Connection) -> None:
+    await _add_missing_columns(db, "refresh_jobs", [("result_json", "TEXT")])
+
+
+async def _migration_5(db: aiosqlite.Connection) -> None:
+    await _add_missing_columns(db, "guild_settings", [("est_refresh_requests", "REAL")])
+
+
+async def _migration_6(db: aiosqlite.Connection) -> None:
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS account_activity (
+          account_id INTEGER PRIMARY KEY,
+          last_new_match_ts INTEGER,
+          games_per_day REAL NOT NULL DEFAULT 0,
+          first_seen_ts INTEGER NOT NULL,
+          FOREIGN KEY (account_id)
+            REFERENCES riot_accounts(id)
+            ON DELETE CASCADE
+        )
+        """
+    )
+
+
+async def _migration_7(db: aiosqlite.Connection) -> None:
+    # Per-day histogram rows become one-day blocks
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS account_game_blocks (
+          account_id INTEGER NOT NULL,
+          queue_class TEXT NOT NULL,
+          first_day INTEGER NOT NULL,
+          last_day INTEGER NOT NULL,
+          games INTEGER NOT NULL,
+          PRIMARY KEY (account_id, queue_class, first_day),
+          FOREIGN KEY (account_id)
+            REFERENCES riot_accounts(id)
+            ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """
+    )
+    cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='account_game_days'")
+    if await cur.fetchone() is None:
+        return
+    await db.execute(
+        """
+        INSERT OR IGNORE INTO account_game_blocks(account_id, queue_class, first_day, last_day, games)
+        SELECT account_id, queue_class, day, day, games FROM account_game_days
+        """
+    )
+    await db.execute("DROP TABLE account_game_days")
+
+
+async def _migration_8(db: aiosqlite.Connection) -> None:
+    await _add_missing_columns(
+        db,
+        "refresh_jobs",
+        [
+            ("done_accounts", "INTEGER NOT NULL DEFAULT 0"),
+            ("requests", "INTEGER NOT NULL DEFAULT 0"),
+            ("cancel_requested", "INTEGER NOT NULL DEFAULT 0"),
+        ],
+    )
+
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
 #Ensures db exists, if not create the db
 async def init_db() -> None:
     """
-    Ensures db folder exists, creates DB file if missing, and applies schema.sql.
-    Safe to call on every startup.
+    Ensures db folder exists, creates DB file if missing, and brings the schema
+    to SCHEMA_VERSION. Call once at process start; a DB that is already current
+    costs a single query.
     """
     DB_DIR.mkdir(parents=True, exist_ok=True)
     #if schema paths does not exist, insert the schemas from schema.sql
     if not SCHEMA_PATH.exists():
         raise FileNotFoundError(f"Missing schema file: {SCHEMA_PATH}")
 
-    schema_sql = SCHEMA_PATH.read_text(encoding="utf-8")
-
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(schema_sql)
-        await db.commit()
+        # Only takes effect on a DB with no tables yet, so it has to come first
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL, applied_at INTEGER NOT NULL)"
+        )
+        cur = await db.execute("SELECT MAX(version) FROM schema_version")
+        current = (await cur.fetchone())[0]
+
+        if current is None:
+            cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='riot_accounts'")
+            if await cur.fetchone() is None:
+                # Fresh DB: schema.sql already is the latest version
+                await db.executescript(SCHEMA_PATH.read_text(encoding="utf-8"))
+                await db.execute("INSERT INTO schema_version(version, applied_at) VALUES(?, ?)", (SCHEMA_VERSION, _now_ts()))
+                await db.commit()
+                print(f"[DB] Created schema v{SCHEMA_VERSION}")
+                return
+            current = 0
+
+        for version, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            await migrate(db)
+            await db.execute("INSERT INTO schema_version(version, applied_at) VALUES(?, ?)", (version, _now_ts()))
+            await db.commit()
+            print(f"[DB] Applied migration v{version}")
+
+async def get_meta(key: str) -> str | None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute("SELECT value FROM bot_meta WHERE key = ?", (key,))
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+
+async def set_meta(key: str, value: str) -> None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            "INSERT INTO bot_meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, value),
+        )
+        await conn.commit()
 
 #Insertion of users function
 async def upsert_user(discord_user_id: int) -> None:
@@ -72,6 +247,40 @@ async def add_riot_account(
         # Most likely: puuid already linked (UNIQUE)
         return False
 
+#Bulk link riot accounts (admin import)
+async def add_riot_accounts_bulk(
+    rows: Iterable[Tuple[int, str, Optional[str], Optional[str]]],
+) -> Tuple[int, int]:
+    """
+    Links many Riot accounts in a single transaction.
+    rows: (discord_user_id, puuid, riot_id, platform)
+    Returns (inserted, skipped) where skipped rows were already linked (UNIQUE puuid).
+    """
+    rows = list(rows)
+    if not rows:
+        return 0, 0
+
+    now = _now_ts()
+    inserted = 0
+
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO users(discord_user_id, created_at) VALUES(?, ?)",
+            [(str(duid), now) for duid in {r[0] for r in rows}],
+        )
+        for discord_user_id, puuid, riot_id, platform in rows:
+            cur = await db.execute(
+                """
+                INSERT OR IGNORE INTO riot_accounts(discord_user_id, puuid, riot_id, platform, added_at)
+                VALUES(?, ?, ?, ?, ?)
+                """,
+                (str(discord_user_id), puuid, riot_id, platform, now),
+            )
+            inserted += cur.rowcount
+        await db.commit()
+
+    return inserted, len(rows) - inserted
+
 #Collect riot account data and display it
 async def list_riot_accounts(discord_user_id: int) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
     """
@@ -213,6 +422,32 @@ async def list_guild_refresh_due(now_ts: int) -> list[dict]:
         rows = await cur.fetchall()
         return [dict(r) for r in rows]
 
+async def list_guild_schedule(
+    shard_count: int | None = None,
+    shard_ids: list[int] | None = None,
+) -> list[tuple[int, int]]:
+    """
+    Returns [(guild_id, next_refresh_ts)] for every scheduled guild, soonest first.
+    With shard_count + shard_ids only guilds on those shards are returned.
+    Served from idx_guild_settings_next_refresh.
+    """
+    sql = """
+    SELECT guild_id, next_refresh_ts
+    FROM guild_settings
+    WHERE next_refresh_ts IS NOT NULL
+    """
+    params: list[int] = []
+    if shard_count and shard_ids is not None:
+        placeholders = ",".join("?" for _ in shard_ids) or "NULL"
+        sql += f" AND ((CAST(guild_id AS INTEGER) >> 22) % ?) IN ({placeholders})"
+        params = [shard_count, *shard_ids]
+    sql += " ORDER BY next_refresh_ts"
+
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(sql, params)
+        rows = await cur.fetchall()
+        return [(int(r[0]), int(r[1])) for r in rows]
+
 async def get_guild_leaderboard_rows(guild_member_ids: list[str], window_key: str) -> list[tuple[str, int]]:
     if not guild_member_ids:
         return []
@@ -238,21 +473,313 @@ async def get_guild_leaderboard_rows(guild_member_ids: list[str], window_key: st
 
     
     
-async def upsert_account_stats(account_id: int, window_key: str, games_played: int) -> None:
+async def upsert_account_stats(account_id: int, window_key: str, games_played: int, final: bool = False) -> None:
     async with aiosqlite.connect(DB_PATH) as conn:
         await conn.execute(
             """
-            INSERT INTO account_stats(account_id, window_key, games_played, last_updated)
-            VALUES(?, ?, ?, ?)
+            INSERT INTO account_stats(account_id, window_key, games_played, last_updated, final)
+            VALUES(?, ?, ?, ?, ?)
             ON CONFLICT(account_id, window_key) DO UPDATE SET
                 games_played=excluded.games_played,
-                last_updated=excluded.last_updated
+                last_updated=excluded.last_updated,
+                final=excluded.final
+            """,
+            (account_id, window_key, games_played, int(time.time()), 1 if final else 0),
+        )
+        await conn.commit()
+
+
+async def seed_window_stats(window_key: str, from_window_key: str, seed_ts: int) -> int:
+    """
+    Gives every account with a row in from_window_key a 0-game row in window_key,
+    last updated at seed_ts (the window start). Existing rows are kept.
+    Returns how many rows were added.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            INSERT OR IGNORE INTO account_stats(account_id, window_key, games_played, last_updated, final)
+            SELECT account_id, ?, 0, ?, 0
+            FROM account_stats
+            WHERE window_key = ?
+            """,
+            (window_key, seed_ts, from_window_key),
+        )
+        await conn.commit()
+        return cur.rowcount
+
+
+async def list_final_account_ids(window_key: str, account_ids: list[int]) -> set[int]:
+    """
+    The subset of account_ids whose count for window_key is final (window closed).
+    """
+    if not account_ids:
+        return set()
+
+    placeholders = ",".join("?" for _ in account_ids)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            f"SELECT account_id FROM account_stats WHERE window_key = ? AND final = 1 AND account_id IN ({placeholders})",
+            [window_key, *account_ids],
+        )
+        rows = await cur.fetchall()
+        return {int(r[0]) for r in rows}
+
+
+async def get_account_stats_rows(window_key: str, account_ids: list[int]) -> dict[int, tuple[int, int]]:
+    """
+    account_id -> (games_played, last_updated) for the accounts that have a row for window_key.
+    """
+    if not account_ids:
+        return {}
+
+    placeholders = ",".join("?" for _ in account_ids)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            f"""
+            SELECT account_id, games_played, last_updated FROM account_stats
+            WHERE window_key = ? AND account_id IN ({placeholders})
             """,
-            (account_id, window_key, games_played, int(time.time())),
+            [window_key, *account_ids],
+        )
+        rows = await cur.fetchall()
+        return {int(r[0]): (int(r[1]), int(r[2])) for r in rows}
+
+
+async def get_account_activity(account_ids: list[int]) -> dict[int, dict]:
+    if not account_ids:
+        return {}
+
+    placeholders = ",".join("?" for _ in account_ids)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        cur = await conn.execute(
+            f"SELECT * FROM account_activity WHERE account_id IN ({placeholders})",
+            list(account_ids),
+        )
+        rows = await cur.fetchall()
+        return {int(r["account_id"]): dict(r) for r in rows}
+
+
+async def upsert_account_activity(
+    account_id: int,
+    last_new_match_ts: int | None,
+    games_per_day: float,
+    first_seen_ts: int,
+) -> None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            """
+            INSERT INTO account_activity(account_id, last_new_match_ts, games_per_day, first_seen_ts)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(account_id) DO UPDATE SET
+                last_new_match_ts=excluded.last_new_match_ts,
+                games_per_day=excluded.games_per_day
+            """,
+            (account_id, last_new_match_ts, games_per_day, first_seen_ts),
         )
         await conn.commit()
 
 
+async def list_fresh_account_ids(
+    window_key: str,
+    account_ids: list[int],
+    since_ts: int,
+    window_start_ts: int,
+) -> set[int]:
+    """
+    The subset of account_ids whose count for window_key was updated at or after since_ts.
+    Rows last updated at window_start_ts are rollover seeds (seed_window_stats),
+    never counted against Riot, so they are not fresh.
+    """
+    if not account_ids:
+        return set()
+
+    placeholders = ",".join("?" for _ in account_ids)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            f"""
+            SELECT account_id FROM account_stats
+            WHERE window_key = ? AND last_updated >= ? AND last_updated != ?
+              AND account_id IN ({placeholders})
+            """,
+            [window_key, since_ts, window_start_ts, *account_ids],
+        )
+        rows = await cur.fetchall()
+        return {int(r[0]) for r in rows}
+
+
+async def list_accounts_after(after_id: int, limit: int) -> list[tuple[int, str, str]]:
+    """
+    (account_id, puuid, platform) with id > after_id, in id order. For round-robin walks.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            "SELECT id, puuid, platform FROM riot_accounts WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        )
+        rows = await cur.fetchall()
+        return [(int(r[0]), r[1], r[2]) for r in rows]
+
+
+async def get_slice_count(puuid: str, queue_class: str, start_ts: int, end_ts: int) -> int | None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            SELECT count FROM match_slice_counts
+            WHERE puuid = ? AND queue_class = ? AND start_ts = ? AND end_ts = ?
+            """,
+            (puuid, queue_class, start_ts, end_ts),
+        )
+        row = await cur.fetchone()
+        return int(row[0]) if row else None
+
+
+async def set_slice_count(puuid: str, queue_class: str, start_ts: int, end_ts: int, count: int) -> None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            """
+            INSERT OR REPLACE INTO match_slice_counts(puuid, queue_class, start_ts, end_ts, count)
+            VALUES(?, ?, ?, ?, ?)
+            """,
+            (puuid, queue_class, start_ts, end_ts, count),
+        )
+        await conn.commit()
+
+
+async def prune_slice_counts(ended_before_ts: int) -> int:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute("DELETE FROM match_slice_counts WHERE end_ts < ?", (ended_before_ts,))
+        await conn.commit()
+        return cur.rowcount
+
+
+async def get_day_coverage(account_id: int, queue_class: str) -> tuple[int, int] | None:
+    """
+    Returns (first_day, last_day) of closed days already in account_game_blocks, or None.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            "SELECT first_day, last_day FROM account_day_coverage WHERE account_id = ? AND queue_class = ?",
+            (account_id, queue_class),
+        )
+        row = await cur.fetchone()
+        return (int(row[0]), int(row[1])) if row else None
+
+
+async def add_game_blocks(
+    account_id: int,
+    queue_class: str,
+    blocks: list[tuple[int, int, int]],
+    first_day: int,
+    last_day: int,
+) -> None:
+    """
+    Stores (first_day, last_day, games) blocks and extends coverage to
+    [first_day, last_day] in one transaction. Days of the range outside every
+    block had zero games.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.executemany(
+            """
+            INSERT INTO account_game_blocks(account_id, queue_class, first_day, last_day, games)
+            VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(account_id, queue_class, first_day) DO UPDATE SET
+                last_day=excluded.last_day,
+                games=excluded.games
+            """,
+            [(account_id, queue_class, lo, hi, games) for lo, hi, games in blocks if games > 0],
+        )
+        await conn.execute(
+            """
+            INSERT INTO account_day_coverage(account_id, queue_class, first_day, last_day)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(account_id, queue_class) DO UPDATE SET
+                first_day=MIN(first_day, excluded.first_day),
+                last_day=MAX(last_day, excluded.last_day)
+            """,
+            (account_id, queue_class, first_day, last_day),
+        )
+        await conn.commit()
+
+
+async def get_game_block_across(account_id: int, queue_class: str, day: int) -> tuple[int, int, int] | None:
+    """
+    Returns (first_day, last_day, games) of the block that starts before `day`
+    and ends on or after it, i.e. the block a boundary at `day` cuts, or None.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            SELECT first_day, last_day, games
+            FROM account_game_blocks
+            WHERE account_id = ? AND queue_class = ? AND first_day < ? AND last_day >= ?
+            """,
+            (account_id, queue_class, day, day),
+        )
+        row = await cur.fetchone()
+        return (int(row[0]), int(row[1]), int(row[2])) if row else None
+
+
+async def split_game_block(account_id: int, queue_class: str, first_day: int, at_day: int, right_games: int) -> None:
+    """
+    Splits the block starting at first_day into [first_day, at_day - 1] and
+    [at_day, last_day], the latter with right_games. Empty halves are dropped.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            "SELECT last_day, games FROM account_game_blocks WHERE account_id = ? AND queue_class = ? AND first_day = ?",
+            (account_id, queue_class, first_day),
+        )
+        row = await cur.fetchone()
+        if row is None:
+            return
+        last_day, games = int(row[0]), int(row[1])
+        await conn.execute(
+            "DELETE FROM account_game_blocks WHERE account_id = ? AND queue_class = ? AND first_day = ?",
+            (account_id, queue_class, first_day),
+        )
+        await conn.executemany(
+            """
+            INSERT INTO account_game_blocks(account_id, queue_class, first_day, last_day, games)
+            VALUES(?, ?, ?, ?, ?)
+            """,
+            [
+                (account_id, queue_class, lo, hi, n)
+                for lo, hi, n in ((first_day, at_day - 1, games - right_games), (at_day, last_day, right_games))
+                if n > 0
+            ],
+        )
+        await conn.commit()
+
+
+async def sum_game_blocks(account_id: int, queue_class: str, first_day: int, last_day: int) -> int:
+    """
+    Games in the blocks that lie entirely inside [first_day, last_day].
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            SELECT COALESCE(SUM(games), 0)
+            FROM account_game_blocks
+            WHERE account_id = ? AND queue_class = ? AND first_day >= ? AND last_day <= ?
+            """,
+            (account_id, queue_class, first_day, last_day),
+        )
+        row = await cur.fetchone()
+        return int(row[0])
+
+
+async def list_linked_user_ids() -> list[str]:
+    """
+    Discord user IDs that have at least one linked Riot account.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute("SELECT DISTINCT discord_user_id FROM riot_accounts")
+        rows = await cur.fetchall()
+        return [str(r[0]) for r in rows]
+
+
 async def list_accounts_for_users(discord_user_ids: list[str]) -> list[tuple[int, str, str]]:
     """
     Returns list of (account_id, puuid, platform) for the given Discord user IDs.
@@ -271,6 +798,25 @@ async def list_accounts_for_users(discord_user_ids: list[str]) -> list[tuple[int
         rows = await cur.fetchall()
         return [(int(r[0]), str(r[1]), str(r[2])) for r in rows]
 
+async def list_accounts_by_ids(account_ids: list[int]) -> list[tuple[int, str, str]]:
+    """
+    Returns list of (account_id, puuid, platform) for the given riot_accounts ids.
+    Accounts unlinked in the meantime are simply missing.
+    """
+    if not account_ids:
+        return []
+
+    placeholders = ",".join("?" for _ in account_ids)
+    sql = f"""
+    SELECT id, puuid, platform
+    FROM riot_accounts
+    WHERE id IN ({placeholders})
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(sql, account_ids)
+        rows = await cur.fetchall()
+        return [(int(r[0]), str(r[1]), str(r[2])) for r in rows]
+
 async def set_window_mode(guild_id: int, mode: str, tz_name: str) -> None:
     async with aiosqlite.connect(DB_PATH) as conn:
         await conn.execute(
@@ -304,9 +850,15 @@ async def get_snapshot_map(guild_id: int, window_key: str) -> dict[str, tuple[in
         return {str(r[0]): (int(r[1]), int(r[2])) for r in rows}
 
 
-async def upsert_snapshot_row(guild_id: int, window_key: str, discord_user_id: str, rank: int, games: int) -> None:
+async def upsert_snapshot_rows(guild_id: int, window_key: str, rows: list[tuple[str, int, int]]) -> None:
+    """
+    rows: [(discord_user_id, rank, games_played)], written in one transaction.
+    """
+    if not rows:
+        return
+    now = int(time.time())
     async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
+        await conn.executemany(
             """
             INSERT INTO leaderboard_snapshots(guild_id, window_key, discord_user_id, rank, games_played, updated_at)
             VALUES(?, ?, ?, ?, ?, ?)
@@ -315,11 +867,59 @@ async def upsert_snapshot_row(guild_id: int, window_key: str, discord_user_id: s
                 games_played=excluded.games_played,
                 updated_at=excluded.updated_at
             """,
-            (str(guild_id), window_key, str(discord_user_id), rank, games, int(time.time())),
+            [(str(guild_id), window_key, str(duid), rank, games, now) for duid, rank, games in rows],
         )
         await conn.commit()
 
 
+async def set_stale_after_seconds(guild_id: int, seconds: int) -> None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            "UPDATE guild_settings SET stale_after_seconds=? WHERE guild_id=?",
+            (seconds, str(guild_id)),
+        )
+        await conn.commit()
+
+
+async def record_refresh_cost(guild_id: int, requests: int, alpha: float = 0.3) -> None:
+    """
+    Folds one refresh's Riot request count into the guild's moving average.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            """
+            UPDATE guild_settings
+            SET est_refresh_requests = CASE
+                WHEN est_refresh_requests IS NULL THEN ?
+                ELSE est_refresh_requests * (1 - ?) + ? * ?
+            END
+            WHERE guild_id = ?
+            """,
+            (requests, alpha, requests, alpha, str(guild_id)),
+        )
+        await conn.commit()
+
+
+async def get_refresh_estimates(guild_ids: list[int]) -> dict[int, float]:
+    """
+    guild_id -> average Riot requests per refresh, for guilds that have one.
+    """
+    if not guild_ids:
+        return {}
+
+    placeholders = ",".join("?" for _ in guild_ids)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            f"""
+            SELECT guild_id, est_refresh_requests FROM guild_settings
+            WHERE est_refresh_requests IS NOT NULL AND guild_id IN ({placeholders})
+            """,
+            [str(g) for g in guild_ids],
+        )
+        rows = await cur.fetchall()
+        return {int(r[0]): float(r[1]) for r in rows}
+
+
 async def set_queue_policy(guild_id: int, policy: str) -> None:
     async with aiosqlite.connect(DB_PATH) as conn:
         await conn.execute(
@@ -393,3 +993,254 @@ async def get_account_label(account_id: int) -> str:
         riot_txt = riot_id or "unknown#????"
         plat_txt = platform or "unknown"
         return f"{riot_txt} ({plat_txt}) acc_id={acc_id} puuid={short}..."
+
+
+async def enqueue_refresh_job(
+    guild_id: int,
+    window_key: str,
+    window_start_ts: int,
+    queue_policy: str,
+    account_ids: list[int],
+    priority: int,
+) -> int:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            INSERT INTO refresh_jobs(guild_id, window_key, window_start_ts, queue_policy, account_ids, priority, created_at)
+            VALUES(?, ?, ?, ?, ?, ?, ?)
+            """,
+            (str(guild_id), window_key, window_start_ts, queue_policy, json.dumps(account_ids), priority, _now_ts()),
+        )
+        await conn.commit()
+        return int(cur.lastrowid)
+
+
+async def claim_refresh_job(worker_id: str, stale_after: int) -> dict | None:
+    """
+    Atomically claims the next queued job (lowest priority value, then oldest).
+    Running jobs whose worker stopped heartbeating for `stale_after` seconds are requeued first.
+    Returns the job row (account_ids decoded) or None.
+    """
+    now = _now_ts()
+    async with aiosqlite.connect(DB_PATH, isolation_level=None) as conn:
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            await conn.execute(
+                """
+                UPDATE refresh_jobs
+                SET status='queued', claimed_by=NULL
+                WHERE status='running' AND heartbeat_at < ?
+                """,
+                (now - stale_after,),
+            )
+            cur = await conn.execute(
+                """
+                SELECT * FROM refresh_jobs
+                WHERE status='queued'
+                ORDER BY priority, id
+                LIMIT 1
+                """
+            )
+            row = await cur.fetchone()
+            if row is not None:
+                await conn.execute(
+                    "UPDATE refresh_jobs SET status='running', claimed_by=?, heartbeat_at=? WHERE id=?",
+                    (worker_id, now, row["id"]),
+                )
+            await conn.execute("COMMIT")
+        except Exception:
+            await conn.execute("ROLLBACK")
+            raise
+
+    if row is None:
+        return None
+    job = dict(row)
+    job["account_ids"] = json.loads(job["account_ids"])
+    return job
+
+
+async def heartbeat_refresh_job(job_id: int, done_accounts: int, requests: int) -> bool:
+    """
+    Marks a running job alive and stores its progress. Returns True when the bot asked to cancel it.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            "UPDATE refresh_jobs SET heartbeat_at=?, done_accounts=?, requests=? WHERE id=?",
+            (_now_ts(), done_accounts, requests, job_id),
+        )
+        await conn.commit()
+        cur = await conn.execute("SELECT cancel_requested FROM refresh_jobs WHERE id=?", (job_id,))
+        row = await cur.fetchone()
+        return bool(row and row[0])
+
+
+async def finish_refresh_job(
+    job_id: int,
+    updated_accounts: int | None,
+    result_json: str | None = None,
+    error: str | None = None,
+    requests: int = 0,
+    cancelled: bool = False,
+) -> None:
+    status = "cancelled" if cancelled else "failed" if error else "done"
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            """
+            UPDATE refresh_jobs
+            SET status=?, finished_at=?, updated_accounts=?, result_json=?, error=?, requests=?
+            WHERE id=?
+            """,
+            (status, _now_ts(), updated_accounts, result_json, error, requests, job_id),
+        )
+        await conn.commit()
+
+
+async def cancel_refresh_job(job_id: int) -> None:
+    """
+    A queued job is cancelled right away; a running one is flagged for its
+    worker, which stops at its next heartbeat.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        await conn.execute(
+            "UPDATE refresh_jobs SET status='cancelled', finished_at=? WHERE id=? AND status='queued'",
+            (_now_ts(), job_id),
+        )
+        await conn.execute(
+            "UPDATE refresh_jobs SET cancel_requested=1 WHERE id=? AND status='running'",
+            (job_id,),
+        )
+        await conn.commit()
+
+
+async def abandon_refresh_job(job_id: int, error: str, stale_before: int | None = None) -> bool:
+    """
+    Marks a job failed so the bot can count it itself: a job still queued, or
+    (with stale_before) a running one whose last heartbeat is older than that.
+    Returns False when a worker got to the job first.
+    """
+    if stale_before is None:
+        where, args = "status='queued'", ()
+    else:
+        where, args = "status='running' AND heartbeat_at < ?", (stale_before,)
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            f"UPDATE refresh_jobs SET status='failed', finished_at=?, error=? WHERE id=? AND {where}",
+            (_now_ts(), error, job_id, *args),
+        )
+        await conn.commit()
+        return cur.rowcount > 0
+
+
+async def get_refresh_job(job_id: int) -> dict | None:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        cur = await conn.execute("SELECT * FROM refresh_jobs WHERE id = ?", (job_id,))
+        row = await cur.fetchone()
+        return dict(row) if row else None
+
+
+async def list_all_guild_settings() -> list[dict]:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        cur = await conn.execute("SELECT * FROM guild_settings")
+        rows = await cur.fetchall()
+        return [dict(r) for r in rows]
+
+
+async def list_window_keys() -> list[str]:
+    """
+    Every window_key that still has account_stats or leaderboard_snapshots rows.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            """
+            SELECT DISTINCT window_key FROM account_stats
+            UNION
+            SELECT DISTINCT window_key FROM leaderboard_snapshots
+            """
+        )
+        rows = await cur.fetchall()
+        return [str(r[0]) for r in rows]
+
+
+async def archive_and_delete_windows(window_keys: list[str], top_n: int = 10) -> tuple[int, int]:
+    """
+    For each window: writes one window_archive row per guild (player count, total
+    games, top N from the snapshot), then deletes the window's account_stats and
+    leaderboard_snapshots rows. One transaction.
+    Returns (account_stats rows deleted, snapshot rows deleted).
+    """
+    if not window_keys:
+        return 0, 0
+
+    now = _now_ts()
+    stats_deleted = 0
+    snaps_deleted = 0
+
+    async with aiosqlite.connect(DB_PATH) as conn:
+        for window_key in window_keys:
+            cur = await conn.execute(
+                """
+                SELECT guild_id, discord_user_id, rank, games_played
+                FROM leaderboard_snapshots
+                WHERE window_key = ?
+                ORDER BY guild_id, rank, discord_user_id
+                """,
+                (window_key,),
+            )
+            per_guild: dict[str, list[tuple[str, int, int]]] = {}
+            for guild_id, duid, rank, games in await cur.fetchall():
+                per_guild.setdefault(str(guild_id), []).append((str(duid), int(rank), int(games)))
+
+            await conn.executemany(
+                """
+                INSERT OR REPLACE INTO window_archive(guild_id, window_key, players, total_games, top_json, archived_at)
+                VALUES(?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        guild_id,
+                        window_key,
+                        len(rows),
+                        sum(r[2] for r in rows),
+                        json.dumps([{"user": d, "rank": r, "games": g} for d, r, g in rows[:top_n]]),
+                        now,
+                    )
+                    for guild_id, rows in per_guild.items()
+                ],
+            )
+
+            cur = await conn.execute("DELETE FROM account_stats WHERE window_key = ?", (window_key,))
+            stats_deleted += cur.rowcount
+            cur = await conn.execute("DELETE FROM leaderboard_snapshots WHERE window_key = ?", (window_key,))
+            snaps_deleted += cur.rowcount
+
+        await conn.commit()
+
+    return stats_deleted, snaps_deleted
+
+
+async def prune_refresh_jobs(finished_before_ts: int) -> int:
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute(
+            "DELETE FROM refresh_jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+            (finished_before_ts,),
+        )
+        await conn.commit()
+        return cur.rowcount
+
+
+async def incremental_vacuum(max_pages: int = 0) -> int:
+    """
+    Returns free pages to the OS (auto_vacuum=INCREMENTAL). 0 = all free pages.
+    Returns the number of pages freed.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        cur = await conn.execute("PRAGMA freelist_count")
+        before = (await cur.fetchone())[0]
+        # executescript steps the pragma to completion; execute() frees a single page
+        await conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+        cur = await conn.execute("PRAGMA freelist_count")
+        after = (await cur.fetchone())[0]
+        return int(before) - int(after)
@@ -1,5 +1,12 @@
+PRAGMA auto_vacuum=INCREMENTAL;
 PRAGMA journal_mode=WAL;
 
+-- Small key/value store for bot bookkeeping (e.g. hash of the last synced command tree)
+CREATE TABLE IF NOT EXISTS bot_meta (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS users (
   discord_user_id TEXT PRIMARY KEY,
   created_at INTEGER NOT NULL
@@ -33,9 +40,17 @@ CREATE TABLE IF NOT EXISTS guild_settings (
   refresh_minute INTEGER NOT NULL DEFAULT 0,
   refresh_tz TEXT NOT NULL DEFAULT 'Europe/Copenhagen',
   next_refresh_ts INTEGER,
-  last_refresh_ts INTEGER
+  last_refresh_ts INTEGER,
+
+  stale_after_seconds INTEGER,
+
+  -- Moving average of Riot requests per stats refresh (pre-warm planning)
+  est_refresh_requests REAL
 );
 
+CREATE INDEX IF NOT EXISTS idx_guild_settings_next_refresh
+  ON guild_settings(next_refresh_ts);
+
 
 
 CREATE TABLE IF NOT EXISTS match_meta (
@@ -57,6 +72,8 @@ CREATE TABLE IF NOT EXISTS account_stats (
   window_key TEXT NOT NULL,
   games_played INTEGER NOT NULL,
   last_updated INTEGER NOT NULL,
+  -- 1 once the window has closed and games_played is its final count
+  final INTEGER NOT NULL DEFAULT 0,
   PRIMARY KEY (account_id, window_key),
   FOREIGN KEY (account_id)
     REFERENCES riot_accounts(id)
@@ -64,6 +81,56 @@ CREATE TABLE IF NOT EXISTS account_stats (
 );
 
 
+-- Per-account game histogram: counted blocks of UTC days [first_day, last_day]
+-- (inclusive) per queue class, only blocks with games > 0. Blocks never overlap;
+-- queue_class is 'all' or a queue id; days are unix_ts // 86400.
+CREATE TABLE IF NOT EXISTS account_game_blocks (
+  account_id INTEGER NOT NULL,
+  queue_class TEXT NOT NULL,
+  first_day INTEGER NOT NULL,
+  last_day INTEGER NOT NULL,
+  games INTEGER NOT NULL,
+  PRIMARY KEY (account_id, queue_class, first_day),
+  FOREIGN KEY (account_id)
+    REFERENCES riot_accounts(id)
+    ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- Adaptive polling: when new games were last seen, and games/day moving average
+CREATE TABLE IF NOT EXISTS account_activity (
+  account_id INTEGER PRIMARY KEY,
+  last_new_match_ts INTEGER,
+  games_per_day REAL NOT NULL DEFAULT 0,
+  first_seen_ts INTEGER NOT NULL,
+  FOREIGN KEY (account_id)
+    REFERENCES riot_accounts(id)
+    ON DELETE CASCADE
+);
+
+-- Match-V5 id counts for [start_ts, end_ts] ranges that had already ended when
+-- counted. Such a range can never change, so it is never fetched twice.
+CREATE TABLE IF NOT EXISTS match_slice_counts (
+  puuid TEXT NOT NULL,
+  queue_class TEXT NOT NULL,
+  start_ts INTEGER NOT NULL,
+  end_ts INTEGER NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (puuid, queue_class, start_ts, end_ts)
+) WITHOUT ROWID;
+
+-- Contiguous range of closed days already counted into account_game_blocks (inclusive).
+CREATE TABLE IF NOT EXISTS account_day_coverage (
+  account_id INTEGER NOT NULL,
+  queue_class TEXT NOT NULL,
+  first_day INTEGER NOT NULL,
+  last_day INTEGER NOT NULL,
+  PRIMARY KEY (account_id, queue_class),
+  FOREIGN KEY (account_id)
+    REFERENCES riot_accounts(id)
+    ON DELETE CASCADE
+);
+
+
 CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
   guild_id TEXT NOT NULL,
   window_key TEXT NOT NULL,
@@ -76,5 +143,45 @@ CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
 
 CREATE INDEX IF NOT EXISTS idx_snapshots_guild_window
   ON leaderboard_snapshots(guild_id, window_key);
+
+-- One row per (guild, expired window), written by the retention job before
+-- the window's account_stats / leaderboard_snapshots rows are deleted.
+CREATE TABLE IF NOT EXISTS window_archive (
+  guild_id TEXT NOT NULL,
+  window_key TEXT NOT NULL,
+  players INTEGER NOT NULL,
+  total_games INTEGER NOT NULL,
+  top_json TEXT NOT NULL,
+  archived_at INTEGER NOT NULL,
+  PRIMARY KEY (guild_id, window_key)
+);
 CREATE INDEX IF NOT EXISTS idx_riot_accounts_user
-  ON riot_accounts(discord_user_id);
\ No newline at end of file
+  ON riot_accounts(discord_user_id);
+
+-- Stats work handed from the bot to stats_worker processes (STATS_WORKER_MODE = "external").
+-- status: queued -> running -> done | failed | cancelled (queued -> cancelled too)
+-- While running, the worker's heartbeat writes done_accounts/requests for the
+-- bot's progress view and picks up cancel_requested.
+CREATE TABLE IF NOT EXISTS refresh_jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  guild_id TEXT NOT NULL,
+  window_key TEXT NOT NULL,
+  window_start_ts INTEGER NOT NULL,
+  queue_policy TEXT NOT NULL,
+  account_ids TEXT NOT NULL,
+  priority INTEGER NOT NULL,
+  status TEXT NOT NULL DEFAULT 'queued',
+  claimed_by TEXT,
+  heartbeat_at INTEGER,
+  created_at INTEGER NOT NULL,
+  finished_at INTEGER,
+  updated_accounts INTEGER,
+  result_json TEXT,
+  error TEXT,
+  done_accounts INTEGER NOT NULL DEFAULT 0,
+  requests INTEGER NOT NULL DEFAULT 0,
+  cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_refresh_jobs_status
+  ON refresh_jobs(status, priority, id);
@@ -0,0 +1,142 @@
+# guild_cache.py
+"""
+Per-guild in-memory caches, partitioned by shard.
+
+Entries are grouped by the shard that owns the guild, so a process only ever
+holds data for its own shards and a whole shard can be dropped at once when
+its gateway connection is lost.
+"""
+from __future__ import annotations
+
+import time
+from typing import Any
+
+import discord
+
+import db
+from shards import shard_id_for
+
+# Lean mode: the gateway member cache is off (see bot.py) and only members with
+# linked Riot accounts are fetched, via query_members, and kept.
+try:
+    from key import LEAN_MEMBER_CACHE
+except Exception:
+    LEAN_MEMBER_CACHE = False
+
+MEMBER_CACHE_TTL_SECONDS = 10 * 60
+BOARD_CACHE_TTL_SECONDS = 5 * 60
+
+# Discord accepts at most 100 user_ids per member request
+QUERY_MEMBERS_CHUNK = 100
+
+# Lean mode: linked users a member request did not find in a guild are not
+# asked for again until this expires or they join. Links are global, so in any
+# one guild most linked users are not members.
+ABSENT_MEMBER_TTL_SECONDS = 6 * 60 * 60
+
+
+class ShardedCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._parts: dict[int, dict[tuple, tuple[float, Any]]] = {}
+
+    def get(self, guild_id: int, key: tuple = ()) -> Any | None:
+        part = self._parts.get(shard_id_for(guild_id))
+        if not part:
+            return None
+        hit = part.get((guild_id, *key))
+        if hit is None:
+            return None
+        expires, value = hit
+        if time.monotonic() >= expires:
+            del part[(guild_id, *key)]
+            return None
+        return value
+
+    def set(self, guild_id: int, value: Any, key: tuple = ()) -> None:
+        part = self._parts.setdefault(shard_id_for(guild_id), {})
+        part[(guild_id, *key)] = (time.monotonic() + self.ttl, value)
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        part = self._parts.get(shard_id_for(guild_id))
+        if part:
+            for k in [k for k in part if k[0] == guild_id]:
+                del part[k]
+
+    def drop_shard(self, shard_id: int) -> None:
+        self._parts.pop(shard_id, None)
+
+
+_members = ShardedCache(MEMBER_CACHE_TTL_SECONDS)
+_boards = ShardedCache(BOARD_CACHE_TTL_SECONDS)
+_absent = ShardedCache(ABSENT_MEMBER_TTL_SECONDS)  # guild -> set of non-member user ids
+
+
+async def member_ids(guild: discord.Guild) -> list[str]:
+    """
+    Discord user IDs (as strings) of the guild members the leaderboard cares about.
+    Full mode: every cached member. Lean mode: only members with linked accounts.
+    """
+    ids = _members.get(guild.id)
+    if ids is None:
+        if LEAN_MEMBER_CACHE:
+            ids = await _linked_member_ids(guild)
+        else:
+            ids = [str(m.id) for m in guild.members]
+        _members.set(guild.id, ids)
+    return ids
+
+
+async def _linked_member_ids(guild: discord.Guild) -> list[str]:
+    absent: set[int] | None = _absent.get(guild.id)
+    present: list[str] = []
+    missing: list[int] = []
+    for duid in await db.list_linked_user_ids():
+        uid = int(duid)
+        if guild.get_member(uid) is not None:
+            present.append(duid)
+        elif absent is None or uid not in absent:
+            missing.append(uid)
+
+    # cache=True keeps the returned members, so guild.get_member works for them afterwards
+    found: set[int] = set()
+    for i in range(0, len(missing), QUERY_MEMBERS_CHUNK):
+        members = await guild.query_members(user_ids=missing[i:i + QUERY_MEMBERS_CHUNK], cache=True)
+        found.update(m.id for m in members)
+    present.extend(str(uid) for uid in found)
+
+    not_found = set(missing) - found
+    if absent is None:
+        _absent.set(guild.id, not_found)
+    else:
+        absent.update(not_found)  # keeps the set's expiry: everyone is re-asked once it ends
+    return present
+
+
+def invalidate_members(guild_id: int) -> None:
+    _members.invalidate_guild(guild_id)
+
+
+def member_joined(guild_id: int, user_id: int) -> None:
+    invalidate_members(guild_id)
+    absent = _absent.get(guild_id)
+    if absent is not None:
+        absent.discard(user_id)
+
+
+def get_board(guild_id: int, window_key: str) -> list[tuple[str, int]] | None:
+    return _boards.get(guild_id, (window_key,))
+
+
+def set_board(guild_id: int, window_key: str, rows: list[tuple[str, int]]) -> None:
+    _boards.set(guild_id, rows, (window_key,))
+
+
+def invalidate_board(guild_id: int) -> None:
+    _boards.invalidate_guild(guild_id)
+
+
+def drop_shard(shard_id: int) -> None:
+    _members.drop_shard(shard_id)
+    _boards.drop_shard(shard_id)
+    _absent.drop_shard(shard_id)
@@ -1,5 +1,10 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Sequence
+
 import discord
 import db
+import guild_cache
+import profiling
 
 MAX_ROWS = 25
 MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
@@ -47,40 +52,70 @@ def _dense_rank(sorted_rows: list[tuple[str, int]]) -> list[tuple[int, str, int]
 
     return out
 
-async def refresh_leaderboard_for_guild(bot: discord.Client, guild_id: int, window_key: str) -> None:
+@dataclass
+class BoardState:
+    """
+    A guild board as of one refresh, loaded once and handed to every pipeline stage.
+    `prev` is the snapshot from before this refresh: all stages diff against it.
+    """
+    guild: discord.Guild
+    gs: dict
+    window_key: str
+    rows: list[tuple[str, int]]  # whole board, total desc then user id asc
+    prev: dict[str, tuple[int, int]]  # {duid: (rank, games)}
+    rendered: bool = False
+
+    @property
+    def ranked(self) -> list[tuple[int, str, int]]:
+        return _dense_rank(self.rows[:MAX_ROWS])
+
+# A stage gets the shared board; extra stages run before the render and the snapshot write
+BoardStage = Callable[[BoardState], Awaitable[None]]
+
+async def load_board(bot: discord.Client, guild_id: int, window_key: str) -> BoardState | None:
     gs = await db.get_guild_settings(guild_id)
+    if not gs.get("leaderboard_channel_id"):
+        return None
+
+    guild = bot.get_guild(int(guild_id))
+    if guild is None:
+        return None
+
+    with profiling.span("members"):
+        member_ids = await guild_cache.member_ids(guild)
+    with profiling.span("db.board_rows"):
+        rows = await db.get_guild_leaderboard_rows(guild_member_ids=member_ids, window_key=window_key)
+
+    # Stable sorting:
+    #  - total desc
+    #  - user id asc to prevent ties swapping between refreshes
+    rows = sorted(rows, key=lambda r: (-r[1], int(r[0])))
+    # Fresh after the stats update: /top and /myrank read it from here
+    guild_cache.set_board(guild.id, window_key, rows)
+
+    with profiling.span("db.snapshot_read"):
+        prev = await db.get_snapshot_map(guild_id, window_key)
+    return BoardState(guild=guild, gs=gs, window_key=window_key, rows=rows, prev=prev)
+
+async def render_board(state: BoardState) -> None:
+    gs, guild = state.gs, state.guild
     channel_id = gs.get("leaderboard_channel_id")
     message_id = gs.get("leaderboard_message_id")
 
     if not channel_id or not message_id:
         return
 
-    guild = bot.get_guild(int(guild_id))
-    if guild is None:
-        return
-
     channel = guild.get_channel(int(channel_id))
     if channel is None:
         return
 
     try:
-        msg = await channel.fetch_message(int(message_id))
+        with profiling.span("discord.fetch"):
+            msg = await channel.fetch_message(int(message_id))
     except Exception:
         return
 
-    member_ids = {str(m.id) for m in guild.members}
-
-    rows = await db.get_guild_leaderboard_rows(
-        guild_member_ids=list(member_ids),
-        window_key=window_key,
-    )
-
-    # Stable sorting:
-    #  - total desc
-    #  - user id asc to prevent ties swapping between refreshes
-    rows = sorted(rows, key=lambda r: (-r[1], int(r[0])))[:MAX_ROWS]
-
-    prev = await db.get_snapshot_map(guild_id, window_key)
+    rows = state.rows[:MAX_ROWS]
 
     queue_policy_label = (gs.get("queue_policy") or "all").replace("_", " ").title()
     window_mode = gs.get("window_mode", "month")
@@ -114,16 +149,11 @@ async def refresh_leaderboard_for_guild(bot: discord.Client, guild_id: int, wind
         await msg.edit(content=None, embed=embed)
         return
 
-    ranked_rows = _dense_rank(rows)
-
     formatted: list[str] = []
-    for rank, duid, total in ranked_rows:
-        prev_rank, prev_games = prev.get(duid, (None, None))
+    for rank, duid, total in state.ranked:
+        prev_rank, prev_games = state.prev.get(duid, (None, None))
         formatted.append(_format_row(rank, duid, total, prev_rank, prev_games))
 
-        # snapshot uses the dense rank too (important!)
-        await db.upsert_snapshot_row(guild_id, window_key, duid, rank, total)
-
     embed.add_field(name="🏆 Podium", value="\n".join(formatted[:3]), inline=False)
 
     rest = formatted[3:]
@@ -140,4 +170,53 @@ async def refresh_leaderboard_for_guild(bot: discord.Client, guild_id: int, wind
     )
 
     embed.set_footer(text="🆕 new | ⬆️ up | ⬇️ down | ➖ same")
-    await msg.edit(content=None, embed=embed)
+    with profiling.span("discord.edit"):
+        await msg.edit(content=None, embed=embed)
+    state.rendered = True
+
+async def write_snapshot(state: BoardState) -> None:
+    """
+    Stores the rendered ranks as the baseline for the next refresh's arrows and gains.
+    Skipped when nothing was rendered, so the baseline stays the last board users saw.
+    """
+    if not state.rendered:
+        return
+    # snapshot uses the dense rank too (important!)
+    with profiling.span("db.snapshot_write"):
+        await db.upsert_snapshot_rows(
+            state.guild.id,
+            state.window_key,
+            [(duid, rank, total) for rank, duid, total in state.ranked],
+        )
+
+async def refresh_leaderboard_for_guild(
+    bot: discord.Client,
+    guild_id: int,
+    window_key: str,
+    stages: Sequence[BoardStage] = (),
+    snapshot: bool = True,
+) -> BoardState | None:
+    """
+    Refresh pipeline: settings, ranked board and previous snapshot are loaded once,
+    then `stages` (e.g. the weekly announcement) run, then the embed render, then
+    the snapshot write. A failing extra stage is logged and does not stop the render.
+    With snapshot=False the baseline is left as it is (background refreshes).
+    """
+    with profiling.span("board.load"):
+        state = await load_board(bot, guild_id, window_key)
+    if state is None:
+        return None
+
+    for stage in stages:
+        name = getattr(stage, "__name__", str(stage))
+        try:
+            with profiling.span(f"board.{name.lstrip('_')}"):
+                await stage(state)
+        except Exception as e:
+            print(f"[Leaderboard] Guild {guild_id}: {name} failed: {e}")
+
+    with profiling.span("board.render"):
+        await render_board(state)
+    if snapshot:
+        await write_snapshot(state)
+    return state
@@ -0,0 +1,117 @@
+# loop_monitor.py
+"""
+Event-loop lag monitor.
+
+A sampler task sleeps LOOP_SAMPLE_SECONDS at a time and records how late it
+wakes up as the `loop.lag` timing, shown with the other metrics in /botstats.
+Anything that runs synchronously on the loop (tz maths, sorting a whole
+board, a burst of prints) delays every other task by that much, including
+gateway heartbeats and interaction acks.
+
+A watchdog thread finds the culprit. When the sampler has been held up for
+more than LOOP_STALL_SECONDS, it takes the loop thread's stack through
+sys._current_frames(), so the stack shows the blocking code while it still
+blocks.
+"""
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+import metrics
+
+try:
+    from key import LOOP_MONITOR
+except Exception:
+    LOOP_MONITOR = True
+
+try:
+    from key import LOOP_STALL_SECONDS
+except Exception:
+    LOOP_STALL_SECONDS = 0.25
+
+LOOP_SAMPLE_SECONDS = 0.25
+STALL_HISTORY = 20
+STALL_STACK_FRAMES = 12
+
+
+@dataclass
+class Stall:
+    at: float  # unix time the stall was caught
+    blocked: float  # seconds the loop had been blocked when the stack was taken
+    stack: list[str]  # "file:line in function", innermost last
+
+
+_stalls: deque[Stall] = deque(maxlen=STALL_HISTORY)
+_beat = 0.0  # monotonic time of the sampler's last wake-up
+_task: asyncio.Task | None = None
+
+
+async def _sample() -> None:
+    global _beat
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_SAMPLE_SECONDS
+        await asyncio.sleep(LOOP_SAMPLE_SECONDS)
+        metrics.observe("loop.lag", max(0.0, loop.time() - expected))
+        _beat = time.monotonic()
+
+
+def _watchdog(loop_thread_id: int) -> None:
+    caught = None  # beat of the stall whose stack is already taken: one capture per stall
+    while True:
+        time.sleep(LOOP_STALL_SECONDS / 2)
+        beat = _beat
+        blocked = time.monotonic() - beat - LOOP_SAMPLE_SECONDS
+        if blocked < LOOP_STALL_SECONDS or beat == caught:
+            continue
+
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        caught = beat
+
+        stack = [
+            f"{Path(fs.filename).name}:{fs.lineno} in {fs.name}"
+            for fs in traceback.extract_stack(frame)[-STALL_STACK_FRAMES:]
+        ]
+        del frame
+        _stalls.append(Stall(at=time.time(), blocked=blocked, stack=stack))
+        metrics.incr("loop.stalls")
+        print(f"[LoopMonitor] event loop blocked {blocked:.2f}s+ at:\n  " + "\n  ".join(stack[-5:]))
+
+
+def start() -> None:
+    """
+    Starts the sampler on the running loop and the watchdog thread. Once per process.
+    """
+    global _task, _beat
+    if not LOOP_MONITOR or _task is not None:
+        return
+
+    _beat = time.monotonic()
+    _task = asyncio.get_running_loop().create_task(_sample())
+    threading.Thread(
+        target=_watchdog,
+        args=(threading.get_ident(),),
+        name="loop-watchdog",
+        daemon=True,
+    ).start()
+
+
+def recent_stalls(limit: int = 3) -> list[Stall]:
+    return list(_stalls)[-limit:][::-1]
+
+
+def format_stalls(limit: int = 3, frames: int = 4) -> str:
+    lines: list[str] = []
+    for stall in recent_stalls(limit):
+        lines.append(f"{stall.blocked * 1000:.0f}ms+ blocked, {int(time.time() - stall.at)}s ago:")
+        lines.extend(f"  {frame}" for frame in stall.stack[-frames:])
+    return "\n".join(lines)
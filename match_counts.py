@@ -1,10 +1,20 @@
 from __future__ import annotations
 
 import asyncio
+import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
 import aiohttp
 
+import db
+import metrics
+import profiling
+import progress
+import riot_limits
+import speedups
+from riot_limits import PRIORITY_NAMES, PRIORITY_REFRESH
+from singleflight import Singleflight
+
 REGIONAL = {
     "EUW1": "europe", "EUN1": "europe", "TR1": "europe", "RU": "europe",
     "NA1": "americas", "BR1": "americas", "LA1": "americas", "LA2": "americas",
@@ -15,8 +25,6 @@ REGIONAL = {
 RANKED_QUEUES = [420, 440]
 NORMAL_QUEUES = [400, 430, 450]
 
-DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=30)
-
 # ✅ Default slice size: 90 days (quarter-year).
 # Change to 180 * 24 * 60 * 60 if you want half-year.
 # Change to 90 * 24 * 60 * 60 if you want quater-year.
@@ -25,6 +33,20 @@ SLICE_SECONDS_DEFAULT = 180 * 24 * 60 * 60
 # Safety: Riot endpoint uses count<=100.
 PAGE_SIZE = 100
 
+DAY_SECONDS = 24 * 60 * 60
+
+# A UTC day only counts as closed (safe to store in the histogram) once it
+# ended this long ago, so late-indexed matches from its last hours are in.
+DAY_CLOSE_GRACE_SECONDS = 2 * 60 * 60
+
+# Closed days newer than the histogram are counted with the live tail slice
+# until this many have piled up; then they are stored as one block.
+HISTOGRAM_BATCH_DAYS = 7
+
+
+# Guilds sharing members refresh the same ranges at the same time (weekly bursts)
+_ids_flights = Singleflight("match_ids")
+
 
 @dataclass
 class SliceResult:
@@ -40,9 +62,7 @@ def _label(label: str | None, puuid: str) -> str:
 
 
 async def _fetch_ids_page(
-    session: aiohttp.ClientSession,
     *,
-    api_key: str,
     region: str,
     puuid: str,
     start_time_ts: int,
@@ -51,8 +71,8 @@ async def _fetch_ids_page(
     queue: int | None,
     debug: bool,
     label: str | None,
+    priority: int = PRIORITY_REFRESH,
 ) -> list[str]:
-    headers = {"X-Riot-Token": api_key}
     url = f"https://{region}.api.riotgames.com/lol/match/v5/matches/by-puuid/{puuid}/ids"
 
     params: dict[str, int] = {"startTime": start_time_ts, "start": start, "count": PAGE_SIZE}
@@ -61,30 +81,72 @@ async def _fetch_ids_page(
     if queue is not None:
         params["queue"] = queue
 
-    tries = 0
-    while True:
-        async with session.get(url, headers=headers, params=params) as resp:
-            if resp.status == 429:
-                retry_after = resp.headers.get("Retry-After")
-                wait_s = int(retry_after) if retry_after and retry_after.isdigit() else (2 ** min(tries, 5))
-                tries += 1
-                if debug:
-                    print(f"[Match-V5] {_label(label, puuid)} 429 retry in {wait_s}s (try={tries})")
-                await asyncio.sleep(wait_s)
-                continue
+    # Callers only read the returned list; sharing it between them is safe
+    flight_key = (url, tuple(sorted(params.items())))
+    return await _ids_flights.do(
+        flight_key,
+        lambda session, lane: _fetch_ids_page_once(
+            session, url=url, params=params, region=region, puuid=puuid, debug=debug, label=label, lane=lane
+        ),
+        priority,
+    )
 
-            if resp.status == 403:
-                body = await resp.text()
-                raise RuntimeError(f"Forbidden (403) from Riot. body={body}")
 
-            resp.raise_for_status()
-            return await resp.json()
+async def _fetch_ids_page_once(
+    session: aiohttp.ClientSession,
+    *,
+    url: str,
+    params: dict[str, int],
+    region: str,
+    puuid: str,
+    debug: bool,
+    label: str | None,
+    lane: riot_limits.Lane,
+) -> list[str]:
+    tries = 0
+    while True:
+        with profiling.span("riot.acquire"):
+            api_key = await riot_limits.acquire(region, lane=lane)
+        progress.count_request()
+        started = time.monotonic()
+        try:
+            with profiling.span("riot.http"):
+                async with session.get(url, headers={"X-Riot-Token": api_key}, params=params) as resp:
+                    priority_name = PRIORITY_NAMES.get(lane.priority, lane.priority)
+                    metrics.observe(f"riot.latency.{priority_name}", time.monotonic() - started)
+                    if resp.status == 429:
+                        retry_after = resp.headers.get("Retry-After")
+                        wait_s = int(retry_after) if retry_after and retry_after.isdigit() else (2 ** min(tries, 5))
+                        riot_limits.penalize(region, api_key, wait_s)
+                        tries += 1
+                        if debug:
+                            print(f"[Match-V5] {_label(label, puuid)} 429 retry in {wait_s}s (try={tries})")
+                        with profiling.span("riot.backoff"):
+                            await asyncio.sleep(wait_s)
+                        continue
+
+                    if resp.status in (401, 403):
+                        body = await resp.text()
+                        print(f"[Match-V5] {_label(label, puuid)} {resp.status} from Riot. body={body[:200]}")
+                        # Retry with another key if this one was quarantined; otherwise only this request fails
+                        if riot_limits.reject(api_key, resp.status):
+                            continue
+
+                    if resp.status >= 500:
+                        riot_limits.record_failure(region)
+                    resp.raise_for_status()
+                    with profiling.span("riot.json"):
+                        ids = await resp.json(loads=speedups.json_loads)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            riot_limits.record_failure(region)
+            raise
+
+        riot_limits.record_success(region, api_key)
+        return ids
 
 
 async def _count_ids_in_range(
-    session: aiohttp.ClientSession,
     *,
-    api_key: str,
     region: str,
     puuid: str,
     start_time_ts: int,
@@ -92,15 +154,31 @@ async def _count_ids_in_range(
     queue: int | None,
     debug: bool,
     label: str | None,
+    priority: int = PRIORITY_REFRESH,
+    memo: bool = True,
 ) -> SliceResult:
+    """
+    Counts match ids in [start_time_ts, end_time_ts]. A range that already ended
+    (past the close grace) cannot change, so its count is memoized in the DB
+    and only ever fetched once.
+    """
+    closed = (
+        memo
+        and end_time_ts is not None
+        and end_time_ts <= int(datetime.now(timezone.utc).timestamp()) - DAY_CLOSE_GRACE_SECONDS
+    )
+    if closed:
+        with profiling.span("db.slice_memo"):
+            cached = await db.get_slice_count(puuid, _queue_class(queue), start_time_ts, end_time_ts)
+        if cached is not None:
+            return SliceResult(count=cached, hit_full_pages=cached >= PAGE_SIZE)
+
     total = 0
     start = 0
     hit_full_pages = False
 
     while True:
         ids = await _fetch_ids_page(
-            session,
-            api_key=api_key,
             region=region,
             puuid=puuid,
             start_time_ts=start_time_ts,
@@ -109,6 +187,7 @@ async def _count_ids_in_range(
             queue=queue,
             debug=debug,
             label=label,
+            priority=priority,
         )
 
         n = len(ids)
@@ -127,6 +206,10 @@ async def _count_ids_in_range(
 
         start += PAGE_SIZE
 
+    if closed:
+        with profiling.span("db.slice_memo"):
+            await db.set_slice_count(puuid, _queue_class(queue), start_time_ts, end_time_ts, total)
+
     return SliceResult(count=total, hit_full_pages=hit_full_pages)
 
 
@@ -143,15 +226,14 @@ def _queues_for_policy(queue_policy: str) -> list[int | None]:
 
 async def count_lol_matches_since_filtered(
     *,
-    api_key: str,
     puuid: str,
     platform: str,
     start_time_ts: int,
     queue_policy: str = "all",
     debug: bool = False,
-    session: aiohttp.ClientSession | None = None,
     slice_seconds: int = SLICE_SECONDS_DEFAULT,
     label: str | None = None,  # ✅ NEW: for debug logs (e.g., riot_id or discord name)
+    priority: int = PRIORITY_REFRESH,
 ) -> int:
     """
     Counts matches from start_time_ts up to now, filtered by queue_policy.
@@ -167,43 +249,255 @@ async def count_lol_matches_since_filtered(
 
     queues = _queues_for_policy(queue_policy)
 
-    owns_session = session is None
-    if owns_session:
-        session = aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT)
+    total_all = 0
+
+    t = start_time_ts
+    slice_idx = 0
+    while t < now_ts:
+        end_t = min(t + slice_seconds, now_ts)
+
+        for q in queues:
+            res = await _count_ids_in_range(
+                region=region,
+                puuid=puuid,
+                start_time_ts=t,
+                end_time_ts=end_t,
+                queue=q,
+                debug=debug,
+                label=label,
+                priority=priority,
+            )
+            total_all += res.count
+
+        # ✅ Progress log: once every ~1 year worth of slices (works for 90d slices too)
+        if debug and slice_idx % 4 == 0:
+            print(f"[Match-V5] progress {_label(label, puuid)} t={t} -> {end_t} total={total_all}")
+
+        t = end_t
+        slice_idx += 1
+
+    return total_all
+
 
-    try:
-        assert session is not None
 
-        total_all = 0
+def _queue_class(queue: int | None) -> str:
+    return "all" if queue is None else str(queue)
+
+
+async def _fill_blocks(
+    *,
+    region: str,
+    puuid: str,
+    first_day: int,
+    last_day: int,
+    queue: int | None,
+    debug: bool,
+    label: str | None,
+    priority: int,
+) -> list[tuple[int, int, int]]:
+    """
+    (first_day, last_day, games) blocks covering UTC days [first_day, last_day], only blocks with games.
+    A range whose ids fit in one page is a single block for a single request; only
+    a range that fills the page is bisected, so a month costs one request unless
+    the account played 100+ games in it.
+    """
+    out: list[tuple[int, int, int]] = []
+
+    async def fill(lo: int, hi: int) -> None:
+        ids = await _fetch_ids_page(
+            region=region,
+            puuid=puuid,
+            start_time_ts=lo * DAY_SECONDS,
+            end_time_ts=(hi + 1) * DAY_SECONDS - 1,
+            start=0,
+            queue=queue,
+            debug=debug,
+            label=label,
+            priority=priority,
+        )
+        if len(ids) < PAGE_SIZE:
+            if ids:
+                out.append((lo, hi, len(ids)))
+            return
+        if lo == hi:
+            # 100+ games on one day: page through it
+            res = await _count_ids_in_range(
+                region=region,
+                puuid=puuid,
+                start_time_ts=lo * DAY_SECONDS,
+                end_time_ts=(hi + 1) * DAY_SECONDS - 1,
+                queue=queue,
+                debug=debug,
+                label=label,
+                priority=priority,
+                memo=False,  # the histogram already keeps these
+            )
+            out.append((lo, hi, res.count))
+            return
+        mid = (lo + hi) // 2
+        await fill(lo, mid)
+        await fill(mid + 1, hi)
+
+    await fill(first_day, last_day)
+    return out
+
+
+async def _cut_block(
+    *,
+    account_id: int,
+    region: str,
+    puuid: str,
+    at_day: int,
+    queue: int | None,
+    debug: bool,
+    label: str | None,
+    priority: int,
+) -> None:
+    """
+    Makes `at_day` a block boundary: a stored block that spans it is split in
+    two by counting its part from at_day on. Once per account and boundary.
+    """
+    qc = _queue_class(queue)
+    with profiling.span("db.histogram"):
+        block = await db.get_game_block_across(account_id, qc, at_day)
+    if block is None:
+        return
+    first_day, last_day, _ = block
+    res = await _count_ids_in_range(
+        region=region,
+        puuid=puuid,
+        start_time_ts=at_day * DAY_SECONDS,
+        end_time_ts=(last_day + 1) * DAY_SECONDS - 1,
+        queue=queue,
+        debug=debug,
+        label=label,
+        priority=priority,
+        memo=False,  # the histogram already keeps these
+    )
+    with profiling.span("db.histogram"):
+        await db.split_game_block(account_id, qc, first_day, at_day, res.count)
+
+
+async def count_lol_matches_in_window(
+    *,
+    account_id: int,
+    puuid: str,
+    platform: str,
+    start_time_ts: int,
+    queue_policy: str = "all",
+    debug: bool = False,
+    label: str | None = None,
+    priority: int = PRIORITY_REFRESH,
+    end_time_ts: int | None = None,
+) -> int:
+    """
+    Counts matches from start_time_ts up to now (or up to end_time_ts, exclusive,
+    for a window that has ended) using the histogram of counted day blocks.
+
+    Closed UTC days come from account_game_blocks; days not covered yet are
+    fetched from Riot (one request per range that fits a page) and stored. The
+    rest of the window, i.e. the partial first day and everything after the
+    histogram, is counted with one slice each; a slice that already ended is
+    memoized, so a closed window is recounted without Riot calls and an open one
+    usually costs a single request.
+    """
+    region = REGIONAL.get(platform.upper())
+    if not region:
+        raise ValueError(f"Unknown platform: {platform}")
 
-        t = start_time_ts
-        slice_idx = 0
-        while t < now_ts:
-            end_t = min(t + slice_seconds, now_ts)
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    if start_time_ts >= now_ts:
+        return 0
 
-            for q in queues:
-                res = await _count_ids_in_range(
-                    session,
-                    api_key=api_key,
+    # Inclusive last second of the counted range
+    until_ts = now_ts if end_time_ts is None else min(now_ts, end_time_ts - 1)
+
+    first_full_day = -(-start_time_ts // DAY_SECONDS)  # first UTC day fully inside the window
+    open_day = (now_ts - DAY_CLOSE_GRACE_SECONDS) // DAY_SECONDS  # first day not closed yet
+    last_closed_day = min(open_day - 1, (until_ts + 1) // DAY_SECONDS - 1)
+
+    total_all = 0
+    for q in _queues_for_policy(queue_policy):
+        qc = _queue_class(q)
+
+        # Closed days answered from the histogram: [first_full_day, stored_last]
+        stored_last = first_full_day - 1
+        if first_full_day <= last_closed_day:
+            with profiling.span("db.histogram"):
+                coverage = await db.get_day_coverage(account_id, qc)
+
+            # Older days are filled right away; newer ones once a batch has piled up
+            missing = []
+            if coverage is None:
+                if last_closed_day - first_full_day + 1 >= HISTOGRAM_BATCH_DAYS:
+                    missing.append((first_full_day, last_closed_day))
+            else:
+                cov_first, cov_last = coverage
+                if first_full_day < cov_first:
+                    missing.append((first_full_day, cov_first - 1))
+                if last_closed_day - cov_last >= HISTOGRAM_BATCH_DAYS:
+                    missing.append((cov_last + 1, last_closed_day))
+
+            for lo_day, hi_day in missing:
+                blocks = await _fill_blocks(
                     region=region,
                     puuid=puuid,
-                    start_time_ts=t,
-                    end_time_ts=end_t,
+                    first_day=lo_day,
+                    last_day=hi_day,
                     queue=q,
                     debug=debug,
                     label=label,
+                    priority=priority,
                 )
-                total_all += res.count
-
-            # ✅ Progress log: once every ~1 year worth of slices (works for 90d slices too)
-            if debug and slice_idx % 4 == 0:
-                print(f"[Match-V5] progress {_label(label, puuid)} t={t} -> {end_t} total={total_all}")
-
-            t = end_t
-            slice_idx += 1
-
-        return total_all
+                with profiling.span("db.histogram"):
+                    await db.add_game_blocks(account_id, qc, blocks, lo_day, hi_day)
+                if debug:
+                    print(
+                        f"[Match-V5] {_label(label, puuid)} queue={qc} filled days {lo_day}..{hi_day} "
+                        f"-> {sum(b[2] for b in blocks)} games in {len(blocks)} blocks"
+                    )
+
+            if coverage is not None or missing:
+                cov_last = max([hi for _, hi in missing] + ([coverage[1]] if coverage else []))
+                stored_last = min(last_closed_day, cov_last)
+
+        if stored_last < first_full_day:
+            live = [(start_time_ts, until_ts)]
+        else:
+            # Blocks cut by the window edges are split once, then reused
+            for at_day in (first_full_day, stored_last + 1):
+                await _cut_block(
+                    account_id=account_id,
+                    region=region,
+                    puuid=puuid,
+                    at_day=at_day,
+                    queue=q,
+                    debug=debug,
+                    label=label,
+                    priority=priority,
+                )
+            with profiling.span("db.histogram"):
+                total_all += await db.sum_game_blocks(account_id, qc, first_full_day, stored_last)
+            # Edge slices: [start, first full day) and (last stored day, until]
+            live = [
+                (start_time_ts, first_full_day * DAY_SECONDS - 1),
+                ((stored_last + 1) * DAY_SECONDS, until_ts),
+            ]
+
+        for lo_ts, hi_ts in live:
+            if lo_ts > hi_ts:
+                continue
+            res = await _count_ids_in_range(
+                region=region,
+                puuid=puuid,
+                start_time_ts=lo_ts,
+                end_time_ts=hi_ts,
+                queue=q,
+                debug=debug,
+                label=label,
+                priority=priority,
+            )
+            total_all += res.count
+
+    return total_all
 
-    finally:
-        if owns_session:
-            await session.close()
@@ -0,0 +1,73 @@
+# metrics.py
+"""
+Tiny in-process metrics registry.
+
+Counters are plain integers; timings keep a bounded window of recent samples
+so percentiles stay cheap. Shown to admins through /botstats.
+"""
+from __future__ import annotations
+
+from collections import defaultdict, deque
+
+SAMPLE_WINDOW = 1000
+
+_counters: dict[str, int] = defaultdict(int)
+_samples: dict[str, deque[float]] = {}
+
+
+def incr(name: str, n: int = 1) -> None:
+    _counters[name] += n
+
+
+def observe(name: str, value: float) -> None:
+    buf = _samples.get(name)
+    if buf is None:
+        buf = _samples[name] = deque(maxlen=SAMPLE_WINDOW)
+    buf.append(value)
+
+
+def counter(name: str) -> int:
+    return _counters.get(name, 0)
+
+
+def percentile(name: str, pct: float) -> float | None:
+    buf = _samples.get(name)
+    if not buf:
+        return None
+    ordered = sorted(buf)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def snapshot() -> dict:
+    """
+    Returns {"counters": {...}, "timings": {name: {"n", "p50", "p95", "max"}}}.
+    """
+    timings = {}
+    for name, buf in _samples.items():
+        if not buf:
+            continue
+        timings[name] = {
+            "n": len(buf),
+            "p50": percentile(name, 50),
+            "p95": percentile(name, 95),
+            "max": max(buf),
+        }
+    return {"counters": dict(_counters), "timings": timings}
+
+
+def format_summary() -> str:
+    snap = snapshot()
+    lines: list[str] = []
+
+    for name in sorted(snap["timings"]):
+        t = snap["timings"][name]
+        lines.append(
+            f"{name}: p50={t['p50'] * 1000:.0f}ms p95={t['p95'] * 1000:.0f}ms "
+            f"max={t['max'] * 1000:.0f}ms (n={t['n']})"
+        )
+
+    for name in sorted(snap["counters"]):
+        lines.append(f"{name}: {snap['counters'][name]}")
+
+    return "\n".join(lines) or "No metrics recorded yet."
@@ -0,0 +1,146 @@
+# profiling.py
+"""
+Await-site profiler for a single refresh run.
+
+Code marks its await sites with `with profiling.span("riot.http"):`. While a
+profile is active, each span adds its wall time to the stack of spans around
+it. When no profile is active a span costs one context variable lookup. The
+profile travels in a context variable (like progress.py), so the per-account
+workers of a refresh, which inherit the context, all record into it. Their
+times add up: a stack's time is summed over tasks, not wall clock.
+
+Profiles are written in the collapsed-stack format ("a;b;c <microseconds>")
+read by flamegraph.pl, inferno and speedscope.
+"""
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+try:
+    from key import PROFILE_DIR
+except Exception:
+    PROFILE_DIR = "profiles"
+
+HOTSPOT_LIMIT = 8
+
+Stack = tuple[str, ...]
+
+
+@dataclass
+class Profile:
+    name: str
+    totals: dict[Stack, float] = field(default_factory=dict)  # inclusive seconds per stack
+    calls: dict[Stack, int] = field(default_factory=dict)
+    started: float = field(default_factory=time.perf_counter)
+    wall: float = 0.0
+
+    def add(self, stack: Stack, seconds: float) -> None:
+        self.totals[stack] = self.totals.get(stack, 0.0) + seconds
+        self.calls[stack] = self.calls.get(stack, 0) + 1
+
+    def self_times(self) -> dict[Stack, float]:
+        """
+        Time spent in each stack outside its child spans. Children running in
+        parallel tasks can add up to more than their parent: clamped at 0.
+        """
+        out = dict(self.totals)
+        for stack, seconds in self.totals.items():
+            if len(stack) > 1 and stack[:-1] in out:
+                out[stack[:-1]] -= seconds
+        return {stack: max(0.0, seconds) for stack, seconds in out.items()}
+
+    def collapsed(self) -> str:
+        lines = [
+            f"{';'.join(stack)} {int(seconds * 1_000_000)}"
+            for stack, seconds in sorted(self.self_times().items())
+            if seconds > 0
+        ]
+        return "\n".join(lines) + "\n"
+
+    def hotspots(self, limit: int = HOTSPOT_LIMIT) -> list[tuple[str, float, float, int]]:
+        """
+        [(span name, self seconds, inclusive seconds, calls)], most self time
+        first. A span name that shows up under several stacks is merged.
+        """
+        merged: dict[str, list] = {}
+        self_times = self.self_times()
+        for stack, total in self.totals.items():
+            entry = merged.setdefault(stack[-1], [0.0, 0.0, 0])
+            entry[0] += self_times[stack]
+            entry[1] += total
+            entry[2] += self.calls[stack]
+        ranked = sorted(merged.items(), key=lambda kv: kv[1][0], reverse=True)[:limit]
+        return [(name, s, t, n) for name, (s, t, n) in ranked]
+
+    def summary(self, limit: int = HOTSPOT_LIMIT) -> str:
+        lines = [f"{self.name}: {self.wall:.2f}s wall"]
+        for name, self_s, total_s, calls in self.hotspots(limit):
+            lines.append(f"{name:<24} self={self_s:8.2f}s  total={total_s:8.2f}s  calls={calls}")
+        return "\n".join(lines)
+
+    def write(self, directory: str | Path = PROFILE_DIR) -> Path:
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        path = path / f"{self.name}-{int(time.time())}.folded"
+        path.write_text(self.collapsed(), encoding="utf-8")
+        return path
+
+
+current: ContextVar[Profile | None] = ContextVar("profile", default=None)
+_stack: ContextVar[Stack] = ContextVar("profile_stack", default=())
+
+# Guild ids whose next scheduled refresh should be profiled
+_armed: set[int] = set()
+
+
+@contextmanager
+def session(name: str) -> Iterator[Profile]:
+    """
+    Profiles everything awaited inside the block, under a root frame `name`.
+    """
+    profile = Profile(name)
+    token = current.set(profile)
+    stack_token = _stack.set((name,))
+    try:
+        yield profile
+    finally:
+        profile.wall = time.perf_counter() - profile.started
+        profile.add((name,), profile.wall)
+        _stack.reset(stack_token)
+        current.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    profile = current.get()
+    if profile is None:
+        yield
+        return
+
+    stack = _stack.get() + (name,)
+    token = _stack.set(stack)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(stack, time.perf_counter() - started)
+        _stack.reset(token)
+
+
+def arm(guild_id: int) -> None:
+    _armed.add(guild_id)
+
+
+def take_armed(guild_id: int) -> bool:
+    """
+    True once after arm(guild_id): the caller profiles this run.
+    """
+    if guild_id in _armed:
+        _armed.discard(guild_id)
+        return True
+    return False
@@ -0,0 +1,44 @@
+# progress.py
+"""
+Live progress of a stats refresh run.
+
+The refresh owns a RefreshProgress and updates done/total per account. Riot
+requests are counted through a context variable, so code deep in the Match-V5
+client can report them without threading the object through every call.
+"""
+from __future__ import annotations
+
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+
+@dataclass
+class RefreshProgress:
+    total: int = 0  # accounts in this run
+    done: int = 0  # accounts finished (updated, failed or skipped)
+    requests: int = 0  # Riot requests sent by this run
+    started: float = field(default_factory=time.monotonic)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def eta_seconds(self) -> float | None:
+        """
+        Remaining accounts x requests per account so far, at the request pace
+        the rate limiter has allowed so far. None until an account is done.
+        """
+        if self.done == 0 or self.requests == 0:
+            return None
+        per_account = self.requests / self.done
+        pace = self.requests / max(self.elapsed(), 1e-6)
+        return per_account * max(0, self.total - self.done) / pace
+
+
+current: ContextVar[RefreshProgress | None] = ContextVar("refresh_progress", default=None)
+
+
+def count_request() -> None:
+    p = current.get()
+    if p is not None:
+        p.requests += 1
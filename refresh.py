@@ -0,0 +1,309 @@
+# refresh.py
+"""
+Guild refresh runs: update Riot stats for the current window, then re-render
+the leaderboard message.
+
+At most one refresh per guild runs at a time. /refreshnow and the scheduler's
+pre-warm join a run that is already in flight, and read commands (/top,
+/myrank) can kick off a background refresh when the stored board is stale
+(stale-while-revalidate). Background refreshes re-render the board but keep
+its snapshot, the baseline the weekly announcement diffs against. A run can
+be profiled (profiling.py); its profile is kept for the caller to pick up.
+
+Closed windows are made final in the background too, once per guild and
+window, when /top asks for the previous period.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from pathlib import Path
+
+import discord
+
+import db
+import guild_cache
+import profiling
+import riot_limits
+import window_service
+from leaderboard import refresh_leaderboard_for_guild
+from match_counts import DAY_CLOSE_GRACE_SECONDS
+from progress import RefreshProgress
+from riot_limits import PRIORITY_REFRESH
+from stats_update import RefreshResult, finalize_window_for_guild, update_stats_for_guild
+from utilities.utils_window import make_window_key
+
+# Board older than this triggers a background refresh on /top or /myrank.
+# Per guild via /setstaleness (guild_settings.stale_after_seconds, 0 = off).
+DEFAULT_STALE_AFTER_SECONDS = 6 * 60 * 60
+
+# Minimum time between two background refreshes of the same guild
+BACKGROUND_REFRESH_COOLDOWN_SECONDS = 15 * 60
+
+_inflight: dict[int, asyncio.Task] = {}
+_stats_only: set[int] = set()  # guilds whose in-flight run does not render (scheduler pre-warms)
+_progress: dict[int, RefreshProgress] = {}
+_profiles: dict[int, tuple[profiling.Profile, Path]] = {}
+_last_background_start: dict[int, float] = {}
+
+# (guild_id, window_key) of closed windows: being finalized, final, last attempt
+_finalizing: dict[tuple[int, str], asyncio.Task] = {}
+_finalized: set[tuple[int, str]] = set()
+_last_finalize_start: dict[tuple[int, str], float] = {}
+
+
+def current_window(gs: dict) -> tuple[str, int, str, str, str]:
+    """
+    Returns (window_key, window_start_ts, mode, tz_name, queue_policy) for guild settings.
+    """
+    return window_service.window_for_settings(gs)
+
+
+def previous_window(gs: dict) -> tuple[str, int, int] | None:
+    """
+    Returns (window_key, window_start_ts, window_end_ts) of the window before the
+    current one, or None in since_date mode (no previous period).
+    """
+    _, start_ts, mode, tz_name, _ = current_window(gs)
+    if mode == "since_date":
+        return None
+
+    prev_start, _ = window_service.bounds(mode, tz_name, start_ts - 1)
+    return make_window_key(mode, prev_start, tz_name), prev_start, start_ts
+
+
+async def _run_refresh(
+    bot: discord.Client,
+    guild: discord.Guild,
+    priority: int,
+    progress: RefreshProgress,
+    profile: bool = False,
+    render: bool = True,
+    snapshot: bool = True,
+) -> RefreshResult:
+    if not profile:
+        return await _refresh_once(bot, guild, priority, progress, render, snapshot)
+
+    with profiling.session(f"refresh-{guild.id}") as prof:
+        try:
+            return await _refresh_once(bot, guild, priority, progress, render, snapshot)
+        finally:
+            # Also written for cancelled and failed runs: those are often the slow ones
+            path = prof.write()
+            _profiles[guild.id] = (prof, path)
+            print(f"[Refresh] Guild {guild.id}: profile written to {path}\n{prof.summary()}")
+
+
+async def _refresh_once(
+    bot: discord.Client,
+    guild: discord.Guild,
+    priority: int,
+    progress: RefreshProgress,
+    render: bool = True,
+    snapshot: bool = True,
+) -> RefreshResult:
+    gs = await db.get_guild_settings(guild.id)
+    window_key, window_start_ts, _, _, queue_policy = current_window(gs)
+
+    try:
+        with profiling.span("stats"):
+            result = await update_stats_for_guild(
+                guild=guild,
+                window_key=window_key,
+                window_start_ts=window_start_ts,
+                queue_policy=queue_policy,
+                max_concurrency=2,
+                priority=priority,
+                progress=progress,
+            )
+    except asyncio.CancelledError:
+        # Counts stored before the cancel are kept; the cached ranking is not
+        guild_cache.invalidate_board(guild.id)
+        print(f"[Refresh] Guild {guild.id}: cancelled after {progress.done}/{progress.total} accounts")
+        raise
+
+    if render:
+        await _publish(bot, guild, window_key, snapshot)
+    return result
+
+
+async def _publish(bot: discord.Client, guild: discord.Guild, window_key: str, snapshot: bool) -> None:
+    await db.set_last_refresh_ts(guild.id, int(time.time()))
+    # Renders from whatever succeeded; failed accounts keep their previous counts
+    await refresh_leaderboard_for_guild(bot, guild.id, window_key, snapshot=snapshot)
+
+
+async def _publish_after(
+    bot: discord.Client,
+    guild: discord.Guild,
+    stats_run: asyncio.Task,
+    snapshot: bool,
+) -> RefreshResult:
+    # Cancelling this run must not cancel the stats-only run it waits for
+    result = await asyncio.shield(stats_run)
+    gs = await db.get_guild_settings(guild.id)
+    await _publish(bot, guild, current_window(gs)[0], snapshot)
+    return result
+
+
+def start_refresh(
+    bot: discord.Client,
+    guild: discord.Guild,
+    priority: int = PRIORITY_REFRESH,
+    profile: bool = False,
+    render: bool = True,
+    snapshot: bool = True,
+) -> asyncio.Task:
+    """
+    Starts a refresh for the guild, or returns the one already running.
+    The task result is the RefreshResult of the stats update; cancelling the
+    task stops the run (accounts already counted stay stored).
+    With profile=True a new run is profiled (see take_profile); a run that
+    is already in flight is returned as it is.
+    With render=False only the stats are updated (the scheduler's pre-warm);
+    a rendering refresh asked for meanwhile renders once those are in.
+    With snapshot=False the board is rendered without moving its snapshot.
+    """
+    task = _inflight.get(guild.id)
+    if task is not None and not task.done():
+        if render and guild.id in _stats_only:
+            task = asyncio.create_task(_publish_after(bot, guild, task, snapshot))
+            _inflight[guild.id] = task
+            _stats_only.discard(guild.id)
+            task.add_done_callback(lambda t, gid=guild.id: _forget(gid, t))
+        return task
+
+    progress = RefreshProgress()
+    _profiles.pop(guild.id, None)
+    task = asyncio.create_task(_run_refresh(bot, guild, priority, progress, profile, render, snapshot))
+    _inflight[guild.id] = task
+    _progress[guild.id] = progress
+    if not render:
+        _stats_only.add(guild.id)
+    task.add_done_callback(lambda t, gid=guild.id: _forget(gid, t))
+    return task
+
+
+def _forget(guild_id: int, task: asyncio.Task) -> None:
+    if _inflight.get(guild_id) is task:
+        del _inflight[guild_id]
+        _stats_only.discard(guild_id)
+        _progress.pop(guild_id, None)
+
+
+def progress_for(guild_id: int) -> RefreshProgress | None:
+    """
+    Progress of the guild's running refresh, or None when none is running.
+    """
+    return _progress.get(guild_id) if is_refreshing(guild_id) else None
+
+
+def take_profile(guild_id: int) -> tuple[profiling.Profile, Path] | None:
+    """
+    (profile, written file) of the guild's last profiled run, once.
+    """
+    return _profiles.pop(guild_id, None)
+
+
+def is_refreshing(guild_id: int) -> bool:
+    task = _inflight.get(guild_id)
+    return task is not None and not task.done()
+
+
+def is_stale(gs: dict, now_ts: int | None = None) -> bool:
+    stale_after = gs.get("stale_after_seconds")
+    if stale_after is None:
+        stale_after = DEFAULT_STALE_AFTER_SECONDS
+    if stale_after <= 0:
+        return False
+
+    last_ts = gs.get("last_refresh_ts")
+    now_ts = int(time.time()) if now_ts is None else now_ts
+    return not last_ts or now_ts - int(last_ts) >= stale_after
+
+
+def maybe_revalidate(bot: discord.Client, guild: discord.Guild, gs: dict) -> bool:
+    """
+    Starts a background refresh when the guild's board is stale.
+    Returns True if a refresh is running afterwards (new or already in flight).
+    """
+    if is_refreshing(guild.id):
+        return True
+    if not riot_limits.has_keys() or not is_stale(gs):
+        return False
+
+    now = time.monotonic()
+    last = _last_background_start.get(guild.id)
+    if last is not None and now - last < BACKGROUND_REFRESH_COOLDOWN_SECONDS:
+        return False
+
+    _last_background_start[guild.id] = now
+    # Not a snapshot: the weekly announcement diffs against the last post, not against this
+    task = start_refresh(bot, guild, snapshot=False)
+    task.add_done_callback(_log_background_result(guild.id))
+    print(f"[Refresh] Guild {guild.id}: board stale — background refresh started")
+    return True
+
+
+def _log_background_result(guild_id: int):
+    def _done(task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            print(f"[Refresh] Guild {guild_id}: background refresh failed: {exc}")
+        else:
+            print(f"[Refresh] Guild {guild_id}: background refresh done, {task.result().summary()}")
+    return _done
+
+
+def maybe_finalize(guild: discord.Guild, gs: dict) -> bool:
+    """
+    Starts making the previous window final in the background once it has closed
+    (DAY_CLOSE_GRACE_SECONDS after its end). Returns True if its stored counts
+    are final already; until then they are provisional.
+    """
+    prev = previous_window(gs)
+    if prev is None:
+        return False
+    window_key, start_ts, end_ts = prev
+    key = (guild.id, window_key)
+    if key in _finalized:
+        return True
+
+    task = _finalizing.get(key)
+    if task is not None and not task.done():
+        return False
+    if not riot_limits.has_keys() or time.time() < end_ts + DAY_CLOSE_GRACE_SECONDS:
+        return False
+
+    now = time.monotonic()
+    last = _last_finalize_start.get(key)
+    if last is not None and now - last < BACKGROUND_REFRESH_COOLDOWN_SECONDS:
+        return False
+
+    _last_finalize_start[key] = now
+    queue_policy = current_window(gs)[4]
+    task = asyncio.create_task(finalize_window_for_guild(guild, window_key, start_ts, end_ts, queue_policy))
+    _finalizing[key] = task
+    task.add_done_callback(_finalize_done(key))
+    print(f"[Refresh] Guild {guild.id}: finalizing {window_key} in background")
+    return False
+
+
+def _finalize_done(key: tuple[int, str]):
+    def _done(task: asyncio.Task) -> None:
+        if _finalizing.get(key) is task:
+            del _finalizing[key]
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            print(f"[Refresh] Guild {key[0]}: finalizing {key[1]} failed: {exc}")
+            return
+        result, final = task.result()
+        if final:
+            _finalized.add(key)
+            _last_finalize_start.pop(key, None)
+        print(f"[Refresh] Guild {key[0]}: {key[1]} {'final' if final else 'still provisional'}, {result.summary()}")
+    return _done
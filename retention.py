@@ -0,0 +1,89 @@
+# retention.py
+"""
+Retention for per-window tables.
+
+account_stats and leaderboard_snapshots get a fresh set of rows for every
+window (week / month / since-date), so they grow forever. Windows that
+started more than RETENTION_DAYS ago, and are not the current window of any
+guild, are summarized into window_archive and deleted. The freed pages are
+then returned to the OS with an incremental vacuum.
+"""
+from __future__ import annotations
+
+import time
+
+import db
+import metrics
+from refresh import current_window, previous_window
+
+# Windows starting more than this many days ago are archived and deleted
+try:
+    from key import RETENTION_DAYS
+except Exception:
+    RETENTION_DAYS = 180
+
+# Finished refresh_jobs rows are kept this long for inspection
+REFRESH_JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+
+def window_start_from_key(window_key: str) -> int | None:
+    # make_window_key: "mode:tz:start_ts"
+    try:
+        return int(window_key.rsplit(":", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+async def active_window_keys() -> set[str]:
+    """
+    The current and previous window key of every guild — never deleted, however
+    old (a since-date window can start years back, /top serves the previous period).
+    """
+    keys = set()
+    for gs in await db.list_all_guild_settings():
+        keys.add(current_window(gs)[0])
+        prev = previous_window(gs)
+        if prev is not None:
+            keys.add(prev[0])
+    return keys
+
+
+async def expired_window_keys(horizon_days: int, now_ts: int | None = None) -> list[str]:
+    now_ts = int(time.time()) if now_ts is None else now_ts
+    cutoff = now_ts - horizon_days * 24 * 60 * 60
+    active = await active_window_keys()
+
+    expired = []
+    for window_key in await db.list_window_keys():
+        start_ts = window_start_from_key(window_key)
+        if start_ts is None or window_key in active:
+            continue
+        if start_ts < cutoff:
+            expired.append(window_key)
+    return sorted(expired)
+
+
+async def run_retention(horizon_days: int = RETENTION_DAYS) -> dict:
+    """
+    One retention pass. Returns what was removed.
+    """
+    started = time.monotonic()
+    expired = await expired_window_keys(horizon_days)
+    stats_deleted, snaps_deleted = await db.archive_and_delete_windows(expired)
+    jobs_deleted = await db.prune_refresh_jobs(int(time.time()) - REFRESH_JOB_RETENTION_SECONDS)
+    # Memoized slices are only read again while their window is kept
+    slices_deleted = await db.prune_slice_counts(int(time.time()) - horizon_days * 24 * 60 * 60)
+    pages_freed = await db.incremental_vacuum()
+
+    metrics.incr("retention.windows_archived", len(expired))
+    metrics.incr("retention.rows_deleted", stats_deleted + snaps_deleted + jobs_deleted + slices_deleted)
+    metrics.observe("retention.run", time.monotonic() - started)
+
+    return {
+        "windows": len(expired),
+        "account_stats": stats_deleted,
+        "snapshots": snaps_deleted,
+        "refresh_jobs": jobs_deleted,
+        "slice_counts": slices_deleted,
+        "pages_freed": pages_freed,
+    }
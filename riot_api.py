@@ -1,15 +1,33 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
 import aiohttp
 from urllib.parse import quote
 
+import metrics
+import riot_limits
+import speedups
+from riot_limits import PRIORITY_INTERACTIVE, PRIORITY_NAMES
+from singleflight import Singleflight
+
 class RiotNotFound(Exception): ...
 class RiotUnauthorized(Exception): ...
 class RiotRateLimited(Exception):
     def __init__(self, retry_after: int | None = None):
         self.retry_after = retry_after
 
-async def get_puuid_by_riot_id(api_key: str, riot_id: str, region_cluster: str = "europe"):
-    api_key = (api_key or "").strip()
-    if not api_key:
+# /link and /adminlink racing on the same Riot ID share one account-v1 call
+_account_flights = Singleflight("account")
+
+
+async def get_puuid_by_riot_id(
+    riot_id: str,
+    region_cluster: str = "europe",
+    priority: int = PRIORITY_INTERACTIVE,
+):
+    if not riot_limits.has_keys():
         raise RiotUnauthorized()
 
     # riot_id: "GameName#TAG"
@@ -21,20 +39,56 @@ async def get_puuid_by_riot_id(api_key: str, riot_id: str, region_cluster: str =
     tag_line = quote(tag_line.strip(), safe="")
 
     url = f"https://{region_cluster}.api.riotgames.com/riot/account/v1/accounts/by-riot-id/{game_name}/{tag_line}"
-    headers = {"X-Riot-Token": api_key}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as resp:
+    # Riot IDs are case-insensitive. The shared call runs at the most urgent caller's priority.
+    flight_key = (region_cluster.lower(), game_name.lower(), tag_line.lower())
+    return await _account_flights.do(
+        flight_key, lambda session, lane: _get_account(session, url, region_cluster, lane), priority
+    )
+
+
+async def _get_account(
+    session: aiohttp.ClientSession,
+    url: str,
+    region_cluster: str,
+    lane: riot_limits.Lane,
+):
+    while True:
+        try:
+            api_key = await riot_limits.acquire(region_cluster, lane=lane)
+        except riot_limits.NoRiotKeys:
+            raise RiotUnauthorized()
+
+        # Latency of the HTTP call alone; the gate wait is riot.wait.*
+        started = time.monotonic()
+        try:
+            resp = await session.get(url, headers={"X-Riot-Token": api_key})
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            riot_limits.record_failure(region_cluster)
+            raise
+
+        async with resp:
+            priority_name = PRIORITY_NAMES.get(lane.priority, lane.priority)
+            metrics.observe(f"riot.latency.{priority_name}", time.monotonic() - started)
             text = await resp.text()
 
+            if resp.status >= 500:
+                riot_limits.record_failure(region_cluster)
+            elif resp.status not in (401, 403, 429):
+                riot_limits.record_success(region_cluster, api_key)
+
             # ✅ DEBUG: print the real result from Riot
             print(f"[RiotAPI] GET {url} -> {resp.status} | body={text[:200]}")
 
             if resp.status == 200:
-                data = await resp.json()
+                # The body is already read for the debug line: decode that text
+                data = speedups.json_loads(text)
                 return data["puuid"], data["gameName"], data["tagLine"]
 
             if resp.status in (401, 403):
+                # Retry with the next key if this one was taken out of rotation
+                if riot_limits.reject(api_key, resp.status):
+                    continue
                 raise RiotUnauthorized()
 
             if resp.status == 404:
@@ -42,7 +96,7 @@ async def get_puuid_by_riot_id(api_key: str, riot_id: str, region_cluster: str =
 
             if resp.status == 429:
                 ra = resp.headers.get("Retry-After")
+                riot_limits.penalize(region_cluster, api_key, int(ra) if ra and ra.isdigit() else 1)
                 raise RiotRateLimited(int(ra) if ra and ra.isdigit() else None)
 
             resp.raise_for_status()
-
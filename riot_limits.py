@@ -0,0 +1,498 @@
+# riot_limits.py
+"""
+Client-side Riot rate limiting with priority lanes and a pool of API keys.
+
+Every Riot request first takes a token from the gate of its routing region
+(europe / americas / asia / sea). Waiters are served strictly by priority,
+so an interactive /link always gets the next free token while a weekly
+refresh or a bulk backfill waits its turn.
+
+Each API key has its own rate state per region. A granted token names the
+key to use: the usable key with the most remaining budget. A key that gets
+401 Unauthorized is quarantined for a while and skipped, as long as another
+key can take over; a lone key only after several 401s in a row. 403 is a
+per-request error (Riot also returns it for bad paths).
+
+All of this state lives in the process. Two processes on one key would each
+spend its full budget, so stats workers get keys of their own
+(STATS_WORKER_KEYS, use_worker_keys).
+
+Each region also has a circuit breaker: after a run of server errors or
+timeouts it opens and requests fail fast with RiotUnavailable until a probe
+request gets through again.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from bisect import bisect_right
+
+import metrics
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REFRESH = 1
+PRIORITY_BACKFILL = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_REFRESH: "refresh",
+    PRIORITY_BACKFILL: "backfill",
+}
+
+class NoRiotKeys(Exception):
+    """No API key configured, or every key is quarantined."""
+
+
+class RiotUnavailable(Exception):
+    """The region's circuit breaker is open: Riot is failing, don't send anything."""
+
+    def __init__(self, region: str, retry_after: float):
+        super().__init__(f"Riot {region} unavailable, retry in {retry_after:.0f}s")
+        self.region = region
+        self.retry_after = retry_after
+
+
+# API keys: RIOT_API_KEYS (list) in key.py, falling back to the single RIOT_API_KEY
+try:
+    from key import RIOT_API_KEYS
+except Exception:
+    try:
+        from key import RIOT_API_KEY
+        RIOT_API_KEYS = [RIOT_API_KEY]
+    except Exception:
+        RIOT_API_KEYS = []
+
+# Keys reserved for standalone stats workers (stats_worker.py). Rate state is
+# kept per process, so each key must be spent by one process only: the bot
+# leaves these out of its pool and every worker takes its own slot of them.
+try:
+    from key import STATS_WORKER_KEYS
+except Exception:
+    STATS_WORKER_KEYS = []
+
+# How long a key that got 401 is left out of rotation
+KEY_QUARANTINE_SECONDS = 60 * 60
+# 401s in a row before the only usable key is quarantined (one 401 fails just that request)
+KEY_UNAUTHORIZED_STRIKES = 3
+
+# Development key defaults: 20 requests / 1s and 100 requests / 2min.
+# Production keys can override this in key.py as [(count, seconds), ...].
+try:
+    from key import RIOT_RATE_LIMITS
+except Exception:
+    RIOT_RATE_LIMITS = [(20, 1), (100, 120)]
+
+# Tokens per window that background lanes may never take, so a burst of
+# interactive commands still finds budget in the middle of a refresh.
+try:
+    from key import RIOT_INTERACTIVE_RESERVE
+except Exception:
+    RIOT_INTERACTIVE_RESERVE = 2
+
+
+# Circuit breaker: consecutive failures (5xx / timeouts) that open it, and how
+# long it stays open before a single probe request is let through
+try:
+    from key import RIOT_BREAKER_FAILURES
+except Exception:
+    RIOT_BREAKER_FAILURES = 5
+
+try:
+    from key import RIOT_BREAKER_COOLDOWN_SECONDS
+except Exception:
+    RIOT_BREAKER_COOLDOWN_SECONDS = 60
+
+
+class RateBucket:
+    """
+    Sliding-window request log for one rate-limit scope.
+    """
+
+    def __init__(self, limits: list[tuple[int, int]]):
+        self.limits = [(int(n), float(per)) for n, per in limits]
+        self._horizon = max(per for _, per in self.limits)
+        self._stamps: list[float] = []
+        self._blocked_until = 0.0
+
+    def _prune(self, now: float) -> None:
+        cut = bisect_right(self._stamps, now - self._horizon)
+        if cut:
+            del self._stamps[:cut]
+
+    def _in_window(self, now: float, per: float) -> int:
+        return len(self._stamps) - bisect_right(self._stamps, now - per)
+
+    def remaining(self, now: float | None = None) -> int:
+        now = time.monotonic() if now is None else now
+        if now < self._blocked_until:
+            return 0
+        self._prune(now)
+        return min(n - self._in_window(now, per) for n, per in self.limits)
+
+    def wait_time(self, now: float | None = None, reserve: int = 0) -> float:
+        """
+        Seconds until a request may be sent while leaving `reserve` tokens untouched.
+        """
+        now = time.monotonic() if now is None else now
+        self._prune(now)
+
+        wait = max(0.0, self._blocked_until - now)
+        for n, per in self.limits:
+            allowed = max(1, n - reserve)
+            if self._in_window(now, per) >= allowed:
+                # the request that has to age out is the `allowed`-th most recent one
+                wait = max(wait, self._stamps[-allowed] + per - now)
+        return wait
+
+    def free_fraction(self, now: float | None = None) -> float:
+        """
+        Share of the tightest limit still unused, 0.0 - 1.0.
+        """
+        now = time.monotonic() if now is None else now
+        if now < self._blocked_until:
+            return 0.0
+        self._prune(now)
+        return min((n - self._in_window(now, per)) / n for n, per in self.limits)
+
+    def take(self, now: float | None = None) -> None:
+        self._stamps.append(time.monotonic() if now is None else now)
+
+    def block_for(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class RiotKey:
+    """
+    One API key and its rate state in every region it has been used in.
+    """
+
+    def __init__(self, key: str, limits: list[tuple[int, int]]):
+        self.key = key
+        self.label = f"...{key[-4:]}"
+        self.limits = limits
+        self.buckets: dict[str, RateBucket] = {}
+        self.quarantined_until = 0.0
+        self.strikes = 0  # 401s in a row
+
+    def bucket(self, region: str) -> RateBucket:
+        b = self.buckets.get(region)
+        if b is None:
+            b = self.buckets[region] = RateBucket(self.limits)
+        return b
+
+    def usable(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+
+class Lane:
+    """
+    The priority of a request that several callers wait for (a coalesced
+    flight). raise_to() lets a more urgent caller move it ahead, also while it
+    is already queued in a gate.
+    """
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self._queued: tuple["PriorityGate", asyncio.Future] | None = None
+
+    def raise_to(self, priority: int) -> None:
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        if self._queued is not None:
+            gate, fut = self._queued
+            gate._promote(fut, priority)
+
+
+class PriorityGate:
+    """
+    Hands out tokens for one region, lowest priority value first.
+    The token is the key with the most remaining budget in that region.
+    """
+
+    def __init__(self, name: str, keys: list[RiotKey], reserve: int = 0):
+        self.name = name
+        self.keys = keys
+        self.reserve = reserve
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+        self._arrived = asyncio.Event()  # set by acquire(): the dispatcher re-checks the head
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, lane: Lane | None = None) -> str:
+        if lane is not None:
+            priority = lane.priority
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._arrived.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        started = time.monotonic()
+        if lane is not None:
+            lane._queued = (self, fut)
+        try:
+            key = await fut
+        finally:
+            if lane is not None:
+                lane._queued = None
+                priority = lane.priority
+        metrics.observe(f"riot.wait.{PRIORITY_NAMES.get(priority, priority)}", time.monotonic() - started)
+        return key
+
+    def _promote(self, fut: asyncio.Future, priority: int) -> None:
+        for i, (p, seq, f) in enumerate(self._waiters):
+            if f is fut:
+                if priority < p:
+                    self._waiters[i] = (priority, seq, f)
+                    heapq.heapify(self._waiters)
+                    self._arrived.set()
+                return
+
+    def _pick(self, reserve: int) -> tuple[RiotKey | None, float]:
+        """
+        Returns (key ready now with the most budget, 0) or (None, seconds until one is ready).
+        The wait is infinite when every key is quarantined.
+        """
+        now = time.monotonic()
+        best: RiotKey | None = None
+        best_remaining = -1
+        soonest = float("inf")
+
+        for k in self.keys:
+            if not k.usable(now):
+                continue
+            b = k.bucket(self.name)
+            wait = b.wait_time(now, reserve=reserve)
+            if wait > 0:
+                soonest = min(soonest, wait)
+                continue
+            remaining = b.remaining(now)
+            if remaining > best_remaining:
+                best, best_remaining = k, remaining
+
+        return best, (0.0 if best else soonest)
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            priority, _, fut = self._waiters[0]
+            if fut.done():  # waiter was cancelled
+                heapq.heappop(self._waiters)
+                continue
+
+            reserve = 0 if priority == PRIORITY_INTERACTIVE else self.reserve
+            key, wait = self._pick(reserve)
+
+            if key is None and wait == float("inf"):
+                # Every key is quarantined: fail everyone waiting instead of hanging
+                while self._waiters:
+                    _, _, f = heapq.heappop(self._waiters)
+                    if not f.done():
+                        f.set_exception(NoRiotKeys())
+                return
+
+            if key is None:
+                # Sleep until budget frees up, but wake as soon as anyone new queues:
+                # an interactive waiter may be served from the reserve right away
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._waiters)
+            key.bucket(self.name).take()
+            metrics.incr(f"riot.key.{key.label}.requests")
+            fut.set_result(key.key)
+
+
+class CircuitBreaker:
+    """
+    Closed: everything passes. Open (after `threshold` consecutive failures):
+    nothing passes for `cooldown` seconds. Half-open: one probe at a time;
+    its success closes the breaker, its failure re-opens it.
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._probe_until = 0.0  # a probe that never reports back frees its slot after cooldown
+
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def check(self) -> None:
+        """
+        Raises RiotUnavailable unless a request may be sent now.
+        """
+        if not self.is_open():
+            return
+        now = time.monotonic()
+        if now < self.open_until:
+            raise RiotUnavailable(self.name, self.open_until - now)
+        if now < self._probe_until:
+            raise RiotUnavailable(self.name, self._probe_until - now)
+        self._probe_until = now + self.cooldown
+
+    def record_success(self) -> None:
+        if self.is_open():
+            print(f"[RiotBreaker] {self.name} closed again")
+        self.failures = 0
+        self._probe_until = 0.0
+
+    def record_failure(self) -> None:
+        was_open = self.is_open()
+        self.failures += 1
+        self._probe_until = 0.0
+        if self.is_open():
+            self.open_until = time.monotonic() + self.cooldown
+            if not was_open:
+                metrics.incr(f"riot.breaker.{self.name}.opened")
+                print(f"[RiotBreaker] {self.name} open after {self.failures} failures — pausing {self.cooldown:.0f}s")
+
+
+def _key_pool(keys: list[str]) -> dict[str, RiotKey]:
+    return {k.strip(): RiotKey(k.strip(), RIOT_RATE_LIMITS) for k in keys if k and k.strip()}
+
+
+_worker_keys = {k.strip() for k in STATS_WORKER_KEYS if k and k.strip()}
+_keys: dict[str, RiotKey] = _key_pool([k for k in RIOT_API_KEYS if k and k.strip() not in _worker_keys])
+_gates: dict[str, PriorityGate] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def use_worker_keys(slot: int, slots: int) -> list[str]:
+    """
+    Switches this process to its share of STATS_WORKER_KEYS: every `slots`-th
+    key starting at `slot`. Call before the first request. Returns the keys.
+    """
+    keys = [k.strip() for k in STATS_WORKER_KEYS if k and k.strip()][slot::slots]
+    global _keys
+    _keys = _key_pool(keys)
+    _gates.clear()
+    return keys
+
+
+def has_keys() -> bool:
+    return bool(_keys)
+
+
+def usable_key_count() -> int:
+    now = time.monotonic()
+    return sum(1 for k in _keys.values() if k.usable(now))
+
+
+def region_worker_count(region: str, per_key: int) -> int:
+    """
+    Worker pool size for one routing region: `per_key` workers for every key
+    that currently has budget there (not quarantined, not blocked by a 429).
+    """
+    now = time.monotonic()
+    ready = sum(
+        1 for k in _keys.values()
+        if k.usable(now) and k.bucket(region.lower()).remaining(now) > 0
+    )
+    return per_key * max(1, ready)
+
+
+def has_spare(region: str, share: float) -> bool:
+    """
+    True when nobody is waiting for `region` and some usable key has more than
+    `share` of every rate-limit window unused. For work that should only ever
+    use budget nothing else wants.
+    """
+    region = region.lower()
+    gate = _gates.get(region)
+    if gate is not None and gate._waiters:
+        return False
+    now = time.monotonic()
+    return any(k.usable(now) and k.bucket(region).free_fraction(now) > share for k in _keys.values())
+
+
+def sustained_rate() -> float:
+    """
+    Requests per second one region can sustain over time with every usable key
+    (the tightest configured limit; bursts above it are not sustainable).
+    """
+    per_key = min(n / per for n, per in RIOT_RATE_LIMITS)
+    return per_key * max(1, usable_key_count())
+
+
+def gate_for(region: str) -> PriorityGate:
+    region = region.lower()
+    gate = _gates.get(region)
+    if gate is None:
+        gate = _gates[region] = PriorityGate(region, list(_keys.values()), RIOT_INTERACTIVE_RESERVE)
+    return gate
+
+
+def breaker_for(region: str) -> CircuitBreaker:
+    region = region.lower()
+    breaker = _breakers.get(region)
+    if breaker is None:
+        breaker = _breakers[region] = CircuitBreaker(region, RIOT_BREAKER_FAILURES, RIOT_BREAKER_COOLDOWN_SECONDS)
+    return breaker
+
+
+def record_success(region: str, key: str | None = None) -> None:
+    breaker_for(region).record_success()
+    k = _keys.get(key) if key else None
+    if k is not None:
+        k.strikes = 0
+
+
+def record_failure(region: str) -> None:
+    # A 5xx or a timeout from Riot (not 429/404: those are Riot working as intended)
+    breaker_for(region).record_failure()
+
+
+async def acquire(region: str, priority: int = PRIORITY_INTERACTIVE, lane: Lane | None = None) -> str:
+    """
+    Waits for budget in `region` and returns the API key to send the request with.
+    With a lane, its priority (which may rise while waiting) replaces `priority`.
+    Raises NoRiotKeys when no key is configured or all are quarantined, and
+    RiotUnavailable while the region's circuit breaker is open.
+    """
+    if not _keys:
+        raise NoRiotKeys()
+    breaker_for(region).check()
+    return await gate_for(region).acquire(priority, lane)
+
+
+def penalize(region: str, key: str, retry_after: float) -> None:
+    # Riot told us to back off (429): this key sends nothing in this region until then
+    k = _keys.get(key)
+    if k is not None:
+        k.bucket(region.lower()).block_for(retry_after)
+
+
+def reject(key: str, status: int) -> bool:
+    """
+    Riot answered 401/403 to a request sent with `key`. Returns True when the
+    key was quarantined and the request should be retried with another one;
+    False means only this request fails.
+    """
+    k = _keys.get(key)
+    if k is None or status != 401:
+        return False
+    k.strikes += 1
+    if usable_key_count() > 1 or k.strikes >= KEY_UNAUTHORIZED_STRIKES:
+        quarantine(key)
+        return True
+    return False
+
+
+def quarantine(key: str) -> None:
+    k = _keys.get(key)
+    if k is None:
+        return
+    k.strikes = 0
+    k.quarantined_until = time.monotonic() + KEY_QUARANTINE_SECONDS
+    metrics.incr("riot.key_quarantined")
+    print(f"[RiotKeys] key {k.label} rejected by Riot — quarantined for {KEY_QUARANTINE_SECONDS}s")
@@ -0,0 +1,40 @@
+# shards.py
+"""
+Shard configuration and helpers.
+
+Set SHARD_COUNT (and optionally SHARD_IDS) in key.py to run the bot sharded.
+Several processes can share one DB: give each the same SHARD_COUNT and a
+disjoint SHARD_IDS list, and each only schedules guilds on its own shards.
+Without SHARD_COUNT the bot runs unsharded and owns every guild.
+"""
+from __future__ import annotations
+
+try:
+    from key import SHARD_COUNT
+except Exception:
+    SHARD_COUNT = None
+
+try:
+    from key import SHARD_IDS
+except Exception:
+    SHARD_IDS = None
+
+
+def shard_id_for(guild_id: int, shard_count: int | None = None) -> int:
+    # Discord's sharding formula
+    count = shard_count or SHARD_COUNT or 1
+    return (int(guild_id) >> 22) % count
+
+
+def owned_shard_ids() -> list[int] | None:
+    """
+    Shards this process is responsible for, or None when it owns everything.
+    """
+    if not SHARD_COUNT or SHARD_IDS is None:
+        return None
+    return list(SHARD_IDS)
+
+
+def owns_guild(guild_id: int) -> bool:
+    owned = owned_shard_ids()
+    return owned is None or shard_id_for(guild_id) in owned
@@ -0,0 +1,83 @@
+# singleflight.py
+"""
+Request coalescing: concurrent calls with the same key share one execution.
+
+The first caller for a key starts the work as a task; callers that arrive
+while it is in flight await the same task and get the same result (or
+exception). Nothing is cached once the task finishes.
+
+The work belongs to the flight, not to the caller that happened to start it:
+it sends on this module's HTTP session (a caller closing its own session, or
+being cancelled, cannot break it for the others) and at the most urgent
+priority of everyone waiting for it (riot_limits.Lane).
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+import aiohttp
+
+import metrics
+from riot_limits import Lane
+
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+
+
+def http_session() -> aiohttp.ClientSession:
+    """
+    The session flights send their requests on, opened on first use in the running loop.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(timeout=HTTP_TIMEOUT)
+        _session_loop = loop
+    return _session
+
+
+async def close_http_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class Singleflight:
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[Hashable, tuple[asyncio.Task, Lane]] = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        flight = self._inflight.get(key)
+        if flight is not None and flight[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller was cancelled
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[aiohttp.ClientSession, Lane], Awaitable[Any]],
+        priority: int,
+    ) -> Any:
+        """
+        Runs fn(session, lane) once for everyone asking for `key` at the same time.
+        """
+        flight = self._inflight.get(key)
+        if flight is None:
+            lane = Lane(priority)
+            task = asyncio.create_task(fn(http_session(), lane))
+            self._inflight[key] = (task, lane)
+            task.add_done_callback(lambda t: self._forget(key, t))
+            metrics.incr(f"riot.calls.{self.name}")
+        else:
+            task, lane = flight
+            lane.raise_to(priority)
+            metrics.incr(f"riot.coalesced.{self.name}")
+
+        # A caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(task)
@@ -0,0 +1,54 @@
+# speedups.py
+"""
+Optional fast paths, both off unless enabled in key.py:
+
+    FAST_JSON = True        # decode Riot responses with orjson
+    FAST_EVENT_LOOP = True  # run the bot and workers on uvloop
+
+A missing package only logs a note and falls back to the standard library,
+so the same key.py works on hosts with or without the extras installed.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any, Callable, Coroutine
+
+try:
+    from key import FAST_JSON
+except Exception:
+    FAST_JSON = False
+
+try:
+    from key import FAST_EVENT_LOOP
+except Exception:
+    FAST_EVENT_LOOP = False
+
+
+def _pick_json() -> tuple[str, Callable[[str | bytes], Any]]:
+    if FAST_JSON:
+        try:
+            import orjson
+            return "orjson", orjson.loads
+        except ImportError:
+            print("[Speedups] FAST_JSON is set but orjson is not installed — using json")
+    return "json", json.loads
+
+
+# For aiohttp: `await resp.json(loads=json_loads)`
+JSON_BACKEND, json_loads = _pick_json()
+
+
+def run(main: Coroutine) -> Any:
+    """
+    asyncio.run(main), on uvloop when FAST_EVENT_LOOP is set and it is installed.
+    """
+    if FAST_EVENT_LOOP:
+        try:
+            import uvloop
+        except ImportError:
+            print("[Speedups] FAST_EVENT_LOOP is set but uvloop is not installed — using asyncio")
+        else:
+            print("[Speedups] event loop: uvloop")
+            return uvloop.run(main)
+    return asyncio.run(main)
@@ -1,47 +1,392 @@
 # stats_update.py
 import asyncio
-from typing import List, Tuple
+import json
+import random
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
 
 import aiohttp
+import activity
 import db
-from match_counts import count_lol_matches_since_filtered, DEFAULT_TIMEOUT
+import guild_cache
+import metrics
+import profiling
+from progress import RefreshProgress, current as progress_ctx
+import trickle
+from match_counts import count_lol_matches_in_window, DAY_CLOSE_GRACE_SECONDS, REGIONAL
+import riot_limits
+from riot_limits import PRIORITY_BACKFILL, PRIORITY_REFRESH
+
+# "inline": count in the bot process. "external": enqueue refresh_jobs rows and
+# let `python -m stats_worker` processes (sharing the DB file) do the counting,
+# each on its own STATS_WORKER_KEYS (see stats_worker.py).
+try:
+    from key import STATS_WORKER_MODE
+except Exception:
+    STATS_WORKER_MODE = "inline"
+
+JOB_POLL_SECONDS = 2.0
+# External mode: a job no worker claimed for this long, or whose worker stopped
+# heartbeating for this long (stats_worker requeues stale jobs after 5 minutes,
+# so a live worker gets it first), is counted inline instead.
+JOB_CLAIM_TIMEOUT_SECONDS = 2 * 60
+JOB_STALE_SECONDS = 10 * 60
+
+# Per account: attempts on transient errors (5xx, timeouts, connection drops),
+# with full-jitter exponential backoff starting from RETRY_BASE_SECONDS
+ACCOUNT_MAX_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 2.0
+
+
+@dataclass
+class RefreshResult:
+    """
+    Outcome of a stats update. One account failing never discards the others:
+    the board renders from `succeeded` plus the older counts of the rest.
+    """
+    succeeded: List[int] = field(default_factory=list)  # account ids counted and stored
+    failed: Dict[int, str] = field(default_factory=dict)  # account id -> last error
+    skipped: List[int] = field(default_factory=list)  # final, fresh, idle, or region breaker open
+    calls_saved: int = 0  # estimated Riot requests avoided by skipping idle accounts
+
+    @property
+    def total(self) -> int:
+        return len(self.succeeded) + len(self.failed) + len(self.skipped)
+
+    def summary(self) -> str:
+        text = f"{len(self.succeeded)} updated, {len(self.failed)} failed, {len(self.skipped)} skipped"
+        if self.calls_saved:
+            text += f" (~{self.calls_saved} Riot calls saved)"
+        return text
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, text: str) -> "RefreshResult":
+        data = json.loads(text)
+        return cls(
+            succeeded=list(data.get("succeeded", [])),
+            failed={int(k): v for k, v in data.get("failed", {}).items()},
+            skipped=list(data.get("skipped", [])),
+            calls_saved=int(data.get("calls_saved", 0)),
+        )
+
+
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
 
 
 async def update_stats_for_guild(
     guild,
-    riot_api_key: str,
     window_key: str,
     window_start_ts: int,
     queue_policy: str = "all",
-    max_concurrency: int = 2,
-) -> int:
-    member_ids = [str(m.id) for m in guild.members]
+    max_concurrency: int = 2,  # workers per API key, per routing region
+    priority: int = PRIORITY_REFRESH,
+    progress: RefreshProgress | None = None,
+    fresh_since: int | None = None,
+) -> RefreshResult:
+    """
+    Counts the guild's linked accounts for the window. Accounts whose count was
+    stored at or after fresh_since (e.g. by the scheduler's pre-warm) are
+    skipped, and so are accounts the trickle refresh just counted.
+    """
+    member_ids = await guild_cache.member_ids(guild)
+    accounts: List[Tuple[int, str, str]] = await db.list_accounts_for_users(member_ids)
+    linked = len(accounts)
+
+    # Accounts counted recently enough are current already
+    if trickle.TRICKLE_REFRESH:
+        trickle_since = int(time.time()) - trickle.TRICKLE_FRESH_SECONDS
+        fresh_since = trickle_since if fresh_since is None else min(fresh_since, trickle_since)
+    fresh_ids: set = set()
+    if fresh_since is not None and accounts:
+        fresh_ids = await db.list_fresh_account_ids(
+            window_key, [a[0] for a in accounts], fresh_since, window_start_ts
+        )
+        accounts = [a for a in accounts if a[0] not in fresh_ids]
+
+    if not accounts:
+        return RefreshResult(skipped=sorted(fresh_ids))
+
+    progress = progress or RefreshProgress()
+    result = None
+    if STATS_WORKER_MODE == "external":
+        result = await _run_as_job(guild.id, accounts, window_key, window_start_ts, queue_policy, priority, progress)
+    if result is None:
+        result = await update_stats_for_accounts(
+            accounts,
+            window_key=window_key,
+            window_start_ts=window_start_ts,
+            queue_policy=queue_policy,
+            max_concurrency=max_concurrency,
+            priority=priority,
+            progress=progress,
+        )
+    # Cost history for the scheduler's pre-warm planner. Scaled up to every linked
+    # account: runs that skip most of them (after a pre-warm, trickle, idle
+    # accounts) would otherwise pull the estimate far below a full refresh.
+    counted = len(result.succeeded) + len(result.failed)
+    if counted:
+        with profiling.span("db.cost"):
+            await db.record_refresh_cost(guild.id, round(progress.requests * linked / counted))
+
+    result.skipped.extend(sorted(fresh_ids))
+
+    # New counts: any cached ranking for this guild is out of date
+    guild_cache.invalidate_board(guild.id)
+    return result
+
+
+async def finalize_window_for_guild(
+    guild,
+    window_key: str,
+    window_start_ts: int,
+    window_end_ts: int,
+    queue_policy: str = "all",
+    priority: int = PRIORITY_BACKFILL,
+) -> tuple[RefreshResult, bool]:
+    """
+    Makes the counts of a closed window final for the guild's accounts. Accounts
+    that are final already are skipped, so a finalized window costs no Riot calls.
+    Always inline: the histogram and slice memo make this mostly DB work.
+    Returns the result and whether every account's count is final now.
+    """
+    member_ids = await guild_cache.member_ids(guild)
     accounts: List[Tuple[int, str, str]] = await db.list_accounts_for_users(member_ids)
+
+    result = await update_stats_for_accounts(
+        accounts,
+        window_key=window_key,
+        window_start_ts=window_start_ts,
+        queue_policy=queue_policy,
+        priority=priority,
+        window_end_ts=window_end_ts,
+    )
+    if result.succeeded:
+        guild_cache.invalidate_board(guild.id)
+
+    # Accounts skipped for an open circuit breaker are still provisional
+    final_ids = await db.list_final_account_ids(window_key, [a[0] for a in accounts]) if accounts else set()
+    return result, len(final_ids) == len(accounts)
+
+
+async def _run_as_job(
+    guild_id: int,
+    accounts: List[Tuple[int, str, str]],
+    window_key: str,
+    window_start_ts: int,
+    queue_policy: str,
+    priority: int,
+    progress: RefreshProgress,
+) -> RefreshResult | None:
+    """
+    Hands the accounts to a stats worker and waits, mirroring the worker's
+    progress (from its heartbeats) into `progress`. Cancelling the caller
+    cancels the job. Returns None when no worker claimed the job in time or its
+    worker went silent: the caller counts inline instead.
+    """
+    job_id = await db.enqueue_refresh_job(
+        guild_id, window_key, window_start_ts, queue_policy, [a[0] for a in accounts], priority
+    )
+    print(f"[Stats] Guild {guild_id}: queued job {job_id} for {len(accounts)} accounts")
+    progress.total = len(accounts)
+
+    started = time.monotonic()
+    queued_since = started  # reset when a worker holds it: stale jobs are requeued
+    try:
+        while True:
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            job = await db.get_refresh_job(job_id)
+            if job is None:
+                raise RuntimeError(f"refresh job {job_id} disappeared")
+            progress.done = job["done_accounts"]
+            progress.requests = job["requests"]
+
+            if job["status"] == "done":
+                print(f"[Stats] Guild {guild_id}: job {job_id} done in {time.monotonic() - started:.0f}s")
+                result = RefreshResult.from_json(job["result_json"] or "{}")
+                progress.done = result.total
+                return result
+            if job["status"] in ("failed", "cancelled"):
+                raise RuntimeError(f"refresh job {job_id} {job['status']}: {job['error'] or 'no reason given'}")
+
+            if job["status"] == "queued":
+                if time.monotonic() - queued_since < JOB_CLAIM_TIMEOUT_SECONDS:
+                    continue
+                reason = f"no stats worker claimed it within {JOB_CLAIM_TIMEOUT_SECONDS}s"
+                stale_before = None
+            else:
+                queued_since = time.monotonic()
+                if (job["heartbeat_at"] or 0) >= int(time.time()) - JOB_STALE_SECONDS:
+                    continue
+                reason = f"its stats worker stopped heartbeating for {JOB_STALE_SECONDS}s"
+                stale_before = int(time.time()) - JOB_STALE_SECONDS
+
+            if await db.abandon_refresh_job(job_id, f"counted inline: {reason}", stale_before):
+                print(f"[Stats] Guild {guild_id}: job {job_id} {reason} — counting inline")
+                metrics.incr("stats.jobs_abandoned")
+                progress.done = progress.requests = 0
+                return None
+    except asyncio.CancelledError:
+        await db.cancel_refresh_job(job_id)
+        raise
+
+
+async def update_stats_for_accounts(
+    accounts: List[Tuple[int, str, str]],
+    window_key: str,
+    window_start_ts: int,
+    queue_policy: str = "all",
+    max_concurrency: int = 2,  # workers per API key, per routing region
+    priority: int = PRIORITY_REFRESH,
+    window_end_ts: int | None = None,
+    progress: RefreshProgress | None = None,
+) -> RefreshResult:
+    """
+    Counts games for (account_id, puuid, platform) rows and stores them under window_key.
+    With window_end_ts for a window that has closed, the counts are stored as final
+    and accounts that already have a final count are skipped.
+
+    Every account is isolated: transient Riot errors are retried a few times with
+    jittered backoff, then the account is recorded as failed and the rest go on.
+    Accounts in a region whose circuit breaker is open are skipped, and so are
+    quiet accounts whose stored count is recent enough (activity.py).
+    `progress`, when given, is kept up to date while the run goes.
+    """
+    result = RefreshResult()
+    progress = progress or RefreshProgress()
+    progress.total = len(accounts)
+    now_ts = int(time.time())
+
+    closed = window_end_ts is not None and window_end_ts + DAY_CLOSE_GRACE_SECONDS <= now_ts
+    if closed:
+        with profiling.span("db.plan"):
+            final_ids = await db.list_final_account_ids(window_key, [a[0] for a in accounts])
+        result.skipped.extend(a[0] for a in accounts if a[0] in final_ids)
+        accounts = [a for a in accounts if a[0] not in final_ids]
+        progress.done += len(result.skipped)
+
+    # Activity tracking (open windows only: a closed window must be exact)
+    stats_rows: Dict[int, Tuple[int, int]] = {}
+    activity_rows: Dict[int, dict] = {}
+    idle_skipped = 0
+    if not closed and accounts:
+        ids = [a[0] for a in accounts]
+        with profiling.span("db.plan"):
+            stats_rows = await db.get_account_stats_rows(window_key, ids)
+            activity_rows = await db.get_account_activity(ids)
+
+        if activity.ADAPTIVE_POLLING:
+            polled = []
+            for account in accounts:
+                row = stats_rows.get(account[0])
+                if activity.should_poll(activity_rows.get(account[0]), row[1] if row else None, now_ts):
+                    polled.append(account)
+                else:
+                    result.skipped.append(account[0])
+            idle_skipped = len(accounts) - len(polled)
+            accounts = polled
+            progress.done += idle_skipped
+
     if not accounts:
-        return 0
+        if idle_skipped:
+            # Nothing counted to learn the cost from: at least one request each
+            result.calls_saved = idle_skipped
+            metrics.incr("riot.calls_saved", idle_skipped)
+        return result
+
+    # Riot budgets are per routing region, so each region gets its own worker pool:
+    # a long EUW queue never holds back NA/KR accounts.
+    by_region: dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
+    for account in accounts:
+        region = REGIONAL.get((account[2] or "").upper(), "unknown")
+        by_region[region].put_nowait(account)
 
-    sem = asyncio.Semaphore(max_concurrency)
+    async def update_one(account_id: int, puuid: str, platform: str):
+        with profiling.span("db.label"):
+            label = await db.get_account_label(account_id)
+        print(f"[Stats] Counting for {label} | policy={queue_policy} | window_key={window_key}")
 
-    async with aiohttp.ClientSession(timeout=DEFAULT_TIMEOUT) as session:
+        with profiling.span("count"):
+            games = await count_lol_matches_in_window(
+                account_id=account_id,
+                puuid=puuid,
+                platform=platform,
+                start_time_ts=window_start_ts,
+                queue_policy=queue_policy,
+                debug=True,  # keep while testing
+                priority=priority,
+                end_time_ts=window_end_ts,
+            )
+        print(f"[Stats] DONE {label} -> games={games}")
 
-        async def update_one(account_id: int, puuid: str, platform: str):
-            async with sem:
-                label = await db.get_account_label(account_id)
-                print(f"[Stats] Counting for {label} | policy={queue_policy} | window_key={window_key}")
+        with profiling.span("db.store"):
+            await db.upsert_account_stats(account_id, window_key, games, final=closed)
 
-                games = await count_lol_matches_since_filtered(
-                    api_key=riot_api_key,
-                    puuid=puuid,
-                    platform=platform,
-                    start_time_ts=window_start_ts,
-                    queue_policy=queue_policy,
-                    session=session,
-                    debug=True,  # keep while testing
+            if not closed:
+                prev_games, prev_updated = stats_rows.get(account_id, (None, None))
+                last_new, per_day, first_seen = activity.observe(
+                    activity_rows.get(account_id), prev_games, prev_updated, games, int(time.time())
                 )
-                print(f"[Stats] DONE {label} -> games={games}")
+                await db.upsert_account_activity(account_id, last_new, per_day, first_seen)
+
+    async def update_isolated(account_id: int, puuid: str, platform: str):
+        for attempt in range(ACCOUNT_MAX_ATTEMPTS):
+            try:
+                await update_one(account_id, puuid, platform)
+                result.succeeded.append(account_id)
+                return
+            except riot_limits.RiotUnavailable:
+                result.skipped.append(account_id)
+                return
+            except riot_limits.NoRiotKeys:
+                result.failed[account_id] = "no usable Riot API key"
+                return
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if not _is_transient(e) or attempt + 1 == ACCOUNT_MAX_ATTEMPTS:
+                    print(f"[Stats] FAILED account_id={account_id} after {attempt + 1} attempt(s): {error}")
+                    result.failed[account_id] = error
+                    return
+                delay = random.uniform(0, RETRY_BASE_SECONDS * 2 ** attempt)
+                print(f"[Stats] account_id={account_id} {error} — retry in {delay:.1f}s")
+                with profiling.span("retry.backoff"):
+                    await asyncio.sleep(delay)
+
+    async def region_worker(queue: asyncio.Queue):
+        while not queue.empty():
+            account_id, puuid, platform = queue.get_nowait()
+            await update_isolated(account_id, puuid, platform)
+            progress.done += 1
+
+    workers = []
+    for region, queue in by_region.items():
+        n = min(queue.qsize(), riot_limits.region_worker_count(region, max_concurrency))
+        print(f"[Stats] region={region} accounts={queue.qsize()} workers={n}")
+        workers += [region_worker(queue) for _ in range(n)]
 
-                await db.upsert_account_stats(account_id, window_key, games)
+    # Workers inherit the context, so Riot requests count towards this run
+    token = progress_ctx.set(progress)
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        progress_ctx.reset(token)
 
-        await asyncio.gather(*(update_one(a, p, plat) for a, p, plat in accounts))
+    if idle_skipped:
+        # Skipped accounts would have cost what the counted ones did on average
+        polled = len(accounts)
+        per_account = progress.requests / polled if polled and progress.requests else 1.0
+        result.calls_saved = round(idle_skipped * per_account)
+        metrics.incr("riot.calls_saved", result.calls_saved)
 
-    return len(accounts)
+    metrics.incr("stats.accounts_failed", len(result.failed))
+    metrics.incr("stats.accounts_skipped", len(result.skipped))
+    if result.failed or result.skipped:
+        print(f"[Stats] window_key={window_key}: {result.summary()}")
+    return result
@@ -0,0 +1,120 @@
+# stats_worker.py
+"""
+Standalone stats worker.
+
+    python -m stats_worker [--jobs N] [--worker-id NAME] [--slot I --slots N]
+
+Claims refresh_jobs rows queued by the bot (STATS_WORKER_MODE = "external" in
+key.py), counts the listed accounts against Riot and writes account_stats.
+The bot only renders and posts. Workers can run on this host or any other
+host that shares the database file.
+
+Riot rate limits are tracked per process, so a worker never shares a key: it
+uses only STATS_WORKER_KEYS from key.py, which the bot leaves alone. With N
+workers, start each with its own --slot 0..N-1 and --slots N; worker I gets
+every Nth of those keys starting at I. More workers than keys is refused.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import socket
+import traceback
+
+import db
+from progress import RefreshProgress
+import riot_limits
+import singleflight
+import speedups
+from stats_update import update_stats_for_accounts
+
+IDLE_POLL_SECONDS = 2.0
+# Also how often progress reaches the bot and a cancel from the bot is noticed
+HEARTBEAT_SECONDS = 5
+# A running job whose worker has not heartbeated for this long is handed to another worker
+STALE_JOB_SECONDS = 5 * 60
+
+
+async def _heartbeat(job_id: int, progress: RefreshProgress, run: asyncio.Task) -> None:
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        if await db.heartbeat_refresh_job(job_id, progress.done, progress.requests):
+            print(f"[Worker] job {job_id}: cancel requested by the bot")
+            run.cancel()
+            return
+
+
+async def _run_job(job: dict) -> None:
+    job_id = job["id"]
+    accounts = await db.list_accounts_by_ids(job["account_ids"])
+    print(f"[Worker] job {job_id}: guild={job['guild_id']} accounts={len(accounts)} window_key={job['window_key']}")
+
+    progress = RefreshProgress()
+    run = asyncio.create_task(
+        update_stats_for_accounts(
+            accounts,
+            window_key=job["window_key"],
+            window_start_ts=job["window_start_ts"],
+            queue_policy=job["queue_policy"],
+            max_concurrency=2,
+            priority=job["priority"],
+            progress=progress,
+        )
+    )
+    beat = asyncio.create_task(_heartbeat(job_id, progress, run))
+    try:
+        result = await run
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise  # the worker itself is shutting down
+        # Counts stored before the cancel are kept, like an inline cancel
+        await db.finish_refresh_job(job_id, None, requests=progress.requests, cancelled=True)
+        print(f"[Worker] job {job_id}: cancelled after {progress.done}/{progress.total} accounts")
+        return
+    except Exception as e:
+        print(f"[Worker] job {job_id} failed:\n{traceback.format_exc()}")
+        await db.finish_refresh_job(job_id, None, error=str(e) or type(e).__name__, requests=progress.requests)
+        return
+    finally:
+        beat.cancel()
+
+    await db.finish_refresh_job(job_id, len(result.succeeded), result.to_json(), requests=progress.requests)
+    print(f"[Worker] job {job_id}: done, {result.summary()}")
+
+
+async def _job_loop(worker_id: str) -> None:
+    while True:
+        job = await db.claim_refresh_job(worker_id, STALE_JOB_SECONDS)
+        if job is None:
+            await asyncio.sleep(IDLE_POLL_SECONDS)
+            continue
+        await _run_job(job)
+
+
+async def main(jobs: int, worker_id: str, slot: int, slots: int) -> None:
+    if not 0 <= slot < slots:
+        raise SystemExit(f"--slot must be between 0 and {slots - 1}")
+    keys = riot_limits.use_worker_keys(slot, slots)
+    if not keys:
+        raise SystemExit(
+            f"No Riot API key for slot {slot}/{slots}: list one key per worker in STATS_WORKER_KEYS in key.py"
+        )
+
+    await db.init_db()
+    print(f"[Worker] {worker_id} started with {jobs} job slot(s), key slot {slot}/{slots} ({len(keys)} key(s))")
+    try:
+        await asyncio.gather(*(_job_loop(f"{worker_id}/{i}") for i in range(jobs)))
+    finally:
+        await singleflight.close_http_session()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rito Ranker stats worker")
+    parser.add_argument("--jobs", type=int, default=1, help="refresh jobs to run at the same time")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}")
+    parser.add_argument("--slot", type=int, default=0, help="this worker's share of STATS_WORKER_KEYS")
+    parser.add_argument("--slots", type=int, default=1, help="number of workers sharing STATS_WORKER_KEYS")
+    args = parser.parse_args()
+
+    speedups.run(main(args.jobs, args.worker_id, args.slot, args.slots))
@@ -0,0 +1,23 @@
+# tests/conftest.py
+from __future__ import annotations
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    """A fresh schema in a throwaway DB, like benchmarks/bench_retention.py uses."""
+    monkeypatch.setattr(db, "DB_DIR", tmp_path)
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.sqlite3")
+    monkeypatch.setattr(db, "SCHEMA_PATH", ROOT / "db" / "schema.sql")
+    asyncio.run(db.init_db())
+    return db.DB_PATH
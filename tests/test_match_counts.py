@@ -0,0 +1,194 @@
+# tests/test_match_counts.py
+"""
+Match-V5 request counts of the window counter against a fake Riot that serves
+ids from a fixed list of match timestamps.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import aiosqlite
+import pytest
+
+import db
+import match_counts
+import metrics
+import riot_limits
+import singleflight
+from match_counts import DAY_SECONDS, PAGE_SIZE
+
+ACCOUNT_ID = 1
+PUUID = "puuid-test"
+
+
+class _Resp:
+    status = 200
+    headers: dict = {}
+
+    def __init__(self, ids: list[str]):
+        self._ids = ids
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self, loads=None):
+        return list(self._ids)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeRiot:
+    """Serves /ids like Match-V5: newest first, startTime/endTime inclusive, paged."""
+
+    def __init__(self, match_ts: list[int]):
+        self.match_ts = sorted(match_ts, reverse=True)
+        self.calls = 0
+
+    def get(self, url, headers=None, params=None):
+        self.calls += 1
+        lo = params["startTime"]
+        hi = params.get("endTime", 2 ** 62)
+        hits = [f"EUW1_{ts}_{i}" for i, ts in enumerate(self.match_ts) if lo <= ts <= hi]
+        start = params["start"]
+        return _Resp(hits[start:start + params["count"]])
+
+
+@pytest.fixture
+def riot(tmp_db, monkeypatch):
+    async def acquire(region, priority=riot_limits.PRIORITY_INTERACTIVE, lane=None):
+        return "test-key"
+
+    monkeypatch.setattr(riot_limits, "acquire", acquire)
+
+    async def seed():
+        async with aiosqlite.connect(db.DB_PATH) as conn:
+            await conn.execute("INSERT INTO users(discord_user_id, created_at) VALUES('1', 0)")
+            await conn.execute(
+                "INSERT INTO riot_accounts(id, discord_user_id, riot_id, puuid, platform, added_at) "
+                "VALUES(?, '1', 'p#EUW', ?, 'EUW1', 0)",
+                (ACCOUNT_ID, PUUID),
+            )
+            await conn.commit()
+
+    asyncio.run(seed())
+
+    def make(match_ts: list[int]) -> FakeRiot:
+        # Match-V5 pages are coalesced flights: they send on the flight session
+        fake = FakeRiot(match_ts)
+        monkeypatch.setattr(singleflight, "http_session", lambda: fake)
+        return fake
+
+    return make
+
+
+def _count(fake: FakeRiot, start_ts: int, end_ts: int | None = None) -> tuple[int, int]:
+    """(games, HTTP calls) for one count of the window starting at start_ts."""
+    before = fake.calls
+    games = asyncio.run(
+        match_counts.count_lol_matches_in_window(
+            account_id=ACCOUNT_ID,
+            puuid=PUUID,
+            platform="EUW1",
+            start_time_ts=start_ts,
+            end_time_ts=end_ts,
+        )
+    )
+    return games, fake.calls - before
+
+
+def _month_start(now_ts: int) -> int:
+    # 31 days back, at 22:00 UTC like a Europe/Copenhagen window start
+    return (now_ts // DAY_SECONDS - 31) * DAY_SECONDS + 22 * 60 * 60
+
+
+def _games(start_ts: int, now_ts: int, active_days: int, per_day: int) -> list[int]:
+    first_day = start_ts // DAY_SECONDS + 1
+    return [
+        (first_day + d) * DAY_SECONDS + 3600 * (1 + g)
+        for d in range(active_days)
+        for g in range(per_day)
+        if (first_day + d) * DAY_SECONDS + 3600 * (1 + g) < now_ts
+    ]
+
+
+def test_typical_month_costs_a_few_requests(riot):
+    now_ts = int(time.time())
+    start_ts = _month_start(now_ts)
+    fake = riot(_games(start_ts, now_ts, active_days=25, per_day=3))
+
+    # First count: first partial day, one block for the closed days, live tail
+    games, calls = _count(fake, start_ts)
+    assert games == 75
+    assert calls <= 3
+
+    # Every later refresh: only the live tail
+    games, calls = _count(fake, start_ts)
+    assert games == 75
+    assert calls == 1
+
+
+def test_busy_month_bisects_only_full_pages(riot):
+    now_ts = int(time.time())
+    start_ts = _month_start(now_ts)
+    match_ts = _games(start_ts, now_ts, active_days=30, per_day=10)
+    fake = riot(match_ts)
+
+    games, calls = _count(fake, start_ts)
+    assert games == len(match_ts)
+    # Pages alone would take len // PAGE_SIZE + 1; bisecting stays in the same range
+    assert calls <= 4 * (len(match_ts) // PAGE_SIZE + 1)
+
+    games, calls = _count(fake, start_ts)
+    assert games == len(match_ts)
+    assert calls == 1
+
+
+def test_window_edge_inside_a_block_splits_it_once(riot):
+    now_ts = int(time.time())
+    start_ts = _month_start(now_ts)
+    match_ts = _games(start_ts, now_ts, active_days=25, per_day=3)
+    fake = riot(match_ts)
+    _count(fake, start_ts)
+
+    # A window starting mid-month reuses the month's block after one split
+    later_start = start_ts + 10 * DAY_SECONDS
+    expected = sum(1 for ts in match_ts if ts >= later_start)
+    games, calls = _count(fake, later_start)
+    assert games == expected
+    assert calls <= 3
+
+    games, calls = _count(fake, later_start)
+    assert games == expected
+    assert calls == 1
+
+
+def test_closed_window_is_recounted_from_the_db(riot):
+    now_ts = int(time.time())
+    start_ts = _month_start(now_ts) - 31 * DAY_SECONDS
+    end_ts = start_ts + 28 * DAY_SECONDS
+    match_ts = _games(start_ts, now_ts, active_days=60, per_day=2)
+    fake = riot(match_ts)
+
+    expected = sum(1 for ts in match_ts if start_ts <= ts < end_ts)
+    games, _ = _count(fake, start_ts, end_ts)
+    assert games == expected
+
+    games, calls = _count(fake, start_ts, end_ts)
+    assert games == expected
+    assert calls == 0
+
+
+def test_every_request_records_its_latency(riot):
+    now_ts = int(time.time())
+    start_ts = _month_start(now_ts)
+    fake = riot(_games(start_ts, now_ts, active_days=25, per_day=3))
+
+    samples = metrics._samples.get("riot.latency.refresh")
+    before = len(samples) if samples else 0
+    _, calls = _count(fake, start_ts)
+    assert len(metrics._samples["riot.latency.refresh"]) - before == calls
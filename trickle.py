@@ -0,0 +1,122 @@
+# trickle.py
+"""
+Continuous trickle refresh (optional).
+
+With TRICKLE_REFRESH = True in key.py, a background loop walks every linked
+riot_accounts row in round-robin order and recounts it for each guild window
+currently in use. It only sends requests at backfill priority and only while
+the region has more than TRICKLE_BUDGET_SHARE of its rate budget unused, so
+scheduled refreshes, /refreshnow and interactive commands always come first.
+Scheduled and manual refreshes then skip accounts the trickle updated in the
+last TRICKLE_FRESH_SECONDS and mostly just render current data.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import db
+import metrics
+import riot_limits
+from match_counts import REGIONAL, count_lol_matches_in_window
+from riot_limits import PRIORITY_BACKFILL
+from window_service import window_for_settings
+
+try:
+    from key import TRICKLE_REFRESH
+except Exception:
+    TRICKLE_REFRESH = False
+
+# Only trickle while more than this share of every rate-limit window is unused
+TRICKLE_BUDGET_SHARE = 0.5
+# Refreshes skip accounts the trickle counted this recently
+TRICKLE_FRESH_SECONDS = 30 * 60
+
+TRICKLE_BATCH = 50
+TRICKLE_ACCOUNT_INTERVAL_SECONDS = 2.0
+TRICKLE_IDLE_SECONDS = 30.0
+TRICKLE_TARGETS_TTL_SECONDS = 10 * 60
+
+
+async def _targets() -> list[tuple[str, int, str]]:
+    """
+    Distinct (window_key, window_start_ts, queue_policy) of all guilds. A window
+    key used with two different queue policies is left to the guild refreshes.
+    """
+    by_key: dict[str, tuple[int, str]] = {}
+    conflicting: set[str] = set()
+
+    for gs in await db.list_all_guild_settings():
+        try:
+            window_key, start_ts, _, _, queue_policy = window_for_settings(gs)
+        except ValueError:
+            continue  # since_date mode without a date
+        prev = by_key.get(window_key)
+        if prev is not None and prev[1] != queue_policy:
+            conflicting.add(window_key)
+        by_key[window_key] = (start_ts, queue_policy)
+
+    return [(k, start_ts, qp) for k, (start_ts, qp) in by_key.items() if k not in conflicting]
+
+
+async def _update_account(
+    account_id: int,
+    puuid: str,
+    platform: str,
+    targets: list[tuple[str, int, str]],
+) -> None:
+    for window_key, start_ts, queue_policy in targets:
+        games = await count_lol_matches_in_window(
+            account_id=account_id,
+            puuid=puuid,
+            platform=platform,
+            start_time_ts=start_ts,
+            queue_policy=queue_policy,
+            priority=PRIORITY_BACKFILL,
+        )
+        await db.upsert_account_stats(account_id, window_key, games)
+    metrics.incr("trickle.accounts")
+
+
+async def run_forever() -> None:
+    cursor = int(await db.get_meta("trickle_cursor") or 0)
+    targets: list[tuple[str, int, str]] = []
+    targets_at = 0.0
+    counted = 0  # accounts counted in this lap
+
+    while True:
+        if time.monotonic() - targets_at > TRICKLE_TARGETS_TTL_SECONDS:
+            targets = await _targets()
+            targets_at = time.monotonic()
+
+        batch = await db.list_accounts_after(cursor, TRICKLE_BATCH)
+        if not batch:
+            if not counted:
+                # Nothing linked, no targets or no known regions: don't spin on the DB
+                await asyncio.sleep(TRICKLE_IDLE_SECONDS)
+            cursor = counted = 0  # wrap around
+            continue
+
+        for account_id, puuid, platform in batch:
+            region = REGIONAL.get((platform or "").upper())
+            if region is None or not targets:
+                cursor = account_id
+                continue
+
+            while not riot_limits.has_spare(region, TRICKLE_BUDGET_SHARE):
+                await asyncio.sleep(TRICKLE_IDLE_SECONDS)
+
+            counted += 1
+            try:
+                await _update_account(account_id, puuid, platform, targets)
+            except riot_limits.RiotUnavailable as e:
+                await asyncio.sleep(e.retry_after)
+                continue  # this account comes round again next lap
+            except Exception as e:
+                metrics.incr("trickle.errors")
+                print(f"[Trickle] account_id={account_id}: {type(e).__name__}: {e}")
+
+            cursor = account_id
+            await asyncio.sleep(TRICKLE_ACCOUNT_INTERVAL_SECONDS)
+
+        await db.set_meta("trickle_cursor", str(cursor))
@@ -33,3 +33,22 @@ def compute_window_start_ts(now_utc: datetime, mode: str, tz_name: str, since_ts
 def make_window_key(mode: str, start_ts: int, tz_name: str) -> str:
     # Unique enough for caching + multi-guild support
     return f"{mode}:{tz_name}:{start_ts}"
+
+
+def compute_next_window_start_ts(mode: str, start_ts: int, tz_name: str) -> int:
+    """
+    Start of the window after the one starting at start_ts (= that window's end).
+    """
+    tz = ZoneInfo(tz_name)
+    start = datetime.fromtimestamp(start_ts, tz).date()
+
+    if mode == "week":
+        nxt = start + timedelta(days=7)
+    elif mode == "month":
+        nxt = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    elif mode == "year":
+        nxt = start.replace(year=start.year + 1)
+    else:
+        raise ValueError(f"No next window in mode: {mode}")
+
+    return int(datetime.combine(nxt, dtime(0, 0), tzinfo=tz).astimezone(timezone.utc).timestamp())
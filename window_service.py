@@ -0,0 +1,109 @@
+# window_service.py
+"""
+Window boundaries and rollover seeding.
+
+Boundaries are cached per (mode, tz): the current window, the next one and
+the last one looked up. Commands and refreshes only redo the tz maths once a
+boundary has passed.
+
+When a window rolls over, the new window_key has no account_stats rows. Every
+board goes empty and every account looks unpolled, so the first refresh
+would count everyone against Riot at the same moment. seed_rollovers() fills
+the new window from what the DB already has: each account with a row in the
+previous window gets 0 games as of the window start. That count is exact at
+that moment. Boards show right away, and adaptive polling (activity.py)
+recounts active accounts on the next refresh and quiet ones over the
+following hours. A seed never counts as a fresh count for the trickle or
+pre-warm skips (db.list_fresh_account_ids).
+"""
+from __future__ import annotations
+
+import time
+from datetime import datetime, timezone
+
+import db
+import guild_cache
+import metrics
+from utilities.utils_window import compute_next_window_start_ts, compute_window_start_ts, make_window_key
+
+# Spans kept per (mode, tz): previous, current, next
+SPANS_PER_KEY = 3
+
+# Longest the rollover loop sleeps, so changed window settings are picked up
+ROLLOVER_CHECK_SECONDS = 15 * 60
+
+_spans: dict[tuple[str, str], list[tuple[int, int]]] = {}
+_seeded: set[str] = set()  # window keys seeded by this process
+
+
+def bounds(mode: str, tz_name: str, at_ts: int | None = None) -> tuple[int, int]:
+    """
+    (start_ts, end_ts) of the week/month/year window containing at_ts (default now).
+    """
+    at_ts = int(time.time()) if at_ts is None else at_ts
+    spans = _spans.setdefault((mode, tz_name), [])
+    for span in spans:
+        if span[0] <= at_ts < span[1]:
+            return span
+
+    start = compute_window_start_ts(datetime.fromtimestamp(at_ts, timezone.utc), mode, tz_name, None)
+    span = (start, compute_next_window_start_ts(mode, start, tz_name))
+    following = (span[1], compute_next_window_start_ts(mode, span[1], tz_name))
+    spans.extend(s for s in (span, following) if s not in spans)
+    del spans[:-SPANS_PER_KEY]
+    return span
+
+
+def window_for_settings(gs: dict, now_utc: datetime | None = None) -> tuple[str, int, str, str, str]:
+    """
+    Returns (window_key, window_start_ts, mode, tz_name, queue_policy) for a guild_settings row.
+    """
+    mode = (gs.get("window_mode") or "month").strip().lower()
+    tz_name = gs.get("window_tz") or "Europe/Copenhagen"
+    queue_policy = (gs.get("queue_policy") or "all").strip().lower()
+
+    if mode == "since_date":
+        start_ts = compute_window_start_ts(
+            now_utc=now_utc or datetime.now(timezone.utc),
+            mode=mode,
+            tz_name=tz_name,
+            since_ts=gs.get("window_since_ts"),
+        )
+    else:
+        start_ts, _ = bounds(mode, tz_name, int(now_utc.timestamp()) if now_utc else None)
+    return make_window_key(mode, start_ts, tz_name), start_ts, mode, tz_name, queue_policy
+
+
+async def seed_rollovers(now_ts: int | None = None) -> int:
+    """
+    Seeds the current window of every (mode, tz) in use from its previous
+    window, once per window. Returns when the next window starts (at most
+    ROLLOVER_CHECK_SECONDS away), for the caller to sleep until.
+    """
+    now_ts = int(time.time()) if now_ts is None else now_ts
+    next_check = now_ts + ROLLOVER_CHECK_SECONDS
+
+    fresh: set[str] = set()
+    for gs in await db.list_all_guild_settings():
+        if (gs.get("window_mode") or "month").strip().lower() == "since_date":
+            continue
+        window_key, start_ts, mode, tz_name, _ = window_for_settings(
+            gs, datetime.fromtimestamp(now_ts, timezone.utc)
+        )
+        next_check = min(next_check, bounds(mode, tz_name, now_ts)[1])
+
+        # Guilds with the same (mode, tz) share the window_key and its rows
+        if window_key not in _seeded:
+            prev_start, _ = bounds(mode, tz_name, start_ts - 1)
+            seeded = await db.seed_window_stats(window_key, make_window_key(mode, prev_start, tz_name), start_ts)
+            _seeded.add(window_key)
+            fresh.add(window_key)
+            if seeded:
+                metrics.incr("windows.seeded_accounts", seeded)
+                print(f"[Windows] {window_key}: seeded {seeded} accounts from the previous window")
+
+        if window_key in fresh:
+            # Boards cached empty before the seed
+            guild_cache.invalidate_board(int(gs["guild_id"]))
+
+    return next_check